@@ -57,7 +57,7 @@ class PDForm_Miner(App):
         
         if(dlg.result):
             self.log.info("Opening Template: %s" % dlg.selected_template.name)
-            app = gui.FormImporter(None, dlg.selected_template)
+            app = gui.FormImporter(None, dlg.selected_template, Templates)
             app.mainloop()
             
         save_templates(Templates)
@@ -3,4 +3,5 @@ pip install pyexcel
 pip install pyexcel-ods3
 pip install pyexcel-xlsx
 pip install pyexcel-xls
+pip install numpy
 pause
\ No newline at end of file
@@ -11,3 +11,4 @@ pip3 install pyexcel
 pip3 install pyexcel-ods3
 pip3 install pyexcel-xlsx
 pip3 install pyexcel-xls
+pip3 install numpy
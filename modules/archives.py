@@ -0,0 +1,299 @@
+####################################################################################################
+# The MIT License (MIT)
+#
+# Copyright (c) 2015, Alexander I. Mykyta
+# All rights reserved.
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+# 
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+####################################################################################################
+
+# Reading PDFs straight out of .zip and .tar(.gz/.bz2/.xz) archives
+#
+# A PDF inside an archive is identified by the archive's path joined with the member name,
+# as if the archive was a folder. For example: /data/batch1.zip/forms/JohnDoe.pdf
+
+import os
+import zlib
+import queue
+import tarfile
+import zipfile
+import datetime
+import threading
+import collections
+import logging
+
+from . import prefetch
+
+log = logging.getLogger("archives")
+
+ZIP_EXTENSIONS = (".zip",)
+TAR_EXTENSIONS = (".tar", ".tar.gz", ".tgz", ".tar.bz2", ".tbz2", ".tar.xz", ".txz")
+EXTENSIONS = ZIP_EXTENSIONS + TAR_EXTENSIONS
+
+# For file dialogs
+FILETYPES = [('Archives of PDFs', ' '.join(EXTENSIONS))]
+
+#===================================================================================================
+def is_zip(path):
+    return(path.lower().endswith(ZIP_EXTENSIONS))
+
+def is_archive(path):
+    return(path.lower().endswith(EXTENSIONS))
+
+def is_pdf_member(name):
+    return(name.lower().endswith(".pdf"))
+
+def member_path(archive, member):
+    """ Returns the identity of an archive member """
+    return(os.path.join(archive, *member.split("/")))
+
+def split_path(path):
+    """ Splits an identity into (archive, member name).
+    Returns (None, path) if the path does not point into an archive """
+    head = path
+    parts = []
+    while(True):
+        head, tail = os.path.split(head)
+        if(not tail):
+            return((None, path))
+        parts.insert(0, tail)
+        if(is_archive(head) and os.path.isfile(head)):
+            return((head, "/".join(parts)))
+
+#===================================================================================================
+def list_members(archive):
+    """ Returns the names of the PDFs in an archive, in archive order """
+    if(is_zip(archive)):
+        with zipfile.ZipFile(archive) as z:
+            return([i.filename for i in z.infolist() if (not i.is_dir()) and is_pdf_member(i.filename)])
+    else:
+        # Compressed tars have to be decompressed to find the member names
+        with tarfile.open(archive, 'r|*') as t:
+            return([m.name for m in t if m.isfile() and is_pdf_member(m.name)])
+
+def member_sizes(archive):
+    """ Returns {member name: uncompressed size} of the PDFs in an archive """
+    if(is_zip(archive)):
+        with zipfile.ZipFile(archive) as z:
+            return({i.filename: i.file_size for i in z.infolist() if (not i.is_dir()) and is_pdf_member(i.filename)})
+    else:
+        with tarfile.open(archive, 'r|*') as t:
+            return({m.name: m.size for m in t if m.isfile() and is_pdf_member(m.name)})
+
+def expand(paths):
+    """ Replaces any archives in a list of paths with the identities of the PDFs inside them """
+    result = []
+    for path in paths:
+        if(is_archive(path)):
+            try:
+                members = list_members(path)
+            except (OSError, zipfile.BadZipFile, tarfile.TarError) as E:
+                log.warning("Could not read archive '%s': %s" % (path, E))
+                continue
+            for m in members:
+                result.append(member_path(path, m))
+        else:
+            result.append(path)
+    return(result)
+
+#===================================================================================================
+class ZipReader(prefetch.Prefetcher):
+    """ Reads members out of a zip file on several threads.
+    Each thread has its own handle to the archive, so the members decompress in parallel """
+    read_errors = (OSError, KeyError, RuntimeError, zipfile.BadZipFile, zlib.error)
+    
+    def __init__(self, archive, members, n_threads = prefetch.DEFAULT_THREADS, max_bytes = prefetch.DEFAULT_MAX_BYTES):
+        prefetch.Prefetcher.__init__(self, members, n_threads, max_bytes)
+        self.archive = archive
+        self.local = threading.local()
+        self.handles = []
+        self.handles_lock = threading.Lock()
+        self.infos = None
+    
+    def get_zip(self):
+        z = getattr(self.local, 'zip', None)
+        if(z == None):
+            z = zipfile.ZipFile(self.archive)
+            self.local.zip = z
+            with self.handles_lock:
+                self.handles.append(z)
+                if(self.infos == None):
+                    self.infos = {i.filename: i for i in z.infolist()}
+        return(z)
+    
+    def get_name(self, member):
+        return(member_path(self.archive, member))
+    
+    def stat(self, member):
+        self.get_zip()
+        info = self.infos.get(member)
+        if(info == None):
+            raise FileNotFoundError("No member '%s' in %s" % (member, self.archive))
+        return((info.file_size, datetime.datetime(*info.date_time)))
+    
+    def load(self, member):
+        return(self.get_zip().read(member))
+    
+    def __iter__(self):
+        try:
+            for item in prefetch.Prefetcher.__iter__(self):
+                yield(item)
+        finally:
+            with self.handles_lock:
+                for z in self.handles:
+                    z.close()
+                self.handles = []
+
+#---------------------------------------------------------------------------------------------------
+def iter_tar(archive, members, max_queue = 16):
+    """ Reads the given members out of a tar file, in archive order.
+    Tar streams cannot be decompressed in parallel, but a background thread decompresses ahead
+    while the previous member is being parsed """
+    wanted = set(members)
+    q = queue.Queue(max_queue)
+    stop = threading.Event()
+    
+    def reader():
+        try:
+            with tarfile.open(archive, 'r|*') as t:
+                for m in t:
+                    if(stop.is_set()):
+                        return
+                    if((m.name not in wanted) or (not m.isfile())):
+                        continue
+                    timestamp = datetime.datetime.fromtimestamp(m.mtime)
+                    data = t.extractfile(m).read()
+                    q.put(prefetch.PrefetchedFile(member_path(archive, m.name), data, timestamp))
+        except (OSError, tarfile.TarError, EOFError, zlib.error) as E:
+            log.warning("Could not read archive '%s': %s" % (archive, E))
+        finally:
+            q.put(None)
+    
+    th = threading.Thread(target=reader, daemon=True)
+    th.start()
+    try:
+        while(True):
+            item = q.get()
+            if(item == None):
+                break
+            yield(item)
+    finally:
+        stop.set()
+        # Unblock the reader if it is waiting on a full queue
+        while(th.is_alive()):
+            try:
+                q.get(timeout=0.1)
+            except queue.Empty:
+                pass
+
+def iter_tar_ordered(archive, members, max_bytes = prefetch.DEFAULT_MAX_BYTES):
+    """ Reads the given members out of a tar file, in the order of members. Members that are not
+    in the archive are reported as FileNotFoundErrors in their place.
+    
+    Members that come before their turn in the archive are held in memory, up to max_bytes.
+    Past that they are left for another pass over the archive.
+    A tar can hold several members with the same name. The k-th time a name is listed in members
+    gets the k-th of them, as in list_members(). Listings past the last of them get the last. """
+    names = [member_path(archive, m) for m in members]
+    pos = 0
+    while(pos < len(names)):
+        # Positions still to fill, by name. Copies that earlier passes used up are skipped
+        slots = {}
+        for i in range(pos, len(names)):
+            slots.setdefault(names[i], collections.deque()).append(i)
+        skip = collections.Counter(names[:pos])
+        held = {}
+        held_bytes = 0
+        last = {}
+        deferred = set()
+        
+        for pf in iter_tar(archive, members[pos:]):
+            name = pf.filename
+            if(skip[name]):
+                skip[name] = skip[name] - 1
+                if(slots.get(name)):
+                    last[name] = pf
+                continue
+            if((name in deferred) or not slots.get(name)):
+                continue
+            
+            i = slots[name][0]
+            if(i != pos):
+                if(held_bytes + len(pf.data) > max_bytes):
+                    deferred.add(name)
+                    continue
+                held[i] = pf
+                held_bytes = held_bytes + len(pf.data)
+            
+            slots[name].popleft()
+            if(slots[name]):
+                last[name] = pf
+            else:
+                last.pop(name, None)
+            
+            if(i == pos):
+                yield(pf)
+                pos = pos + 1
+                while(pos in held):
+                    pf = held.pop(pos)
+                    held_bytes = held_bytes - len(pf.data)
+                    yield(pf)
+                    pos = pos + 1
+        
+        # Archive is exhausted up to the first deferred member
+        while(pos < len(names)):
+            name = names[pos]
+            if(pos in held):
+                yield(held.pop(pos))
+            elif(name in deferred):
+                log.info("Reading '%s' again for members that were out of order" % archive)
+                break
+            elif(name in last):
+                yield(last[name])
+            else:
+                yield(prefetch.PrefetchedFile(name, error=FileNotFoundError(name)))
+            pos = pos + 1
+
+#===================================================================================================
+def iter_files(paths, n_threads = prefetch.DEFAULT_THREADS, max_bytes = prefetch.DEFAULT_MAX_BYTES, screen = None):
+    """ Yields a prefetch.PrefetchedFile for each path, where paths can be loose files or members
+    of archives (see expand()).
+    Output is in the same order as paths. Reading is fastest when the members of a tar are listed
+    in archive order (see iter_tar_ordered()).
+    screen is an optional prefilter.Prefilter for loose files (see prefetch.Prefetcher)
+    """
+    # Group consecutive runs of loose files, or of members of the same archive
+    runs = []
+    for path in paths:
+        archive, member = split_path(path)
+        if(runs and (runs[-1][0] == archive)):
+            runs[-1][1].append(member)
+        else:
+            runs.append((archive, [member]))
+    
+    for archive, items in runs:
+        if(archive == None):
+            reader = prefetch.Prefetcher(items, n_threads, max_bytes, screen)
+        elif(is_zip(archive)):
+            reader = ZipReader(archive, items, n_threads, max_bytes)
+        else:
+            reader = iter_tar_ordered(archive, items, max_bytes)
+        
+        for pf in reader:
+            yield(pf)
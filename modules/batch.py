@@ -0,0 +1,584 @@
+####################################################################################################
+# The MIT License (MIT)
+#
+# Copyright (c) 2015, Alexander I. Mykyta
+# All rights reserved.
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+# 
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+####################################################################################################
+
+# Batch extraction that can be spread over several hosts that share a directory.
+#
+# A job directory holds:
+#   job.json        Job settings (chunk size, file count, chunk boundaries)
+#   manifest.txt    One PDF path per line. Defines the output row order
+#   plan.pickle     The compiled ExtractionPlan, so every host produces identical rows
+#   leases/         One lease file per chunk that is being worked on
+#   shards/         One output file per finished chunk
+#
+# Workers claim chunks by atomically creating their lease file. A lease is kept alive by
+# touching it. Leases that stop being touched belong to a crashed worker and get re-claimed.
+# Shards are written to a temp file and renamed into place, so a chunk is either finished or
+# not. Processing the same chunk twice gives the same shard, so a re-claim race only costs time.
+
+import os
+import re
+import sys
+import json
+import time
+import pickle
+import socket
+import fnmatch
+import logging
+import argparse
+import multiprocessing
+
+from . import form_data
+from . import pdf_parser
+from . import report_template
+from . import archives
+from . import prefilter
+from . import rollover
+from . import metrics
+from . import schedule
+
+log = logging.getLogger("batch")
+
+STATUS_OK = "ok"
+STATUS_MISMATCH = "mismatch"
+STATUS_INVALID = "invalid"
+STATUS_FAILED = "failed"
+
+DEFAULT_CHUNK_SIZE = 200
+DEFAULT_LEASE_TIMEOUT = 300 # seconds
+DEFAULT_METRICS_INTERVAL = 15 # seconds
+
+#===================================================================================================
+# Extraction
+#===================================================================================================
+STATUS_METRICS = {
+    STATUS_OK: metrics.FILES_MATCHED,
+    STATUS_MISMATCH: metrics.FILES_MISMATCHED,
+    STATUS_INVALID: metrics.FILES_INVALID,
+    STATUS_FAILED: metrics.FILES_FAILED,
+}
+
+def record_metrics(status, seconds, n_bytes):
+    """ Counts one file that went through extraction """
+    STATUS_METRICS[status].inc()
+    if((status == STATUS_OK) or (status == STATUS_MISMATCH)):
+        metrics.FILES_PARSED.inc()
+    metrics.BYTES_READ.inc(n_bytes)
+    metrics.PARSE_SECONDS.observe(seconds)
+    metrics.BUSY_SECONDS.inc(seconds)
+
+def process_file(plan, filename, prefetched = None, screen = None):
+    """ Runs one file through the extraction plan.
+    prefetched is an optional prefetch.PrefetchedFile with the file's contents.
+    screen is an optional prefilter.Prefilter to reject prefetched files before parsing them.
+    Returns (status, row). row is None unless status is STATUS_OK """
+    t_start = time.perf_counter()
+    status, row = extract_file(plan, filename, prefetched, screen)
+    n_bytes = 0
+    if((prefetched != None) and (prefetched.data != None)):
+        n_bytes = len(prefetched.data)
+    record_metrics(status, time.perf_counter() - t_start, n_bytes)
+    return((status, row))
+
+def extract_file(plan, filename, prefetched, screen):
+    data = None
+    timestamp = None
+    if(prefetched != None):
+        if(prefetched.error != None):
+            if(isinstance(prefetched.error, FileNotFoundError)):
+                return((STATUS_INVALID, None))
+            log.warning("Failed to read '%s': %s" % (filename, prefetched.error))
+            return((STATUS_FAILED, None))
+        data = prefetched.data
+        timestamp = prefetched.timestamp
+        
+        # Rejected before it was read, or now
+        reason = prefetched.rejected
+        if((reason == None) and (screen != None)):
+            reason = screen.check(filename, data, timestamp)
+        if(reason == prefilter.REJECT_PAGES):
+            return((STATUS_MISMATCH, None))
+        elif(reason != None):
+            return((STATUS_INVALID, None))
+    
+    try:
+        F = form_data.FormData(filename, plan.required_fields, plan.widget_map, data, timestamp)
+    except Exception as E:
+        log.warning("Failed to read '%s': %s" % (filename, E))
+        return((STATUS_FAILED, None))
+    
+    if(not F.valid):
+        return((STATUS_INVALID, None))
+    if(not plan.is_matching_form(F)):
+        return((STATUS_MISMATCH, None))
+    return((STATUS_OK, plan.make_row(F)))
+
+def find_pdfs(start_dir):
+    """ Recursively finds all PDFs in a directory, in a stable order.
+    PDFs inside archives are included (see archives.expand()) """
+    matches = []
+    for root, dirnames, filenames in os.walk(start_dir):
+        dirnames.sort()
+        for filename in sorted(filenames):
+            if(fnmatch.fnmatch(filename, '*.pdf') or archives.is_archive(filename)):
+                matches.append(os.path.join(root, filename))
+    return(archives.expand(matches))
+
+#===================================================================================================
+# Manifest
+#===================================================================================================
+def write_manifest(path, filenames):
+    with open(path, 'w', encoding="utf-8") as f:
+        for filename in filenames:
+            f.write(filename + "\n")
+
+def read_manifest(path):
+    with open(path, 'r', encoding="utf-8") as f:
+        return([line.rstrip("\n") for line in f if line.strip()])
+
+#===================================================================================================
+# Leases
+#===================================================================================================
+class Lease:
+    """ Exclusive claim on a chunk of work, held as a file in the shared directory """
+    def __init__(self, path, owner):
+        self.path = path
+        self.owner = owner
+        self.renewed = time.time()
+    
+    @classmethod
+    def claim(cls, path, owner, timeout):
+        """ Tries to claim the lease. Returns a Lease, or None if someone else holds it """
+        for attempt in range(2):
+            try:
+                fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            except FileExistsError:
+                pass
+            else:
+                with os.fdopen(fd, 'w') as f:
+                    f.write(owner)
+                return(cls(path, owner))
+            
+            # Held by someone. Check if they are still alive
+            try:
+                stale = cls.read_holder(path)
+            except FileNotFoundError:
+                # Released in the meantime
+                continue
+            if(time.time() - stale[1] < timeout):
+                return(None)
+            
+            # Abandoned. Move it out of the way. Only one worker can win the rename.
+            tomb = "%s.stale-%s" % (path, owner)
+            try:
+                os.rename(path, tomb)
+            except OSError:
+                return(None)
+            
+            # Another worker may have re-claimed it between the check and the rename, or its
+            # holder renewed it. Then a live lease was moved, and it is put back
+            try:
+                moved = cls.read_holder(tomb)
+            except FileNotFoundError:
+                return(None)
+            if(moved != stale):
+                cls.restore(tomb, path)
+                return(None)
+            
+            os.remove(tomb)
+            log.warning("Re-claiming abandoned lease: %s" % path)
+        
+        return(None)
+    
+    @staticmethod
+    def read_holder(path):
+        """ Returns (owner, mtime) of a lease file """
+        mtime = os.path.getmtime(path)
+        with open(path, 'r') as f:
+            return((f.read(), mtime))
+    
+    @staticmethod
+    def restore(tomb, path):
+        """ Moves a live lease back, unless the path was claimed again in the meantime """
+        try:
+            # Unlike a rename, a link never replaces an existing file
+            os.link(tomb, path)
+        except FileExistsError:
+            log.warning("Lease was taken over by another worker: %s" % path)
+        except OSError:
+            # No hard links on this file system
+            if(not os.path.exists(path)):
+                os.rename(tomb, path)
+                return
+        os.remove(tomb)
+    
+    def renew(self, interval = 0):
+        """ Touches the lease file if at least interval seconds have passed """
+        now = time.time()
+        if(now - self.renewed < interval):
+            return
+        self.renewed = now
+        try:
+            os.utime(self.path)
+        except FileNotFoundError:
+            log.warning("Lease was taken over by another worker: %s" % self.path)
+    
+    def release(self):
+        """ Removes the lease file, unless another worker has taken it over """
+        # Moved out of the way first, so the check and the removal see the same file
+        tomb = "%s.release-%s" % (self.path, self.owner)
+        try:
+            os.rename(self.path, tomb)
+        except FileNotFoundError:
+            return
+        try:
+            holder = self.read_holder(tomb)[0]
+        except FileNotFoundError:
+            return
+        if(holder != self.owner):
+            log.warning("Lease was taken over by another worker: %s" % self.path)
+            self.restore(tomb, self.path)
+            return
+        os.remove(tomb)
+
+#===================================================================================================
+# Jobs
+#===================================================================================================
+class BatchJob:
+    """ A batch extraction job stored in a shared directory """
+    def __init__(self, job_dir):
+        self.job_dir = job_dir
+        with open(os.path.join(job_dir, "job.json"), 'r') as f:
+            settings = json.load(f)
+        self.chunk_size = settings['chunk_size']
+        self.n_files = settings['n_files']
+        
+        # (start, end, cost) of each chunk. Jobs created before chunks were sized by cost have
+        # fixed size chunks
+        chunks = settings.get('chunks')
+        if(chunks == None):
+            chunks = [(start, min(start + self.chunk_size, self.n_files), 0)
+                      for start in range(0, self.n_files, self.chunk_size)]
+        self.chunks = [tuple(c) for c in chunks]
+        self.n_chunks = len(self.chunks)
+        self.claim_order = schedule.claim_order(self.chunks)
+        self.filenames = None
+        self.plan = None
+    
+    @classmethod
+    def create(cls, job_dir, template, filenames, chunk_size = DEFAULT_CHUNK_SIZE):
+        """ Sets up a new job directory.
+        The manifest is cut into chunks of about equal cost, by file size. Members of a tar are
+        kept in one chunk (see schedule) """
+        os.makedirs(os.path.join(job_dir, "leases"), exist_ok=True)
+        os.makedirs(os.path.join(job_dir, "shards"), exist_ok=True)
+        
+        write_manifest(os.path.join(job_dir, "manifest.txt"), filenames)
+        
+        # The plan is compiled once, so constants like the export time match on every host
+        with open(os.path.join(job_dir, "plan.pickle"), 'wb') as f:
+            pickle.dump(template.compile(), f)
+        
+        chunks = schedule.balanced_chunks(
+            schedule.get_file_sizes(filenames), chunk_size, links = schedule.get_tar_links(filenames)
+        )
+        
+        settings = {
+            'chunk_size': chunk_size,
+            'n_files': len(filenames),
+            'chunks': chunks
+        }
+        with open(os.path.join(job_dir, "job.json"), 'w') as f:
+            json.dump(settings, f, indent=2)
+        
+        return(cls(job_dir))
+    
+    def load(self):
+        """ Loads the manifest and plan """
+        if(self.filenames == None):
+            self.filenames = read_manifest(os.path.join(self.job_dir, "manifest.txt"))
+            with open(os.path.join(self.job_dir, "plan.pickle"), 'rb') as f:
+                self.plan = pickle.load(f)
+    
+    def lease_path(self, chunk):
+        return(os.path.join(self.job_dir, "leases", "chunk_%06d.lease" % chunk))
+    
+    def shard_path(self, chunk):
+        return(os.path.join(self.job_dir, "shards", "chunk_%06d.json" % chunk))
+    
+    def is_done(self, chunk):
+        return(os.path.exists(self.shard_path(chunk)))
+    
+    def get_pending_chunks(self):
+        """ Returns the chunks that are not finished, most costly first """
+        return([c for c in self.claim_order if not self.is_done(c)])
+    
+    #--------------------------------------------------------------------------
+    def process_chunk(self, chunk, lease = None, renew_interval = DEFAULT_LEASE_TIMEOUT / 4):
+        """ Extracts one chunk of the manifest and writes its shard """
+        self.load()
+        start, end, cost = self.chunks[chunk]
+        
+        metrics.FILES_DISCOVERED.inc(end - start)
+        results = []
+        screen = prefilter.Prefilter.from_plan(self.plan)
+        files = archives.iter_files(self.filenames[start:end], screen=screen)
+        for idx, pf in zip(range(start, end), files):
+            status, row = process_file(self.plan, pf.filename, pf, screen)
+            results.append([idx, status, row])
+            if(lease):
+                lease.renew(renew_interval)
+        
+        # Write atomically
+        path = self.shard_path(chunk)
+        tmp_path = "%s.%s.tmp" % (path, os.getpid())
+        with open(tmp_path, 'w', encoding="utf-8") as f:
+            json.dump({'chunk': chunk, 'results': results}, f)
+        os.replace(tmp_path, path)
+        metrics.CHUNKS_DONE.inc()
+    
+    def run_worker(self, owner = None, lease_timeout = DEFAULT_LEASE_TIMEOUT, poll_interval = 5):
+        """ Claims and processes chunks until the whole job is done """
+        if(owner == None):
+            owner = "%s:%d" % (socket.gethostname(), os.getpid())
+        
+        while(True):
+            pending = self.get_pending_chunks()
+            metrics.CHUNKS_PENDING.set(len(pending))
+            if(len(pending) == 0):
+                return
+            
+            did_work = False
+            for chunk in pending:
+                if(self.is_done(chunk)):
+                    continue
+                lease = Lease.claim(self.lease_path(chunk), owner, lease_timeout)
+                if(lease == None):
+                    continue
+                try:
+                    # Might have finished while the lease was being claimed
+                    if(not self.is_done(chunk)):
+                        log.info("%s: processing chunk %d/%d" % (owner, chunk+1, self.n_chunks))
+                        self.process_chunk(chunk, lease, lease_timeout / 4)
+                        did_work = True
+                finally:
+                    lease.release()
+            
+            if(not did_work):
+                # Everything left is leased by someone else. Wait for them to finish, or for
+                # their leases to expire
+                time.sleep(poll_interval)
+    
+    #--------------------------------------------------------------------------
+    def iter_merged(self):
+        """ Yields (index, status, row) of every file, in manifest order """
+        self.load()
+        pending = self.get_pending_chunks()
+        if(len(pending)):
+            raise RuntimeError("%d chunks are not finished yet" % len(pending))
+        
+        for chunk in range(self.n_chunks):
+            with open(self.shard_path(chunk), 'r', encoding="utf-8") as f:
+                shard = json.load(f)
+            for idx, status, row in shard['results']:
+                yield((idx, status, row))
+    
+    def merge(self, stats = False):
+        """ Combines all shards into one DataTable in manifest order.
+        If stats is set, the table collects per-column statistics as the rows are merged.
+        Returns (table, status counts) """
+        self.load()
+        TBL = report_template.DataTable()
+        TBL.init_plan(self.plan, stats)
+        counts = {}
+        
+        for idx, status, row in self.iter_merged():
+            counts[status] = counts.get(status, 0) + 1
+            if(status == STATUS_OK):
+                TBL.append_row_tuple(row)
+        
+        return(TBL, counts)
+    
+    def merge_to(self, filename, stats = False, max_rows = None, max_bytes = None, split_files = False):
+        """ Merges all shards straight into filename without holding all the rows.
+        The output is split into parts as needed (see rollover.RolloverWriter).
+        Returns (number of rows, parts written, status counts) """
+        self.load()
+        TBL = report_template.DataTable()
+        TBL.init_plan(self.plan, stats)
+        writer = rollover.RolloverWriter(filename, TBL.headings, TBL.name, max_rows, max_bytes, split_files)
+        TBL.stream_to(writer)
+        counts = {}
+        
+        try:
+            for idx, status, row in self.iter_merged():
+                counts[status] = counts.get(status, 0) + 1
+                if(status == STATUS_OK):
+                    TBL.append_row_tuple(row)
+            parts = TBL.finish()
+        except:
+            writer.abort()
+            raise
+        TBL.export_stats_json(filename)
+        
+        return((TBL.get_total_rows(), parts, counts))
+
+#===================================================================================================
+def start_metrics(owner, metrics_dir = None, interval = DEFAULT_METRICS_INTERVAL, port = None):
+    """ Starts publishing this process's metrics, labelled with the worker's name.
+    If metrics_dir is given, they are written there every interval seconds. If port is given,
+    they are served over HTTP along with a health check (see metrics.serve()).
+    Returns a function that stops publishing """
+    metrics.REGISTRY.labels['worker'] = owner
+    
+    reporter = None
+    if(metrics_dir != None):
+        path_base = os.path.join(metrics_dir, "pdform_" + re.sub(r'[^\w.-]', "_", owner))
+        reporter = metrics.MetricsReporter(path_base, interval).start()
+    
+    server = None
+    if(port != None):
+        server = metrics.serve(port)
+    
+    def stop():
+        if(reporter != None):
+            reporter.stop()
+        if(server != None):
+            server.shutdown()
+    return(stop)
+
+def _local_worker(job_dir, owner, lease_timeout, page_workers, metrics_dir, metrics_interval, metrics_port):
+    # Share the cores with the other workers when splitting up large documents
+    pdf_parser.PAGE_WORKERS = page_workers
+    stop_metrics = start_metrics(owner, metrics_dir, metrics_interval, metrics_port)
+    try:
+        BatchJob(job_dir).run_worker(owner, lease_timeout)
+    finally:
+        stop_metrics()
+
+def run_local(job_dir, n_workers = None, lease_timeout = DEFAULT_LEASE_TIMEOUT,
+              metrics_dir = None, metrics_interval = DEFAULT_METRICS_INTERVAL, metrics_port = None):
+    """ Runs the job with several processes on this machine.
+    Each worker publishes its own metrics. With metrics_port, worker i serves on metrics_port + i """
+    if(n_workers == None):
+        n_workers = multiprocessing.cpu_count()
+    
+    page_workers = max(1, multiprocessing.cpu_count() // n_workers)
+    
+    procs = []
+    for i in range(n_workers):
+        owner = "%s:local%d" % (socket.gethostname(), i)
+        port = None if (metrics_port == None) else (metrics_port + i)
+        p = multiprocessing.Process(
+            target=_local_worker,
+            args=(job_dir, owner, lease_timeout, page_workers, metrics_dir, metrics_interval, port)
+        )
+        p.start()
+        procs.append(p)
+    for p in procs:
+        p.join()
+
+#===================================================================================================
+# Command line interface
+#===================================================================================================
+def load_template(path):
+    with open(path, 'r') as f:
+        return(report_template.ReportTemplate.from_dict(json.load(f)))
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(
+        prog = "python -m modules.batch",
+        description = "Batch form extraction over a shared job directory"
+    )
+    sub = parser.add_subparsers(dest = "cmd")
+    
+    p = sub.add_parser("create", help = "Create a job from a template and a folder or manifest")
+    p.add_argument("job_dir")
+    p.add_argument("--template", required = True, help = "Template .json file")
+    src = p.add_mutually_exclusive_group(required = True)
+    src.add_argument("--dir", help = "Folder to search for PDFs")
+    src.add_argument("--manifest", help = "Text file with one PDF path per line")
+    p.add_argument("--chunk-size", type = int, default = DEFAULT_CHUNK_SIZE)
+    
+    p = sub.add_parser("work", help = "Process chunks of a job until it is done")
+    p.add_argument("job_dir")
+    p.add_argument("-j", "--jobs", type = int, default = 1, help = "Worker processes on this host")
+    p.add_argument("--lease-timeout", type = float, default = DEFAULT_LEASE_TIMEOUT)
+    p.add_argument("--metrics-dir", default = None,
+                   help = "Folder to write Prometheus (.prom) and JSON metrics files to")
+    p.add_argument("--metrics-interval", type = float, default = DEFAULT_METRICS_INTERVAL,
+                   help = "Seconds between metrics file updates")
+    p.add_argument("--metrics-port", type = int, default = None,
+                   help = "Serve /metrics, /metrics.json and /health on this port. "
+                   "With -j, each worker uses the next port up")
+    
+    p = sub.add_parser("merge", help = "Merge the finished shards into one output file")
+    p.add_argument("job_dir")
+    p.add_argument("output", help = "Output .xlsx/.xls file")
+    p.add_argument("--stats", action = "store_true",
+                   help = "Add a sheet of per-column statistics, and write them to a .stats.json file")
+    p.add_argument("--max-rows", type = int, default = None,
+                   help = "Rows per sheet or file. Defaults to what the format can hold")
+    p.add_argument("--max-bytes", type = int, default = None,
+                   help = "Approximate size of the cell text per sheet or file")
+    p.add_argument("--split-files", action = "store_true",
+                   help = "Put each part in its own numbered file instead of its own sheet")
+    
+    args = parser.parse_args(argv)
+    logging.basicConfig(level = logging.INFO)
+    logging.getLogger("pdfminer").setLevel(logging.WARNING)
+    
+    if(args.cmd == "create"):
+        T = load_template(args.template)
+        if(args.dir):
+            filenames = find_pdfs(os.path.abspath(args.dir))
+        else:
+            filenames = read_manifest(args.manifest)
+        J = BatchJob.create(args.job_dir, T, filenames, args.chunk_size)
+        log.info("Created job with %d files in %d chunks" % (J.n_files, J.n_chunks))
+    elif(args.cmd == "work"):
+        if(args.jobs > 1):
+            run_local(
+                args.job_dir, args.jobs, args.lease_timeout,
+                args.metrics_dir, args.metrics_interval, args.metrics_port
+            )
+        else:
+            owner = "%s:%d" % (socket.gethostname(), os.getpid())
+            stop_metrics = start_metrics(owner, args.metrics_dir, args.metrics_interval, args.metrics_port)
+            try:
+                BatchJob(args.job_dir).run_worker(owner, args.lease_timeout)
+            finally:
+                stop_metrics()
+    elif(args.cmd == "merge"):
+        n_rows, parts, counts = BatchJob(args.job_dir).merge_to(
+            args.output, args.stats, args.max_rows, args.max_bytes, args.split_files
+        )
+        log.info("Merged %d rows in %d parts. %s" % (n_rows, len(parts), counts))
+    else:
+        parser.print_help()
+        return(1)
+    return(0)
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,127 @@
+####################################################################################################
+# The MIT License (MIT)
+#
+# Copyright (c) 2015, Alexander I. Mykyta
+# All rights reserved.
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+# 
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+####################################################################################################
+
+# Creating report templates in bulk from a folder of blank forms
+#
+# The blanks are parsed on a pool of processes. Blanks with identical fingerprints are the same
+# form, so only the first one (in path order) becomes a template.
+
+import os
+import fnmatch
+import logging
+import multiprocessing
+
+from . import report_template
+from . import report_entries
+
+log = logging.getLogger("bulk_templates")
+
+#===================================================================================================
+def find_blanks(start_dir):
+    """ Recursively finds all PDFs in a directory, in a stable order """
+    matches = []
+    for root, dirnames, filenames in os.walk(start_dir):
+        dirnames.sort()
+        for filename in sorted(fnmatch.filter(filenames, '*.pdf')):
+            matches.append(os.path.join(root, filename))
+    return(matches)
+
+def read_blank(filename):
+    """ Returns (filename, ReportTemplate, None), or (filename, None, reason) if the file could
+    not be read. Runs in a worker process """
+    try:
+        T = report_template.ReportTemplate.from_pdf(filename)
+    except Exception as E:
+        # Any failure only rejects this file. It must not stop the whole pool
+        return((filename, None, str(E) or E.__class__.__name__))
+    return((filename, T, None))
+
+def iter_blanks(filenames, n_workers = None):
+    """ Reads blank forms on a pool of processes.
+    Yields the results of read_blank(), in the same order as filenames """
+    if(n_workers == None):
+        n_workers = multiprocessing.cpu_count()
+    
+    with multiprocessing.Pool(n_workers) as pool:
+        for result in pool.imap(read_blank, filenames, chunksize=4):
+            yield(result)
+
+def add_field_columns(T):
+    """ Sets up one report column per field, named after the field """
+    T.entries = []
+    for field_name in T.avail_fields:
+        e = report_entries.PDF_Field(T, field_name)
+        e.field_name = field_name
+        T.entries.append(e)
+
+def unique_name(name, names):
+    """ Returns name, or name with a number appended if it is already in names """
+    newname = name
+    n = 1
+    while(newname in names):
+        n = n + 1
+        newname = "%s (%d)" % (name, n)
+    return(newname)
+
+#===================================================================================================
+class TemplateCollector:
+    """ Turns blank forms into templates, skipping forms that already have one """
+    
+    def __init__(self, existing = []):
+        # Fingerprint --> template that already covers it
+        self.known = {}
+        for T in existing:
+            self.known.setdefault(tuple(T.form_fingerprint), T)
+        self.names = set(T.name for T in existing)
+        
+        self.templates = [] # Newly created templates
+        self.n_duplicate = 0
+        self.rejected = [] # (filename, reason) of files that are not usable blank forms
+    
+    def add(self, filename, T, reason = None):
+        """ Adds the result of read_blank(). Returns the new template, or None """
+        if(T == None):
+            log.warning("Skipping %s: %s" % (filename, reason))
+            self.rejected.append((filename, reason))
+            return(None)
+        if(len(T.avail_fields) == 0):
+            self.rejected.append((filename, "no form fields"))
+            return(None)
+        
+        key = tuple(T.form_fingerprint)
+        if(key in self.known):
+            self.n_duplicate = self.n_duplicate + 1
+            return(None)
+        self.known[key] = T
+        
+        name = os.path.splitext(os.path.basename(filename))[0]
+        T.name = unique_name(name, self.names)
+        self.names.add(T.name)
+        T.description = "Created from %s" % filename
+        
+        add_field_columns(T)
+        
+        self.templates.append(T)
+        return(T)
@@ -0,0 +1,258 @@
+####################################################################################################
+# The MIT License (MIT)
+#
+# Copyright (c) 2015, Alexander I. Mykyta
+# All rights reserved.
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+# 
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+####################################################################################################
+
+# Census of the form types in a folder
+#
+# Every file is parsed for its fingerprint and field names only. No field values are decoded.
+# Files with the same fingerprint are the same form, and are grouped into a Cluster. Clusters
+# that an existing template already matches are flagged, and the others can be turned into
+# draft templates.
+#
+#   python -m modules.census <folder> [--template t.json ...] [--json census.json]
+
+import os
+import sys
+import json
+import logging
+import argparse
+
+from . import form_data
+from . import report_template
+from . import prefilter
+from . import archives
+from . import bulk_templates
+from . import batch
+from . import form_scan
+
+log = logging.getLogger("census")
+
+MAX_SAMPLES = 5
+
+# Result status of a file
+ST_FORM = "form"
+ST_NOT_FORM = "not a form"
+ST_UNREADABLE = "unreadable"
+
+#===================================================================================================
+# Reading
+#===================================================================================================
+_screen = None
+
+def read_fingerprint(filename, data, timestamp):
+    """ Returns (filename, status, fingerprint, field names) of a file's contents.
+    Runs in a worker process """
+    global _screen
+    if(_screen == None):
+        _screen = prefilter.Prefilter()
+    
+    if(_screen.check(filename, data, timestamp) != None):
+        return((filename, ST_NOT_FORM, None, None))
+    
+    try:
+        # An empty filter skips decoding every value
+        F = form_data.FormData(filename, frozenset(), None, data, timestamp)
+    except Exception as E:
+        log.warning("Failed to read '%s': %s" % (filename, E))
+        return((filename, ST_UNREADABLE, None, None))
+    
+    if((not F.valid) or (len(F.get_fingerprint()) == 0)):
+        return((filename, ST_NOT_FORM, None, None))
+    return((filename, ST_FORM, tuple(F.get_fingerprint()), tuple(sorted(set(F.get_field_names())))))
+
+def iter_fingerprints(filenames, n_workers = None):
+    """ Reads the fingerprints of files on a pool of processes.
+    Yields the results of read_fingerprint(), in the same order as filenames """
+    def prejudge(pf):
+        if(pf.error != None):
+            return((pf.filename, ST_UNREADABLE, None, None))
+        return(None)
+    
+    yield from form_scan.iter_parallel(
+        read_fingerprint, archives.iter_files(filenames), n_workers, prejudge = prejudge
+    )
+
+#===================================================================================================
+# Clustering
+#===================================================================================================
+class Cluster:
+    """ Files that share one fingerprint """
+    def __init__(self, fingerprint, field_names):
+        self.fingerprint = fingerprint
+        self.field_names = field_names
+        self.count = 0
+        self.samples = []   # First few filenames
+        self.templates = [] # Existing templates that match these forms
+    
+    def add(self, filename):
+        self.count = self.count + 1
+        if(len(self.samples) < MAX_SAMPLES):
+            self.samples.append(filename)
+    
+    def get_name(self):
+        """ Suggested name for a template of this form """
+        return(os.path.splitext(os.path.basename(self.samples[0]))[0])
+    
+    def to_dict(self):
+        return({
+            'count': self.count,
+            'pages': len(self.fingerprint),
+            'fingerprint': list(self.fingerprint),
+            'fields': list(self.field_names),
+            'samples': list(self.samples),
+            'templates': [T.name for T in self.templates]
+        })
+
+class Census:
+    """ Groups the results of read_fingerprint() by fingerprint """
+    def __init__(self, templates = []):
+        self.templates = list(templates)
+        self.clusters = {} # fingerprint --> Cluster
+        self.n_files = 0
+        self.n_not_form = 0
+        self.unreadable = []
+    
+    def add(self, result):
+        filename, status, fingerprint, field_names = result
+        self.n_files = self.n_files + 1
+        if(status == ST_UNREADABLE):
+            self.unreadable.append(filename)
+            return(None)
+        if(status == ST_NOT_FORM):
+            self.n_not_form = self.n_not_form + 1
+            return(None)
+        
+        C = self.clusters.get(fingerprint)
+        if(C == None):
+            C = Cluster(fingerprint, field_names)
+            C.templates = self.find_templates(fingerprint)
+            self.clusters[fingerprint] = C
+        C.add(filename)
+        return(C)
+    
+    def find_templates(self, fingerprint):
+        """ Returns the templates that would accept forms with this fingerprint """
+        return([T for T in self.templates if form_data.fingerprint_contains(fingerprint, T.form_fingerprint)])
+    
+    def add_template(self, T):
+        """ Registers a new template, and flags the clusters it matches """
+        self.templates.append(T)
+        for C in self.clusters.values():
+            if(form_data.fingerprint_contains(C.fingerprint, T.form_fingerprint)):
+                C.templates.append(T)
+    
+    def get_clusters(self):
+        """ Returns the clusters, most common first """
+        return(sorted(self.clusters.values(), key=lambda C: (-C.count, C.samples[0])))
+    
+    #--------------------------------------------------------------------------
+    def to_dict(self):
+        return({
+            'files': self.n_files,
+            'not_forms': self.n_not_form,
+            'unreadable': list(self.unreadable),
+            'clusters': [C.to_dict() for C in self.get_clusters()]
+        })
+    
+    def get_report(self):
+        lines = []
+        lines.append("%d files: %d form types, %d not forms, %d unreadable" % (
+            self.n_files, len(self.clusters), self.n_not_form, len(self.unreadable)
+        ))
+        for i, C in enumerate(self.get_clusters()):
+            if(len(C.templates)):
+                matched = "matches " + ", ".join([T.name for T in C.templates])
+            else:
+                matched = "no template"
+            lines.append("#%d: %d files, %d pages, %d fields, %s" % (
+                i + 1, C.count, len(C.fingerprint), len(C.field_names), matched
+            ))
+            for f in C.samples:
+                lines.append("    %s" % f)
+        return("\n".join(lines))
+
+#===================================================================================================
+def make_draft(C, names = ()):
+    """ Creates a draft template from a cluster's first sample, with one column per field.
+    names are the names already taken """
+    pf = next(archives.iter_files([C.samples[0]]))
+    if(pf.error != None):
+        raise ValueError("Could not read '%s': %s" % (pf.filename, pf.error))
+    T = report_template.ReportTemplate.from_pdf(pf.filename, pf.data, pf.timestamp)
+    T.name = bulk_templates.unique_name(C.get_name(), set(names))
+    T.description = "Draft from a census: %d forms like %s" % (C.count, C.samples[0])
+    bulk_templates.add_field_columns(T)
+    return(T)
+
+def run(start_dir, templates = [], n_workers = None):
+    """ Takes a census of all PDFs under start_dir. Returns the Census """
+    S = Census(templates)
+    for result in iter_fingerprints(batch.find_pdfs(start_dir), n_workers):
+        S.add(result)
+    return(S)
+
+#===================================================================================================
+def main(argv = None):
+    parser = argparse.ArgumentParser(
+        prog = "python -m modules.census",
+        description = "Count the distinct form types in a folder of PDFs"
+    )
+    parser.add_argument("dir", help = "Folder to search for PDFs")
+    parser.add_argument("--template", action = "append", default = [],
+                        help = "Existing template .json file to flag matching forms with. Can be given more than once")
+    parser.add_argument("-j", "--jobs", type = int, default = None, help = "Worker processes")
+    parser.add_argument("--json", help = "Also write the census to this .json file")
+    parser.add_argument("--draft", type = int, action = "append", default = [],
+                        help = "Write a draft template for form type #N of the report. Can be given more than once")
+    parser.add_argument("--draft-dir", default = "templates", help = "Where to write drafts")
+    
+    args = parser.parse_args(argv)
+    logging.basicConfig(level = logging.INFO)
+    logging.getLogger("pdfminer").setLevel(logging.WARNING)
+    
+    templates = [batch.load_template(path) for path in args.template]
+    S = run(os.path.abspath(args.dir), templates, args.jobs)
+    print(S.get_report())
+    
+    if(args.json):
+        with open(args.json, 'w', encoding="utf-8") as f:
+            json.dump(S.to_dict(), f, indent=2)
+    
+    clusters = S.get_clusters()
+    names = set([T.name for T in templates])
+    for n in args.draft:
+        if((n < 1) or (n > len(clusters))):
+            log.error("There is no form type #%d" % n)
+            return(1)
+        T = make_draft(clusters[n-1], names)
+        names.add(T.name)
+        os.makedirs(args.draft_dir, exist_ok=True)
+        path = os.path.join(args.draft_dir, "%s.json" % T.name)
+        with open(path, 'w') as f:
+            json.dump(T.to_dict(), f, indent=2, sort_keys = True)
+        log.info("Wrote draft template %s" % path)
+    return(0)
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,251 @@
+####################################################################################################
+# The MIT License (MIT)
+#
+# Copyright (c) 2015, Alexander I. Mykyta
+# All rights reserved.
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+# 
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+####################################################################################################
+
+# Per-column summary statistics, collected one row at a time
+#
+# Memory does not grow with the number of rows:
+#   - Distinct values are counted exactly up to EXACT_DISTINCT_LIMIT, then estimated with a
+#     HyperLogLog sketch (~1.6% standard error)
+#   - Top values are tracked with a bounded counter table. Counts are exact as long as fewer
+#     than TOP_CAPACITY distinct values were seen, and approximate lower bounds after that
+#
+# Values that can not be hashed, like the lists and dicts that clean_value() can make out of a
+# field's text, are counted by their text.
+
+import os
+import json
+import math
+import logging
+
+log = logging.getLogger("column_stats")
+
+EXACT_DISTINCT_LIMIT = 1024
+HLL_BITS = 12 # 4096 registers
+TOP_CAPACITY = 64
+TOP_REPORTED = 10
+
+_MASK64 = (1 << 64) - 1
+
+#===================================================================================================
+def hash64(v):
+    """ Well-mixed 64-bit hash of a value. Python's own hash of an int is the int itself """
+    h = hash(v) & _MASK64
+    h = h ^ (h >> 33)
+    h = (h * 0xFF51AFD7ED558CCD) & _MASK64
+    h = h ^ (h >> 33)
+    h = (h * 0xC4CEB9FE1A85EC53) & _MASK64
+    h = h ^ (h >> 33)
+    return(h)
+
+class HyperLogLog:
+    """ Estimates the number of distinct values added """
+    def __init__(self, bits = HLL_BITS):
+        self.bits = bits
+        self.m = 1 << bits
+        self.registers = bytearray(self.m)
+    
+    def add_hash(self, h):
+        idx = h >> (64 - self.bits)
+        rest = (h << self.bits) & _MASK64
+        # Position of the first 1 bit in the remaining bits
+        rank = (64 - self.bits + 1) if (rest == 0) else (65 - rest.bit_length())
+        if(rank > self.registers[idx]):
+            self.registers[idx] = rank
+    
+    def estimate(self):
+        m = self.m
+        alpha = 0.7213 / (1 + 1.079 / m)
+        z = 0.0
+        for r in self.registers:
+            z = z + 2.0 ** -r
+        e = alpha * m * m / z
+        zeros = self.registers.count(0)
+        if((e <= 2.5 * m) and zeros):
+            # Small range correction
+            e = m * math.log(m / zeros)
+        return(int(round(e)))
+
+#===================================================================================================
+class ColumnStats:
+    """ Statistics of one column """
+    def __init__(self, name):
+        self.name = name
+        self.rows = 0
+        self.filled = 0
+        
+        self.n_numeric = 0
+        self.min = None
+        self.max = None
+        self.sum = 0.0
+        
+        self.distinct = set() # Until it gets too big. Then None, and hll is used
+        self.hll = None
+        
+        self.top = {} # value --> count
+    
+    def add(self, v):
+        self.rows = self.rows + 1
+        if((v == None) or (v == "")):
+            return
+        self.filled = self.filled + 1
+        
+        if(not isinstance(v, (str, int, float))):
+            try:
+                hash(v)
+            except TypeError:
+                v = str(v)
+        
+        if(isinstance(v, (int, float)) and not isinstance(v, bool)):
+            if(self.n_numeric == 0):
+                self.min = v
+                self.max = v
+            elif(v < self.min):
+                self.min = v
+            elif(v > self.max):
+                self.max = v
+            self.n_numeric = self.n_numeric + 1
+            self.sum = self.sum + v
+        
+        # Distinct
+        if(self.distinct != None):
+            self.distinct.add(v)
+            if(len(self.distinct) > EXACT_DISTINCT_LIMIT):
+                self.hll = HyperLogLog()
+                for x in self.distinct:
+                    self.hll.add_hash(hash64(x))
+                self.distinct = None
+        else:
+            self.hll.add_hash(hash64(v))
+        
+        # Top values
+        top = self.top
+        if(v in top):
+            top[v] = top[v] + 1
+        else:
+            top[v] = 1
+            if(len(top) > 2 * TOP_CAPACITY):
+                self.prune_top()
+    
+    def prune_top(self):
+        """ Keeps the TOP_CAPACITY most frequent values """
+        keep = sorted(self.top.items(), key=lambda kv: kv[1], reverse=True)[:TOP_CAPACITY]
+        self.top = dict(keep)
+    
+    #--------------------------------------------------------------------------
+    def get_distinct(self):
+        """ Returns (count, exact) """
+        if(self.distinct != None):
+            return((len(self.distinct), True))
+        return((self.hll.estimate(), False))
+    
+    def get_top(self, n = TOP_REPORTED):
+        items = sorted(self.top.items(), key=lambda kv: (-kv[1], str(kv[0])))
+        return(items[:n])
+    
+    def to_dict(self):
+        distinct, exact = self.get_distinct()
+        d = {
+            'name': self.name,
+            'rows': self.rows,
+            'filled': self.filled,
+            'fill_rate': (self.filled / self.rows) if self.rows else None,
+            'distinct': distinct,
+            'distinct_exact': exact,
+            'top': [[v, c] for v, c in self.get_top()]
+        }
+        if(self.n_numeric):
+            d['numeric'] = {
+                'count': self.n_numeric,
+                'min': self.min,
+                'max': self.max,
+                'mean': self.sum / self.n_numeric
+            }
+        return(d)
+
+#===================================================================================================
+class TableStats:
+    """ Statistics of every column of a report """
+    
+    SHEET_HEADINGS = [
+        "Column", "Rows", "Filled", "Fill Rate", "Distinct",
+        "Numeric", "Min", "Max", "Mean", "Top Values"
+    ]
+    
+    def __init__(self, headings, deferred = ()):
+        self.columns = [ColumnStats(h) for h in headings]
+        
+        # Columns that are filled in later with add_column(). add_row() skips them
+        self.row_columns = [(i, c) for i, c in enumerate(self.columns) if i not in deferred]
+    
+    def add_row(self, row):
+        for i, c in self.row_columns:
+            c.add(row[i])
+    
+    def add_column(self, idx, values):
+        """ Adds values to one column only, for columns that are filled in all at once """
+        c = self.columns[idx]
+        for v in values:
+            c.add(v)
+    
+    #--------------------------------------------------------------------------
+    def to_dict(self):
+        return({'columns': [c.to_dict() for c in self.columns]})
+    
+    def write_json(self, path):
+        with open(path, 'w', encoding="utf-8") as f:
+            json.dump(self.to_dict(), f, indent=2, default=str)
+    
+    def get_rows(self):
+        """ Returns the statistics as a table for a summary sheet, headings first """
+        rows = [list(self.SHEET_HEADINGS)]
+        for c in self.columns:
+            d = c.to_dict()
+            distinct = d['distinct'] if d['distinct_exact'] else "~%d" % d['distinct']
+            fill_rate = ("%.1f%%" % (100 * d['fill_rate'])) if (d['fill_rate'] != None) else ""
+            top = "; ".join(["%s (%d)" % (v, n) for v, n in d['top']])
+            num = d.get('numeric')
+            if(num):
+                rows.append([d['name'], d['rows'], d['filled'], fill_rate, distinct,
+                             num['count'], num['min'], num['max'], num['mean'], top])
+            else:
+                rows.append([d['name'], d['rows'], d['filled'], fill_rate, distinct,
+                             0, "", "", "", top])
+        return(rows)
+
+#===================================================================================================
+def sidecar_path(filename):
+    """ Path of the JSON statistics written next to an output file """
+    return(os.path.splitext(filename)[0] + ".stats.json")
+
+def summary_sheet_name(name, used = ()):
+    """ Sheet name for the statistics of the sheet called name """
+    base = name[:31 - len(" Summary")] + " Summary"
+    newname = base
+    n = 2
+    while(newname.casefold() in used):
+        suffix = " (%d)" % n
+        newname = base[:31 - len(suffix)] + suffix
+        n = n + 1
+    return(newname)
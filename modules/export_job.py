@@ -0,0 +1,176 @@
+####################################################################################################
+# The MIT License (MIT)
+#
+# Copyright (c) 2015, Alexander I. Mykyta
+# All rights reserved.
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+# 
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+####################################################################################################
+
+# Exporting a report on a background thread
+#
+# The output is written to a temporary file next to the destination and renamed into place when
+# it is complete. A cancelled or failed export leaves the destination untouched.
+
+import os
+import time
+import threading
+import logging
+
+from . import report_template
+from . import rollover
+
+log = logging.getLogger("export_job")
+
+# Job states
+ST_RUNNING = "running"
+ST_WRITING = "writing"
+ST_DONE = "done"
+ST_CANCELLED = "cancelled"
+ST_FAILED = "failed"
+
+#===================================================================================================
+def temp_path(filename):
+    """ Temporary file name next to filename. Keeps the extension, since it selects the format """
+    root, ext = os.path.splitext(filename)
+    return("%s.%d.tmp%s" % (root, os.getpid(), ext))
+
+def format_duration(seconds):
+    seconds = int(seconds)
+    if(seconds >= 3600):
+        return("%d:%02d:%02d" % (seconds // 3600, (seconds // 60) % 60, seconds % 60))
+    return("%d:%02d" % (seconds // 60, seconds % 60))
+
+#===================================================================================================
+class ExportJob:
+    """ Builds and writes a report from a snapshot of the loaded forms.
+    
+    get_row(plan, form) returns the report row of a form. Forms that disappear while the job
+    runs (get_row raises KeyError) are skipped.
+    
+    If stats is set, per-column statistics are added as a summary sheet and written to a
+    .stats.json file next to the output.
+    """
+    
+    def __init__(self, plan, forms, filename, get_row, stats = False):
+        self.plan = plan
+        self.forms = list(forms)
+        self.filename = filename
+        self.get_row = get_row
+        self.stats = stats
+        
+        self.state = ST_RUNNING
+        self.error = None
+        self.n_done = 0
+        self.n_total = len(self.forms)
+        self.n_rows = 0
+        self.start_time = None
+        self.end_time = None
+        
+        self.cancel_event = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+    
+    def start(self):
+        self.start_time = time.time()
+        self.thread.start()
+    
+    def cancel(self):
+        self.cancel_event.set()
+    
+    def is_running(self):
+        return(self.thread.is_alive())
+    
+    def join(self, timeout = None):
+        self.thread.join(timeout)
+    
+    #--------------------------------------------------------------------------
+    def run(self):
+        tmp_filename = temp_path(self.filename)
+        writer = None
+        try:
+            TBL = report_template.DataTable()
+            TBL.init_plan(self.plan, self.stats)
+            
+            # Rows are written out in batches as they are built. Reports too big for one sheet
+            # roll over onto more sheets
+            writer = rollover.RolloverWriter(tmp_filename, TBL.headings, TBL.name)
+            TBL.stream_to(writer)
+            
+            for F in self.forms:
+                if(self.cancel_event.is_set()):
+                    self.state = ST_CANCELLED
+                    return
+                try:
+                    row = self.get_row(self.plan, F)
+                except KeyError:
+                    row = None
+                if(row != None):
+                    TBL.append_row_tuple(row)
+                    self.n_rows = self.n_rows + 1
+                self.n_done = self.n_done + 1
+            
+            # Writing can not be interrupted. A cancel during it discards the result
+            self.state = ST_WRITING
+            TBL.finish()
+            writer = None
+            if(self.cancel_event.is_set()):
+                self.state = ST_CANCELLED
+                return
+            os.replace(tmp_filename, self.filename)
+            TBL.export_stats_json(self.filename)
+            self.state = ST_DONE
+            log.info("Exported %d rows to %s" % (self.n_rows, self.filename))
+        except Exception as E:
+            log.error("Export to '%s' failed: %s" % (self.filename, E))
+            self.error = E
+            self.state = ST_FAILED
+        finally:
+            if(writer != None):
+                writer.abort()
+            self.forms = []
+            self.end_time = time.time()
+            if(self.state != ST_DONE):
+                try:
+                    os.remove(tmp_filename)
+                except OSError:
+                    pass
+    
+    #--------------------------------------------------------------------------
+    def get_status_text(self):
+        """ One line describing the job's progress """
+        if(self.state == ST_RUNNING):
+            elapsed = max(time.time() - self.start_time, 1e-3)
+            rate = self.n_done / elapsed
+            text = "Exporting: %d/%d forms (%d forms/s" % (self.n_done, self.n_total, rate)
+            if(rate > 0):
+                text = text + ", %s left)" % format_duration((self.n_total - self.n_done) / rate)
+            else:
+                text = text + ")"
+            return(text)
+        elif(self.state == ST_WRITING):
+            return("Exporting: writing %d rows to %s..." % (self.n_rows, os.path.basename(self.filename)))
+        elif(self.state == ST_DONE):
+            return("Exported %d rows to %s in %s" % (
+                self.n_rows, os.path.basename(self.filename),
+                format_duration(self.end_time - self.start_time)
+            ))
+        elif(self.state == ST_CANCELLED):
+            return("Export cancelled")
+        else:
+            return("Export failed: %s" % self.error)
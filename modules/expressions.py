@@ -0,0 +1,318 @@
+####################################################################################################
+# The MIT License (MIT)
+#
+# Copyright (c) 2015, Alexander I. Mykyta
+# All rights reserved.
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+# 
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+####################################################################################################
+
+# Expressions over report columns, for computed report entries
+#
+# Columns are referenced by name in braces:
+#   {lang_en} + {lang_fr} + {lang_de}
+#   {Height (in)} * 2.54
+#   {First Name} + " " + {Last Name}
+#   where({Age} >= 18, "adult", "minor")
+#
+# Allowed: numbers, strings, + - * / // % **, comparisons, & | ~, and the functions in
+# FUNCTIONS. An expression is evaluated over whole columns at once. If numpy is installed,
+# numeric columns become float arrays and text columns object arrays, so the arithmetic runs
+# in numpy. Otherwise, or if the vectorised evaluation fails, it is evaluated row by row and
+# rows that fail give None.
+#
+# Evaluating row by row defines the result. The vectorised evaluation must give the same values:
+#   - Rows with a blank input are evaluated row by row, since a blank is an error there and not NaN
+#   - Any floating point error (division by zero, overflow) falls back to evaluating row by row
+#   - Whole numbers in float results become integers, as clean_result() does per row
+#   - text() and ~ depend on whether a number was an integer or a bool, which float arrays do
+#     not keep. Arithmetic on bools is a logical and/or in numpy, but counts in Python. So
+#     expressions that use text() or ~, or do arithmetic on a comparison, are only evaluated
+#     row by row (see is_vectorisable())
+#   - round() to a number of digits and min() or max() of more than two values fall back to
+#     evaluating row by row
+
+import re
+import ast
+import math
+import collections
+import logging
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+log = logging.getLogger("expressions")
+
+_COLUMN_REF = re.compile(r'\{([^{}]+)\}')
+
+# Integers beyond this can not be held exactly in a float array
+MAX_EXACT_INT = 2**53
+
+_ALLOWED_NODES = (
+    ast.Expression, ast.BinOp, ast.UnaryOp, ast.Compare, ast.Call, ast.Name, ast.Load,
+    ast.Constant,
+    ast.Add, ast.Sub, ast.Mult, ast.Div, ast.FloorDiv, ast.Mod, ast.Pow,
+    ast.BitAnd, ast.BitOr, ast.Invert, ast.USub, ast.UAdd,
+    ast.Eq, ast.NotEq, ast.Lt, ast.LtE, ast.Gt, ast.GtE
+)
+
+#===================================================================================================
+# Functions, per row and vectorised
+#===================================================================================================
+def _where(cond, a, b):
+    return(a if cond else b)
+
+def _num(v):
+    """ Converts a value to a number. Blanks become 0 """
+    if(v == None or v == ""):
+        return(0)
+    return(float(v))
+
+FUNCTIONS = {
+    'abs': abs,
+    'round': round,
+    'min': min,
+    'max': max,
+    'where': _where,
+    'num': _num,
+    'text': str
+}
+
+if(numpy):
+    def _np_num(a):
+        if(a.dtype == object):
+            return(numpy.array([_num(v) for v in a], dtype=float))
+        return(numpy.nan_to_num(a))
+    
+    def _np_args(func, n_args):
+        # numpy rounds to digits by scaling, which can differ from round() in the last digit.
+        # A third argument to numpy.minimum() is where to put the result
+        def f(*args):
+            if(len(args) != n_args):
+                raise ValueError("Evaluated per row with %d arguments" % len(args))
+            return(func(*args))
+        return(f)
+    
+    def _np_where(cond, a, b):
+        # numpy would turn numbers into strings if one side is text, and bools into numbers if
+        # only one side is a bool. Python objects are kept instead
+        a = numpy.asarray(a)
+        b = numpy.asarray(b)
+        if(((a.dtype.kind not in "iuf") or (b.dtype.kind not in "iuf")) and (a.dtype.kind != b.dtype.kind)):
+            a = a.astype(object)
+            b = b.astype(object)
+        return(numpy.where(cond, a, b))
+    
+    NP_FUNCTIONS = {
+        'abs': numpy.abs,
+        'round': _np_args(numpy.round, 1),
+        'min': _np_args(numpy.minimum, 2),
+        'max': _np_args(numpy.maximum, 2),
+        'where': _np_where,
+        'num': _np_num
+    }
+
+def is_vectorisable(node, bool_ok = True):
+    """ Checks that a numpy evaluation of the expression tree gives the same as Python.
+    Comparisons, & and | give bools. bool_ok is False where a bool would be used as a number """
+    if(isinstance(node, ast.Expression)):
+        return(is_vectorisable(node.body, True))
+    if(isinstance(node, ast.Compare)):
+        return(bool_ok and all([is_vectorisable(n, False) for n in [node.left] + node.comparators]))
+    if(isinstance(node, ast.BinOp)):
+        if(isinstance(node.op, (ast.BitAnd, ast.BitOr))):
+            return(bool_ok and is_vectorisable(node.left, True) and is_vectorisable(node.right, True))
+        return(is_vectorisable(node.left, False) and is_vectorisable(node.right, False))
+    if(isinstance(node, ast.UnaryOp)):
+        return((not isinstance(node.op, ast.Invert)) and is_vectorisable(node.operand, False))
+    if(isinstance(node, ast.Call)):
+        if(node.func.id == 'text'):
+            return(False)
+        if(node.func.id == 'where'):
+            return((len(node.args) == 3) and is_vectorisable(node.args[0], True)
+                   and all([is_vectorisable(n, bool_ok) for n in node.args[1:]]))
+        return(all([is_vectorisable(n, False) for n in node.args]))
+    if(isinstance(node, ast.Constant)):
+        return(bool_ok or not isinstance(node.value, bool))
+    return(True)
+
+#===================================================================================================
+class Expression:
+    """ A parsed and validated column expression. Raises ValueError if text is not valid """
+    
+    def __init__(self, text):
+        self.text = text
+        
+        # Column references become plain variable names
+        self.columns = []
+        def repl(m):
+            name = m.group(1).strip()
+            if(name not in self.columns):
+                self.columns.append(name)
+            return(" _c%d " % self.columns.index(name))
+        source = _COLUMN_REF.sub(repl, text)
+        
+        try:
+            tree = ast.parse(source.strip(), mode='eval')
+        except SyntaxError as E:
+            raise ValueError("Invalid expression: %s" % E.msg)
+        
+        for node in ast.walk(tree):
+            if(not isinstance(node, _ALLOWED_NODES)):
+                raise ValueError("Not allowed in an expression: %s" % type(node).__name__)
+            if(isinstance(node, ast.Name)):
+                if(not re.fullmatch(r'_c\d+', node.id) and (node.id not in FUNCTIONS)):
+                    raise ValueError("Unknown name '%s'. Columns must be written as {name}" % node.id)
+            if(isinstance(node, ast.Call)):
+                if((not isinstance(node.func, ast.Name)) or (node.func.id not in FUNCTIONS) or node.keywords):
+                    raise ValueError("Only these functions can be called: %s" % ", ".join(sorted(FUNCTIONS)))
+        
+        self.code = compile(tree, "<expression>", 'eval')
+        
+        self.vectorise = is_vectorisable(tree)
+    
+    # Code objects can not be pickled. Parse again after unpickling instead
+    def __getstate__(self):
+        return({'text': self.text})
+    
+    def __setstate__(self, state):
+        self.__init__(state['text'])
+    
+    #--------------------------------------------------------------------------
+    def evaluate(self, columns, n_rows, cache = None):
+        """ Evaluates the expression. columns are the value lists of self.columns, in order.
+        Returns a list of n_rows values.
+        cache is an optional dict to share converted columns between several expressions """
+        if(numpy and self.vectorise):
+            try:
+                return(self.evaluate_numpy(columns, n_rows, cache))
+            except Exception as E:
+                log.debug("Vectorised evaluation of '%s' failed (%s). Evaluating per row" % (self.text, E))
+        return(self.evaluate_rows(columns, n_rows))
+    
+    def evaluate_rows(self, columns, n_rows):
+        env = dict(FUNCTIONS)
+        env['__builtins__'] = {}
+        names = ["_c%d" % i for i in range(len(columns))]
+        
+        result = []
+        for y in range(n_rows):
+            for name, col in zip(names, columns):
+                env[name] = col[y]
+            try:
+                result.append(clean_result(eval(self.code, env)))
+            except Exception:
+                result.append(None)
+        return(result)
+    
+    def evaluate_numpy(self, columns, n_rows, cache = None):
+        """ Same result as evaluate_rows(). Raises an exception if it can not be vectorised """
+        if(cache == None):
+            cache = {}
+        env = dict(NP_FUNCTIONS)
+        env['__builtins__'] = {}
+        blank = numpy.zeros(n_rows, dtype=bool)
+        for i, col in enumerate(columns):
+            # The column is kept in the cache too, so that its id() can not be reused
+            entry = cache.get(id(col))
+            if(entry == None):
+                a = to_array(col)
+                entry = cache[id(col)] = (col, a, blank_mask(a))
+            env["_c%d" % i] = entry[1]
+            blank = blank | entry[2]
+        
+        with numpy.errstate(all='raise'):
+            result = eval(self.code, env)
+        
+        if(isinstance(result, numpy.ndarray) and (result.shape == (n_rows,))):
+            values = array_to_list(result)
+        else:
+            # Did not depend on any column
+            values = [clean_result(result)] * n_rows
+        
+        rows = numpy.flatnonzero(blank).tolist()
+        if(len(rows)):
+            fixed = self.evaluate_rows([[col[y] for y in rows] for col in columns], len(rows))
+            for y, v in zip(rows, fixed):
+                values[y] = v
+        return(values)
+
+#===================================================================================================
+def to_array(col):
+    """ Numeric columns (blanks allowed) become float arrays, with NaN for blanks.
+    Anything else becomes an object array. So do columns of values that a float array would
+    change: bools, and integers too big to be exact """
+    types = collections.Counter(map(type, col))
+    n_blank = types.pop(type(None), 0)
+    if(str in types):
+        n_blank = n_blank + col.count("")
+        if(types[str] != col.count("")):
+            return(numpy.array(col, dtype=object))
+        del types[str]
+    if(len(set(types) - set([int, float]))):
+        return(numpy.array(col, dtype=object))
+    
+    a = numpy.array(col, dtype=object)
+    if(n_blank):
+        a[(a == None) | (a == "")] = math.nan
+    a = a.astype(float)
+    if(numpy.any(numpy.abs(a) >= MAX_EXACT_INT)):
+        return(numpy.array(col, dtype=object))
+    return(a)
+
+def blank_mask(a):
+    """ Rows of a to_array() result that were blank """
+    if(a.dtype.kind == 'f'):
+        return(numpy.isnan(a))
+    return(numpy.array([(v == None) or (isinstance(v, str) and (v == "")) for v in a], dtype=bool))
+
+def array_to_list(a):
+    """ Same as clean_result() on every element, done on the whole array """
+    if(a.dtype.kind == 'f'):
+        finite = numpy.isfinite(a)
+        whole = finite & (a == numpy.floor(a))
+        if(numpy.any(whole & (numpy.abs(a) >= MAX_EXACT_INT))):
+            raise ValueError("Integer result too big for a float array")
+        if(whole.all()):
+            return(a.astype(numpy.int64).tolist())
+        values = a.tolist()
+        for i in numpy.flatnonzero(whole).tolist():
+            values[i] = int(values[i])
+        for i in numpy.flatnonzero(~finite).tolist():
+            values[i] = None
+        return(values)
+    elif(a.dtype.kind == 'O'):
+        values = a.tolist()
+        if(float in set(map(type, values))):
+            return([clean_result(v) for v in values])
+        return(values)
+    return(a.tolist())
+
+def clean_result(v):
+    """ NaN becomes a blank cell, and whole floats become integers """
+    if(numpy and isinstance(v, numpy.generic)):
+        v = v.item()
+    if(isinstance(v, float)):
+        if(math.isnan(v) or math.isinf(v)):
+            return(None)
+        if(v.is_integer()):
+            return(int(v))
+    return(v)
@@ -0,0 +1,228 @@
+####################################################################################################
+# The MIT License (MIT)
+#
+# Copyright (c) 2015, Alexander I. Mykyta
+# All rights reserved.
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+# 
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+####################################################################################################
+
+# Extracting several reports from one pass over a set of forms
+#
+# Each PDF is parsed once, with the union of the fields that all of the templates read. The
+# parsed form is then routed to every template whose fingerprint it matches.
+
+import os
+import re
+import json
+import sys
+import time
+import datetime
+import logging
+import argparse
+
+from . import form_data
+from . import report_template
+from . import pdf_parser
+from . import prefilter
+from . import archives
+from . import batch
+from . import column_stats
+from . import metrics
+
+log = logging.getLogger("fanout")
+
+MAX_SHEET_NAME = 31
+
+#===================================================================================================
+def sheet_name(name, used):
+    """ Returns a valid and unique Excel sheet name based on name """
+    name = re.sub(r'[\[\]:*?/\\]', "_", name).strip("'") or "Sheet"
+    name = name[:MAX_SHEET_NAME]
+    newname = name
+    n = 1
+    while(newname.casefold() in used):
+        n = n + 1
+        suffix = " (%d)" % n
+        newname = name[:MAX_SHEET_NAME - len(suffix)] + suffix
+    used.add(newname.casefold())
+    return(newname)
+
+#===================================================================================================
+class FanoutSession:
+    """ Several templates bound to one pass over the forms """
+    
+    def __init__(self, templates, export_time = None, stats = False):
+        if(export_time == None):
+            export_time = datetime.datetime.now()
+        
+        self.templates = list(templates)
+        self.plans = [T.compile(export_time) for T in self.templates]
+        
+        # Every field that any of the reports reads
+        self.required_fields = frozenset().union(*[plan.required_fields for plan in self.plans])
+        
+        # Widget maps by the source document they apply to
+        self.widget_maps = {}
+        for plan in self.plans:
+            if(plan.widget_map != None):
+                self.widget_maps.setdefault(plan.widget_map.doc_id, plan.widget_map)
+        
+        self.screen = prefilter.Prefilter(min([len(plan.form_fingerprint) for plan in self.plans]))
+        
+        used = set()
+        self.tables = []
+        for T, plan in zip(self.templates, self.plans):
+            TBL = report_template.DataTable()
+            TBL.init_plan(plan, stats)
+            TBL.name = sheet_name(T.name, used)
+            self.tables.append(TBL)
+        
+        self.n_files = 0
+        self.n_invalid = 0
+        self.n_unmatched = 0
+    
+    def process(self, filename, prefetched = None):
+        """ Parses one form and adds a row to every report it matches.
+        Returns the indexes of the matching templates """
+        self.n_files = self.n_files + 1
+        
+        data = None
+        timestamp = None
+        if(prefetched != None):
+            if(prefetched.error != None):
+                log.warning("Failed to read '%s': %s" % (filename, prefetched.error))
+                self.n_invalid = self.n_invalid + 1
+                metrics.FILES_FAILED.inc()
+                return([])
+            data = prefetched.data
+            timestamp = prefetched.timestamp
+            
+            if(self.screen.check(filename, data, timestamp) != None):
+                self.n_unmatched = self.n_unmatched + 1
+                metrics.FILES_MISMATCHED.inc()
+                return([])
+        
+        widget_map = None
+        if((data != None) and len(self.widget_maps)):
+            widget_map = self.widget_maps.get(pdf_parser.get_doc_id(data))
+        
+        try:
+            F = form_data.FormData(filename, self.required_fields, widget_map, data, timestamp)
+        except Exception as E:
+            log.warning("Failed to read '%s': %s" % (filename, E))
+            self.n_invalid = self.n_invalid + 1
+            metrics.FILES_FAILED.inc()
+            return([])
+        
+        if(not F.valid):
+            self.n_invalid = self.n_invalid + 1
+            metrics.FILES_INVALID.inc()
+            return([])
+        metrics.FILES_PARSED.inc()
+        
+        matched = []
+        for i, plan in enumerate(self.plans):
+            if(plan.is_matching_form(F)):
+                self.tables[i].append_row_tuple(plan.make_row(F))
+                matched.append(i)
+        
+        if(len(matched) == 0):
+            self.n_unmatched = self.n_unmatched + 1
+            metrics.FILES_MISMATCHED.inc()
+        else:
+            metrics.FILES_MATCHED.inc()
+        return(matched)
+    
+    def process_files(self, filenames):
+        """ Generator that processes the files in order, reading ahead.
+        Yields (filename, matching template indexes) after each one """
+        filenames = list(filenames)
+        metrics.FILES_DISCOVERED.inc(len(filenames))
+        for pf in archives.iter_files(filenames):
+            t_start = time.perf_counter()
+            matched = self.process(pf.filename, pf)
+            t = time.perf_counter() - t_start
+            metrics.PARSE_SECONDS.observe(t)
+            metrics.BUSY_SECONDS.inc(t)
+            if(pf.data != None):
+                metrics.BYTES_READ.inc(len(pf.data))
+            yield((pf.filename, matched))
+    
+    #--------------------------------------------------------------------------
+    def export_excel(self, filename):
+        """ Writes all reports to one workbook, one sheet per template """
+        report_template.export_excel_book(self.tables, filename)
+        if(len(self.tables) and (self.tables[0].stats != None)):
+            # One statistics file for the whole workbook, by sheet
+            stats = {TBL.name: TBL.stats.to_dict() for TBL in self.tables}
+            with open(column_stats.sidecar_path(filename), 'w', encoding="utf-8") as f:
+                json.dump(stats, f, indent=2, default=str)
+    
+    def export_files(self, out_dir, ext = ".xlsx"):
+        """ Writes each report to its own file in out_dir. Returns the paths written """
+        os.makedirs(out_dir, exist_ok=True)
+        paths = []
+        for TBL in self.tables:
+            path = os.path.join(out_dir, TBL.name + ext)
+            TBL.export_excel(path)
+            TBL.export_stats_json(path)
+            paths.append(path)
+        return(paths)
+    
+    def get_summary(self):
+        lines = []
+        for T, TBL in zip(self.templates, self.tables):
+            lines.append("%s: %d rows" % (T.name, TBL.rowcount))
+        lines.append("%d files did not match any template" % self.n_unmatched)
+        lines.append("%d files could not be read" % self.n_invalid)
+        return("\n".join(lines))
+
+#===================================================================================================
+def main(argv = None):
+    parser = argparse.ArgumentParser(
+        prog = "python -m modules.fanout",
+        description = "Extract several reports from one pass over a folder of PDFs"
+    )
+    parser.add_argument("--template", required = True, action = "append",
+                        help = "Template .json file. Can be given more than once")
+    parser.add_argument("--dir", required = True, help = "Folder to search for PDFs")
+    parser.add_argument("--split", action = "store_true",
+                        help = "Write one file per template into output, which is a folder")
+    parser.add_argument("--stats", action = "store_true",
+                        help = "Add per-column statistics sheets, and write them to .stats.json files")
+    parser.add_argument("output", help = "Output .xlsx/.xls file, or folder with --split")
+    
+    args = parser.parse_args(argv)
+    logging.basicConfig(level = logging.INFO)
+    logging.getLogger("pdfminer").setLevel(logging.WARNING)
+    
+    S = FanoutSession([batch.load_template(path) for path in args.template], stats = args.stats)
+    for filename, matched in S.process_files(batch.find_pdfs(os.path.abspath(args.dir))):
+        pass
+    
+    if(args.split):
+        S.export_files(args.output)
+    else:
+        S.export_excel(args.output)
+    log.info("Done.\n%s" % S.get_summary())
+    return(0)
+
+if __name__ == '__main__':
+    sys.exit(main())
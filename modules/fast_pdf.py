@@ -0,0 +1,592 @@
+####################################################################################################
+# The MIT License (MIT)
+#
+# Copyright (c) 2015, Alexander I. Mykyta
+# All rights reserved.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+####################################################################################################
+
+# Minimal PDF object reader
+#
+# Only understands enough of the file format to get from the trailer to the widget annotations
+# of each page: xref tables, xref streams, object streams and FlateDecode.
+# Anything else raises Unsupported, and the caller is expected to fall back to pdfminer.
+#
+# Objects are returned using the same Python types that pdfminer uses (dicts with str keys,
+# bytes for strings, PSLiteral for names) so the rest of pdf_parser works on either one.
+
+import re
+import zlib
+import logging
+
+from pdfminer.psparser import LIT
+
+log = logging.getLogger("fast_pdf")
+
+#===================================================================================================
+class Unsupported(Exception):
+    """ The file uses a feature that this reader does not handle """
+    pass
+
+# Errors that mean a file is malformed in a way that was not anticipated.
+# Callers treat these the same as Unsupported
+READ_ERRORS = (Unsupported, ValueError, KeyError, IndexError, zlib.error)
+
+#===================================================================================================
+class ObjRef:
+    """ Indirect object reference. Same interface as pdfminer's PDFObjRef """
+    __slots__ = ("reader", "objid")
+
+    def __init__(self, reader, objid):
+        self.reader = reader
+        self.objid = objid
+
+    def resolve(self):
+        return(self.reader.get_object(self.objid))
+
+def resolve(obj):
+    """ Follows references until a direct object is reached """
+    while(isinstance(obj, ObjRef)):
+        obj = obj.resolve()
+    return(obj)
+
+def get_int(d, key, default = None):
+    """ Returns an integer entry of a dictionary. Raises Unsupported if it is something else """
+    v = resolve(d.get(key, default))
+    if(not isinstance(v, int)):
+        raise Unsupported("Expected an integer /%s" % key)
+    return(v)
+
+def get_ints(d, key, default = None):
+    """ Returns an array of integers from a dictionary. Raises Unsupported if it is something else """
+    v = resolve(d.get(key, default))
+    if(not isinstance(v, list)):
+        raise Unsupported("Expected an array /%s" % key)
+    v = [resolve(x) for x in v]
+    for x in v:
+        if(not isinstance(x, int)):
+            raise Unsupported("Expected an array of integers /%s" % key)
+    return(v)
+
+#---------------------------------------------------------------------------------------------------
+class Stream:
+    """ Stream object. Not a dict, so it is skipped in the same places as pdfminer's PDFStream """
+    __slots__ = ("attrs", "rawdata")
+
+    def __init__(self, attrs, rawdata):
+        self.attrs = attrs
+        self.rawdata = rawdata
+
+    def get_data(self):
+        filters = resolve(self.attrs.get('Filter'))
+        params = resolve(self.attrs.get('DecodeParms'))
+        if(filters == None):
+            return(self.rawdata)
+
+        if(isinstance(filters, list)):
+            if(len(filters) != 1):
+                raise Unsupported("Chained stream filters")
+            filters = resolve(filters[0])
+            if(isinstance(params, list)):
+                params = resolve(params[0]) if len(params) else None
+
+        if(getattr(filters, 'name', None) not in ("FlateDecode", "Fl")):
+            raise Unsupported("Stream filter %r" % filters)
+
+        data = zlib.decompress(self.rawdata)
+
+        if(params):
+            if(not isinstance(params, dict)):
+                raise Unsupported("Bad stream /DecodeParms")
+            predictor = get_int(params, 'Predictor', 1)
+            if(predictor >= 10):
+                data = png_unpredict(
+                    data,
+                    get_int(params, 'Columns', 1),
+                    get_int(params, 'Colors', 1),
+                    get_int(params, 'BitsPerComponent', 8)
+                )
+            elif(predictor != 1):
+                raise Unsupported("Stream predictor %d" % predictor)
+        return(data)
+
+#---------------------------------------------------------------------------------------------------
+def png_unpredict(data, columns, colors, bpc):
+    """ Undo the PNG row predictors used by xref and object streams """
+    bpp = max(1, (colors * bpc) // 8)
+    rowlen = (columns * colors * bpc + 7) // 8
+
+    out = bytearray()
+    prev = bytearray(rowlen)
+    for i in range(0, len(data), rowlen + 1):
+        ft = data[i]
+        row = bytearray(data[i+1:i+1+rowlen])
+        if(len(row) < rowlen):
+            break
+
+        if(ft == 0):
+            pass
+        elif(ft == 1):
+            # Sub
+            for j in range(bpp, rowlen):
+                row[j] = (row[j] + row[j-bpp]) & 0xFF
+        elif(ft == 2):
+            # Up
+            row = bytearray((a + b) & 0xFF for a,b in zip(row, prev))
+        elif(ft == 3):
+            # Average
+            for j in range(rowlen):
+                left = row[j-bpp] if j >= bpp else 0
+                row[j] = (row[j] + ((left + prev[j]) >> 1)) & 0xFF
+        elif(ft == 4):
+            # Paeth
+            for j in range(rowlen):
+                a = row[j-bpp] if j >= bpp else 0
+                b = prev[j]
+                c = prev[j-bpp] if j >= bpp else 0
+                p = a + b - c
+                pa = abs(p - a)
+                pb = abs(p - b)
+                pc = abs(p - c)
+                if(pa <= pb and pa <= pc):
+                    pred = a
+                elif(pb <= pc):
+                    pred = b
+                else:
+                    pred = c
+                row[j] = (row[j] + pred) & 0xFF
+        else:
+            raise Unsupported("PNG predictor type %d" % ft)
+
+        out += row
+        prev = row
+    return(bytes(out))
+
+#===================================================================================================
+# Lexer
+#===================================================================================================
+_REGULAR = rb'[^\x00\t\n\x0c\r ()<>\[\]{}/%]'
+_WS = re.compile(rb'(?:[\x00\t\n\x0c\r ]+|%[^\r\n]*)*')
+_NUMBER = re.compile(rb'[+-]?(?:\d+\.?\d*|\.\d+)')
+_NAME = re.compile(rb'/(' + _REGULAR + rb'*)')
+_NAME_ESC = re.compile(rb'#([0-9a-fA-F]{2})')
+_KEYWORD = re.compile(_REGULAR + rb'+')
+_REF_TAIL = re.compile(rb'[\x00\t\n\x0c\r ]+(\d+)[\x00\t\n\x0c\r ]+R(?!' + _REGULAR + rb')')
+_OBJ_HEADER = re.compile(rb'[\x00\t\n\x0c\r ]*(\d+)[\x00\t\n\x0c\r ]+(\d+)[\x00\t\n\x0c\r ]+obj')
+_STR_SPECIAL = re.compile(rb'[()\\]')
+_OCTAL = re.compile(rb'[0-7]{1,3}')
+_HEX_SPACE = re.compile(rb'[\x00\t\n\x0c\r ]')
+_STREAM_START = re.compile(rb'stream\r?\n')
+_XREF_SUBSECTION = re.compile(rb'(\d+)[ ]+(\d+)')
+
+_ESCAPES = {
+    b"b": b"\x08",
+    b"t": b"\t",
+    b"n": b"\n",
+    b"f": b"\x0c",
+    b"r": b"\r",
+    b"(": b"(",
+    b")": b")",
+    b"\\": b"\\",
+}
+
+def decode_name(raw):
+    """ Name tokens are decoded the same way pdfminer does it """
+    if(b'#' in raw):
+        raw = _NAME_ESC.sub(lambda m: bytes((int(m.group(1), 16),)), raw)
+    try:
+        return(str(raw, "utf-8"))
+    except UnicodeDecodeError:
+        return(raw)
+
+class Lexer:
+    """ Parses PDF objects out of a byte buffer """
+    def __init__(self, reader, data):
+        self.reader = reader
+        self.data = data
+
+    def parse(self, pos):
+        """ Parses one object starting at pos. Returns (object, end position) """
+        data = self.data
+        pos = _WS.match(data, pos).end()
+        c = data[pos:pos+1]
+
+        if(c == b'/'):
+            m = _NAME.match(data, pos)
+            return(LIT(decode_name(m.group(1))), m.end())
+
+        if(c == b'<'):
+            if(data[pos+1:pos+2] == b'<'):
+                return(self.parse_dict(pos+2))
+            return(self.parse_hexstring(pos+1))
+
+        if(c == b'['):
+            return(self.parse_array(pos+1))
+
+        if(c == b'('):
+            return(self.parse_string(pos+1))
+
+        m = _NUMBER.match(data, pos)
+        if(m):
+            tok = m.group(0)
+            if(b'.' in tok):
+                return(float(tok), m.end())
+            n = int(tok)
+            if(tok[0] not in b'+-'):
+                r = _REF_TAIL.match(data, m.end())
+                if(r):
+                    return(ObjRef(self.reader, n), r.end())
+            return(n, m.end())
+
+        m = _KEYWORD.match(data, pos)
+        if(m):
+            kw = m.group(0)
+            if(kw == b'true'):
+                return(True, m.end())
+            if(kw == b'false'):
+                return(False, m.end())
+            if(kw == b'null'):
+                return(None, m.end())
+
+        raise Unsupported("Unexpected token at offset %d" % pos)
+
+    def parse_dict(self, pos):
+        data = self.data
+        d = {}
+        while(True):
+            pos = _WS.match(data, pos).end()
+            if(data[pos:pos+2] == b'>>'):
+                return(d, pos+2)
+            m = _NAME.match(data, pos)
+            if(not m):
+                raise Unsupported("Bad dictionary key at offset %d" % pos)
+            v, pos = self.parse(m.end())
+            d[decode_name(m.group(1))] = v
+
+    def parse_array(self, pos):
+        data = self.data
+        a = []
+        while(True):
+            pos = _WS.match(data, pos).end()
+            if(data[pos:pos+1] == b']'):
+                return(a, pos+1)
+            if(pos >= len(data)):
+                raise Unsupported("Unterminated array")
+            v, pos = self.parse(pos)
+            a.append(v)
+
+    def parse_string(self, pos):
+        data = self.data
+        depth = 1
+        out = bytearray()
+        while(True):
+            m = _STR_SPECIAL.search(data, pos)
+            if(not m):
+                raise Unsupported("Unterminated string")
+            i = m.start()
+            out += data[pos:i]
+            c = data[i:i+1]
+            if(c == b'('):
+                depth = depth + 1
+                out += c
+                pos = i + 1
+            elif(c == b')'):
+                depth = depth - 1
+                if(depth == 0):
+                    return(bytes(out), i+1)
+                out += c
+                pos = i + 1
+            else:
+                # Escape sequence
+                e = data[i+1:i+2]
+                if(e in _ESCAPES):
+                    out += _ESCAPES[e]
+                    pos = i + 2
+                elif(_OCTAL.match(e)):
+                    o = _OCTAL.match(data, i+1)
+                    out.append(int(o.group(0), 8) & 0xFF)
+                    pos = o.end()
+                elif(e == b'\r'):
+                    # line continuation
+                    pos = i + 2
+                    if(data[pos:pos+1] == b'\n'):
+                        pos = pos + 1
+                elif(e == b'\n'):
+                    pos = i + 2
+                else:
+                    # Unknown escape. Backslash is ignored
+                    out += e
+                    pos = i + 2
+
+    def parse_hexstring(self, pos):
+        end = self.data.find(b'>', pos)
+        if(end < 0):
+            raise Unsupported("Unterminated hex string")
+        h = _HEX_SPACE.sub(b'', self.data[pos:end])
+        if(len(h) % 2):
+            h = h + b'0'
+        try:
+            s = bytes.fromhex(h.decode("ascii"))
+        except ValueError:
+            raise Unsupported("Bad hex string at offset %d" % pos)
+        return(s, end+1)
+
+    def parse_indirect(self, pos, objid = None):
+        """ Parses a 'n g obj ... endobj' definition at pos """
+        m = _OBJ_HEADER.match(self.data, pos)
+        if(not m):
+            raise Unsupported("No object at offset %d" % pos)
+        if((objid != None) and (int(m.group(1)) != objid)):
+            raise Unsupported("Object %d is not at its xref offset" % objid)
+
+        obj, pos = self.parse(m.end())
+
+        # Check for stream data
+        if(isinstance(obj, dict)):
+            pos = _WS.match(self.data, pos).end()
+            s = _STREAM_START.match(self.data, pos)
+            if(s):
+                length = resolve(obj.get('Length'))
+                if(not isinstance(length, int)):
+                    raise Unsupported("Stream without a usable /Length")
+                start = s.end()
+                obj = Stream(obj, self.data[start:start+length])
+                pos = start + length
+        return(obj, pos)
+
+#===================================================================================================
+# Reader
+#===================================================================================================
+class Reader:
+    """ Random access to the objects in an in-memory PDF file.
+    data can also be an mmap of the file, so that only the parts that are looked at are read """
+    def __init__(self, data):
+        self.data = data
+        self.lexer = Lexer(self, data)
+
+        self.xref = {}      # objid --> file offset, or (objstm id, index) for compressed objects
+        self.trailer = {}
+        self.cache = {}
+        self.objstm_cache = {}
+
+        if(data.find(b'%PDF-', 0, 1024) < 0):
+            raise Unsupported("Missing PDF header")
+
+        self.load_xrefs()
+
+        if('Encrypt' in self.trailer):
+            raise Unsupported("Encrypted file")
+        if('Root' not in self.trailer):
+            raise Unsupported("Trailer has no /Root")
+
+    #--------------------------------------------------------------------------
+    def load_xrefs(self):
+        idx = self.data.rfind(b'startxref', max(0, len(self.data) - 2048))
+        if(idx < 0):
+            raise Unsupported("startxref not found")
+        offset, _ = self.lexer.parse(idx + 9)
+
+        visited = set()
+        while(offset != None):
+            if(not isinstance(offset, int) or (offset in visited)):
+                raise Unsupported("Bad xref chain")
+            visited.add(offset)
+
+            pos = _WS.match(self.data, offset).end()
+            if(self.data[pos:pos+4] == b'xref'):
+                trailer = self.load_xref_table(pos + 4)
+                # Hybrid-reference files list compressed objects in an extra xref stream
+                if('XRefStm' in trailer):
+                    if(not isinstance(trailer['XRefStm'], int)):
+                        raise Unsupported("Bad /XRefStm")
+                    self.load_xref_stream(trailer['XRefStm'])
+            else:
+                trailer = self.load_xref_stream(pos)
+
+            # Newer trailers take priority over older ones
+            for k,v in trailer.items():
+                self.trailer.setdefault(k, v)
+
+            offset = trailer.get('Prev')
+
+    def load_xref_table(self, pos):
+        data = self.data
+        while(True):
+            pos = _WS.match(data, pos).end()
+            if(data[pos:pos+7] == b'trailer'):
+                trailer, _ = self.lexer.parse(pos + 7)
+                if(not isinstance(trailer, dict)):
+                    raise Unsupported("Bad trailer")
+                return(trailer)
+
+            # Subsection header
+            m = _XREF_SUBSECTION.match(data, pos)
+            if(not m):
+                raise Unsupported("Bad xref table at offset %d" % pos)
+            start = int(m.group(1))
+            count = int(m.group(2))
+            pos = m.end()
+
+            for i in range(count):
+                pos = _WS.match(data, pos).end()
+                entry = data[pos:pos+18]
+                if(len(entry) < 18):
+                    raise Unsupported("Truncated xref table")
+                # Free entries are skipped, as pdfminer does. In hybrid-reference files, objects
+                # in object streams are listed as free here and found in the /XRefStm instead
+                if(entry[17:18] == b'n'):
+                    self.xref.setdefault(start + i, int(entry[0:10]))
+                pos = pos + 18
+
+    def load_xref_stream(self, pos):
+        obj, _ = self.lexer.parse_indirect(pos)
+        if(not isinstance(obj, Stream)):
+            raise Unsupported("Expected an xref stream at offset %d" % pos)
+        attrs = obj.attrs
+        if(getattr(attrs.get('Type'), 'name', None) != "XRef"):
+            raise Unsupported("Expected an xref stream at offset %d" % pos)
+
+        data = obj.get_data()
+        w = get_ints(attrs, 'W')
+        index = get_ints(attrs, 'Index', [0, get_int(attrs, 'Size')])
+        if((len(w) != 3) or (len(index) % 2)):
+            raise Unsupported("Bad xref stream /W or /Index")
+        entry_len = sum(w)
+
+        def field(p, n, default):
+            if(n == 0):
+                return(default)
+            return(int.from_bytes(data[p:p+n], "big"))
+
+        p = 0
+        for i in range(0, len(index), 2):
+            start = index[i]
+            count = index[i+1]
+            for objid in range(start, start+count):
+                if(p + entry_len > len(data)):
+                    raise Unsupported("Truncated xref stream")
+                t = field(p, w[0], 1)
+                f2 = field(p + w[0], w[1], 0)
+                f3 = field(p + w[0] + w[1], w[2], 0)
+                p = p + entry_len
+
+                if(t == 1):
+                    self.xref.setdefault(objid, f2)
+                elif(t == 2):
+                    self.xref.setdefault(objid, (f2, f3))
+
+        return(attrs)
+
+    #--------------------------------------------------------------------------
+    def get_object(self, objid):
+        if(objid in self.cache):
+            return(self.cache[objid])
+
+        loc = self.xref.get(objid)
+        if(loc == None):
+            # Missing and free objects are null
+            obj = None
+        elif(isinstance(loc, tuple)):
+            obj = self.get_compressed_object(loc[0], loc[1], objid)
+        else:
+            obj, _ = self.lexer.parse_indirect(loc, objid)
+
+        self.cache[objid] = obj
+        return(obj)
+
+    def get_compressed_object(self, stmid, index, objid):
+        if(stmid not in self.objstm_cache):
+            stm = self.get_object(stmid)
+            if(not isinstance(stm, Stream)):
+                raise Unsupported("Object stream %d is not a stream" % stmid)
+            n = get_int(stm.attrs, 'N')
+            first = get_int(stm.attrs, 'First')
+            data = stm.get_data()
+            lexer = Lexer(self, data)
+
+            # Header is N pairs of (objid, offset), all plain integers
+            header = data[:first].split()
+            if(len(header) < 2*n):
+                raise Unsupported("Bad object stream header in %d" % stmid)
+            offsets = []
+            for i in range(n):
+                offsets.append((int(header[2*i]), first + int(header[2*i+1])))
+            self.objstm_cache[stmid] = (lexer, offsets)
+
+        lexer, offsets = self.objstm_cache[stmid]
+        oid, pos = offsets[index]
+        if(oid != objid):
+            raise Unsupported("Object %d is not at its object stream index" % objid)
+        obj, _ = lexer.parse(pos)
+        return(obj)
+
+    #--------------------------------------------------------------------------
+    def get_catalog(self):
+        catalog = resolve(self.trailer['Root'])
+        if(not isinstance(catalog, dict)):
+            raise Unsupported("Bad document catalog")
+        return(catalog)
+
+    def get_pages(self):
+        """ Walks the page tree. Returns a list of Page objects in document order """
+        root = resolve(self.get_catalog().get('Pages'))
+        if(not isinstance(root, dict)):
+            raise Unsupported("Bad page tree")
+
+        pages = []
+        visited = set()
+
+        # Iterative walk. Stack entries are (node, inherited attributes)
+        stack = [(root, {})]
+        while(len(stack)):
+            node, inherited = stack.pop()
+            if(id(node) in visited):
+                raise Unsupported("Page tree loop")
+            visited.add(id(node))
+
+            if('MediaBox' in node):
+                inherited = dict(inherited)
+                inherited['MediaBox'] = node['MediaBox']
+
+            if('Kids' in node):
+                kids = resolve(node['Kids'])
+                if(not isinstance(kids, list)):
+                    raise Unsupported("Bad page tree /Kids")
+                for kid in reversed(kids):
+                    kid = resolve(kid)
+                    if(not isinstance(kid, dict)):
+                        raise Unsupported("Bad page tree node")
+                    stack.append((kid, inherited))
+            else:
+                pages.append(Page(
+                    node.get('Annots'),
+                    resolve(inherited.get('MediaBox'))
+                ))
+
+        return(pages)
+
+#===================================================================================================
+class Page:
+    """ Mimics the attributes of pdfminer's PDFPage that pdf_parser.Page uses """
+    __slots__ = ("annots", "mediabox")
+
+    def __init__(self, annots, mediabox):
+        self.annots = annots
+        self.mediabox = mediabox
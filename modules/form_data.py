@@ -24,6 +24,8 @@
 ####################################################################################################
 
 import os
+import sys
+import array
 import datetime
 import logging
 
@@ -32,24 +34,56 @@ from pdfminer.pdftypes import PDFException
 
 log = logging.getLogger("form_data")
 
+# Widget maps learned from forms, by the /ID of their blank. Copies of one blank share a map
+_widget_maps = {}
+
 class FormData:
-    def __init__(self, filename):
+    """ Fields extracted from a PDF form
+    
+    field_filter is an optional set of field names to extract values for. Names of all other
+    fields are still read so that the fingerprint is complete, but they are left out of fields.
+    
+    widget_map is an optional pdf_parser.WidgetMap of a known blank form. If the file verifies
+    against it, the values are read directly and the page tree is not walked.
+    
+    data and timestamp can be given if the file contents were already read (see prefetch)
+    """
+    def __init__(self, filename, field_filter = None, widget_map = None, data = None, timestamp = None):
         self.valid = False
         self.filename = filename
         self.pages = []
         self.fields = {}
+        self.fingerprint = []
         self.timestamp = None
+        self.direct = False # True if the values were read through widget_map
+        self.doc_id = None # Permanent /ID as hex, once get_widget_map() has read it
         
-        # check if file exists
-        if(not os.path.exists(filename)):
-            self.valid = False
-            return
+        if(data == None):
+            # check if file exists
+            if(not os.path.exists(filename)):
+                self.valid = False
+                return
+            
+            with open(filename, 'rb') as fp:
+                data = fp.read()
+        
+        if(timestamp == None):
+            timestamp = datetime.datetime.fromtimestamp(os.path.getctime(filename))
+        self.timestamp = timestamp
         
-        self.timestamp = datetime.datetime.fromtimestamp(os.path.getctime(filename))
+        # Try the shortcut first
+        if(widget_map != None):
+            fields = widget_map.read_fields(data, field_filter)
+            if(fields != None):
+                self.fields = fields
+                self.fingerprint = list(widget_map.fingerprint)
+                self.direct = True
+                self.valid = True
+                return
         
         # Parse!
         try:
-            self.pages = pdf_parser.get_pdf_pages(filename)
+            self.pages = pdf_parser.get_pdf_pages(filename, field_filter, data)
         except PDFException as E:
             self.valid = False
             log.warning("Call to get_pdf_pages() failed for '%s'" % filename)
@@ -59,38 +93,195 @@ class FormData:
         self.fields = {}
         for pg in self.pages:
             for field in pg.fields:
-                self.fields[field.name] = field.value
+                if((field_filter == None) or (field.name in field_filter)):
+                    self.fields[field.name] = field.value
+        
+        # Collect the page hashes to construct a form fingerprint
+        for page in self.pages:
+            if(page.page_hash != None):
+                self.fingerprint.append(page.page_hash)
         
         self.valid = True
     
+    def get_field_names(self):
+        """ Returns the names of all fields in the form, including ones left out of fields by
+        field_filter """
+        if(self.direct):
+            return(list(self.fields.keys()))
+        names = []
+        for pg in self.pages:
+            for field in pg.fields:
+                names.append(field.name)
+        return(names)
+    
     def get_fingerprint(self):
-        """ Collects the page hashes to construct a form fingerprint """
-        fingerprint = []
-        for page in self.pages:
-            if(page.page_hash != None):
-                fingerprint.append(page.page_hash)
-        return(fingerprint)
+        """ Returns the form fingerprint (page hashes of pages that have fields) """
+        return(self.fingerprint)
+    
+    def get_widget_map(self, data = None):
+        """ Returns a pdf_parser.WidgetMap of this form's widgets, or None if the file has no
+        permanent identifier to verify other files against.
+        data is the file's contents, if the caller still has them """
+        if(not self.valid or self.direct):
+            return(None)
+        
+        if(self.doc_id == None):
+            if(data == None):
+                with open(self.filename, 'rb') as fp:
+                    data = fp.read()
+            self.doc_id = pdf_parser.get_doc_id(data)
+        if(not self.doc_id):
+            return(None)
+        
+        widget_map = _widget_maps.get(self.doc_id)
+        if(widget_map == None):
+            widget_map = pdf_parser.WidgetMap.from_pages(self.doc_id, self.pages, self.fingerprint)
+            _widget_maps[self.doc_id] = widget_map
+        return(widget_map)
         
     def has_matching_fingerprint(self, ext_fp):
         """ checks if ext_fp is a subset of this form's fingerprint """
-        this_fp = self.get_fingerprint()
-        
-        if(len(ext_fp) > len(this_fp)):
-            # Impossible to be a subset because it is bigger than this
-            return(False)
+        return(fingerprint_contains(self.get_fingerprint(), ext_fp))
+
+#===================================================================================================
+def fingerprint_contains(this_fp, ext_fp):
+    """ checks if ext_fp is a run of consecutive page hashes in this_fp """
+    if(len(ext_fp) > len(this_fp)):
+        # Impossible to be a subset because it is bigger than this
+        return(False)
+    
+    # Check if ext_fp is a subset of this_fp
+    for i in range(len(this_fp) - len(ext_fp) + 1):
+        # for each start position
         
-        # Check if ext_fp is a subset of this_fp
-        for i in range(len(this_fp) - len(ext_fp) + 1):
-            # for each start position
+        # check if the substring matches
+        for j in range(len(ext_fp)):
+            if(this_fp[i+j] != ext_fp[j]):
+                # no match at this start position
+                break
+        else:
+            # finished loop without finding mismatch.
+            return(True)
             
-            # check if the substring matches
-            for j in range(len(ext_fp)):
-                if(this_fp[i+j] != ext_fp[j]):
-                    # no match at this start position
-                    break
+    # Never found a match at any offset
+    return(False)
+
+#===================================================================================================
+# Most distinct values a column of a FieldSchema encodes. Columns with more (names, IDs) would only
+# grow the dictionary, so their other values are kept with the row instead
+MAX_DISTINCT = 4096
+
+# Code of a value that is kept with the row
+CODE_EXTRA = 0xFFFFFFFF
+
+class FieldSchema:
+    """ Row layout shared by all forms of one template
+    
+    Forms of the same template all have the same report columns. Instead of a tuple of values
+    per form, each row is packed into a vector of value codes in column order. Values are
+    dictionary-encoded per column, so a value that appears in many forms (blanks, "Yes", a city
+    name) is only stored once.
+    """
+    def __init__(self, names, max_distinct = MAX_DISTINCT):
+        self.names = tuple([sys.intern(n) for n in names])
+        self.max_distinct = max_distinct
+        
+        # Per column. Code 0 is a blank cell
+        self.values = [[None] for n in self.names] # code --> value
+        self.codes = [{} for n in self.names] # (type, value) --> code. Typed so that 1 and "1" stay distinct
+    
+    def encode(self, col, value):
+        """ Returns the code of a value in a column, or CODE_EXTRA if it is not encoded """
+        if(value == None):
+            return(0)
+        key = (type(value), value)
+        try:
+            code = self.codes[col].get(key)
+        except TypeError:
+            # Not hashable
+            return(CODE_EXTRA)
+        if(code == None):
+            if(len(self.values[col]) > self.max_distinct):
+                return(CODE_EXTRA)
+            code = len(self.values[col])
+            self.values[col].append(value)
+            self.codes[col][key] = code
+        return(code)
+    
+    def pack(self, row):
+        """ Converts a row tuple into (codes, values that were not encoded) """
+        codes = array.array('I', bytes(4 * len(self.names)))
+        extra = []
+        for i, value in enumerate(row):
+            code = self.encode(i, value)
+            if(code == CODE_EXTRA):
+                extra.append(value)
+            codes[i] = code
+        return((codes, tuple(extra)))
+    
+    def unpack(self, packed):
+        """ Converts the result of pack() back into a row tuple """
+        codes, extra = packed
+        row = []
+        n_extra = 0
+        for i, code in enumerate(codes):
+            if(code == CODE_EXTRA):
+                row.append(extra[n_extra])
+                n_extra = n_extra + 1
             else:
-                # finished loop without finding mismatch.
-                return(True)
-                
-        # Never found a match at any offset
-        return(False)
+                row.append(self.values[i][code])
+        return(tuple(row))
+
+#===================================================================================================
+class FormSummary:
+    """ What is kept of a form once its report row has been extracted
+    
+    Has the same filename and valid attributes as FormData. row is the tuple returned by
+    ExtractionPlan.make_row(), or None if the form is not valid.
+    If a row_store.RowStore is given, the row is kept there instead of in this object.
+    """
+    __slots__ = ("filename", "valid", "_row", "store", "key")
+    
+    def __init__(self, filename, valid, row = None, store = None):
+        self.filename = filename
+        self.valid = valid
+        self._row = None
+        self.store = None
+        self.key = None
+        
+        if((row != None) and (store != None)):
+            self.store = store
+            self.key = store.add(tuple(row))
+        else:
+            self._row = row
+    
+    @property
+    def row(self):
+        if(self.store != None):
+            return(self.store.get(self.key))
+        return(self._row)
+    
+    def discard(self):
+        """ Releases the stored row """
+        if(self.store != None):
+            self.store.discard(self.key)
+            self.store = None
+
+#===================================================================================================
+class PendingForm:
+    """ A form that was scanned but whose values were not extracted yet (see form_scan)
+    
+    Has the same filename and valid attributes as FormData. field_names is kept for forms that
+    did not match, so they can be compared against other templates.
+    """
+    __slots__ = ("filename", "valid", "field_names")
+    
+    def __init__(self, filename, valid, field_names = None):
+        self.filename = filename
+        self.valid = valid
+        self.field_names = field_names
+    
+    def get_field_names(self):
+        if(self.field_names == None):
+            return([])
+        return(list(self.field_names))
@@ -0,0 +1,229 @@
+####################################################################################################
+# The MIT License (MIT)
+#
+# Copyright (c) 2015, Alexander I. Mykyta
+# All rights reserved.
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+# 
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+####################################################################################################
+
+# Two-phase import of forms
+#
+# The scan only establishes whether each file is a valid form that matches the template. No
+# field values are decoded, and files that verify against the template's widget map are not
+# parsed at all. The report rows of the matching forms are extracted later, when they are needed.
+#
+# Both phases run on a pool of processes. Files are read ahead in this process and handed to
+# the workers, so PDFs inside archives are only unpacked once.
+
+import collections
+import logging
+import multiprocessing
+
+from . import form_data
+from . import prefilter
+from . import prefetch
+from . import archives
+from . import batch
+
+log = logging.getLogger("form_scan")
+
+# Files parsed in this process while looking for a form to learn the widget map from
+MAX_LEARN_FILES = 8
+
+#===================================================================================================
+def get_worker_count(n_workers, n_files):
+    """ No more workers than files. A single file is handled in this process """
+    if(n_workers == None):
+        n_workers = multiprocessing.cpu_count()
+    return(max(1, min(n_workers, n_files)))
+
+def iter_parallel(func, files, n_workers = None, initializer = None, initargs = (), prejudge = None):
+    """ Runs func(filename, data, timestamp) for each prefetch.PrefetchedFile in files on a pool
+    of processes, with at most a few files per worker in flight at once.
+    prejudge(pf) is called in this process first. If it returns something other than None, that
+    is used as the file's result instead.
+    Yields the results in the same order as files """
+    if(n_workers == None):
+        n_workers = multiprocessing.cpu_count()
+    
+    if(n_workers <= 1):
+        if(initializer != None):
+            initializer(*initargs)
+        for pf in files:
+            result = None
+            if(prejudge != None):
+                result = prejudge(pf)
+            if(result == None):
+                result = func(pf.filename, pf.data, pf.timestamp)
+            yield(result)
+        return
+    
+    max_in_flight = n_workers * 4
+    with multiprocessing.Pool(n_workers, initializer, initargs) as pool:
+        window = collections.deque()
+        for pf in files:
+            result = None
+            if(prejudge != None):
+                result = prejudge(pf)
+            if(result != None):
+                window.append((result, None))
+            else:
+                window.append((None, pool.apply_async(func, (pf.filename, pf.data, pf.timestamp))))
+            
+            while(len(window) >= max_in_flight):
+                yield(pop_result(window))
+        while(len(window)):
+            yield(pop_result(window))
+
+def pop_result(window):
+    result, async_result = window.popleft()
+    if(async_result != None):
+        result = async_result.get()
+    return(result)
+
+#===================================================================================================
+# Phase 1: Scan
+#===================================================================================================
+def scan_form(filename, data, timestamp, fingerprint, widget_map):
+    """ Checks a file against a template's fingerprint without decoding any values.
+    Returns ((filename, status, field names), FormData). Field names are only given for forms
+    that did not match """
+    try:
+        # An empty filter skips decoding every value
+        F = form_data.FormData(filename, frozenset(), widget_map, data, timestamp)
+    except Exception as E:
+        log.warning("Failed to read '%s': %s" % (filename, E))
+        return(((filename, batch.STATUS_FAILED, None), None))
+    
+    if(not F.valid):
+        return(((filename, batch.STATUS_INVALID, None), F))
+    if(not F.has_matching_fingerprint(fingerprint)):
+        return(((filename, batch.STATUS_MISMATCH, tuple(sorted(set(F.get_field_names())))), F))
+    return(((filename, batch.STATUS_OK, None), F))
+
+_fingerprint = None
+_widget_map = None
+
+def init_scan(fingerprint, widget_map):
+    global _fingerprint, _widget_map
+    _fingerprint = fingerprint
+    _widget_map = widget_map
+
+def scan_file(filename, data, timestamp):
+    """ Runs in a worker process """
+    return(scan_form(filename, data, timestamp, _fingerprint, _widget_map)[0])
+
+class Scanner:
+    """ Scans files against an ExtractionPlan's template
+    
+    screen is an optional prefilter.Prefilter that rejects files in this process before they are
+    sent to a worker.
+    If the plan has no widget map, one is learned from the first matching form, and all later
+    files are checked against it.
+    """
+    def __init__(self, plan, screen = None, n_workers = None):
+        self.fingerprint = list(plan.form_fingerprint)
+        self.widget_map = plan.widget_map
+        self.screen = screen
+        self.n_workers = n_workers
+    
+    def prejudge(self, pf):
+        if(pf.error != None):
+            if(isinstance(pf.error, FileNotFoundError)):
+                return((pf.filename, batch.STATUS_INVALID, None))
+            log.warning("Failed to read '%s': %s" % (pf.filename, pf.error))
+            return((pf.filename, batch.STATUS_FAILED, None))
+        
+        reason = pf.rejected
+        if((reason == None) and (self.screen != None)):
+            reason = self.screen.check(pf.filename, pf.data, pf.timestamp)
+        if(reason == prefilter.REJECT_PAGES):
+            return((pf.filename, batch.STATUS_MISMATCH, None))
+        elif(reason != None):
+            return((pf.filename, batch.STATUS_INVALID, None))
+        return(None)
+    
+    def iter_scan(self, filenames, begin = None):
+        """ Yields (filename, status, field names) for each file, in order.
+        begin(n) is optionally called with the position of each file in filenames, just before
+        the file is checked """
+        files = archives.iter_files(filenames, screen=self.screen)
+        if(begin != None):
+            files = iter_begun(files, begin)
+        n_done = 0
+        
+        if(self.widget_map == None):
+            # Workers only get the widget map they start with. Try to learn one here first
+            for pf in files:
+                result = self.prejudge(pf)
+                if(result == None):
+                    result, F = scan_form(pf.filename, pf.data, pf.timestamp, self.fingerprint, None)
+                    if(result[1] == batch.STATUS_OK):
+                        self.widget_map = F.get_widget_map(pf.data)
+                yield(result)
+                n_done = n_done + 1
+                if((self.widget_map != None) or (n_done >= MAX_LEARN_FILES)):
+                    break
+        
+        yield from iter_parallel(
+            scan_file, files, get_worker_count(self.n_workers, len(filenames) - n_done),
+            init_scan, (self.fingerprint, self.widget_map),
+            self.prejudge
+        )
+
+def iter_begun(files, begin):
+    for n, pf in enumerate(files):
+        begin(n)
+        yield(pf)
+
+#===================================================================================================
+# Phase 2: Extract
+#===================================================================================================
+_plan = None
+
+def init_extract(plan):
+    global _plan
+    _plan = plan
+
+def extract_file(filename, data, timestamp):
+    """ Runs in a worker process """
+    status, row = batch.process_file(_plan, filename, prefetch.PrefetchedFile(filename, data, timestamp))
+    return((filename, status, row))
+
+def iter_rows(plan, filenames, n_workers = None):
+    """ Extracts the report rows of files on a pool of processes.
+    Yields (filename, status, row) for each file, in order """
+    def prejudge(pf):
+        if(pf.error != None):
+            status, row = batch.process_file(plan, pf.filename, pf)
+            return((pf.filename, status, row))
+        return(None)
+    
+    yield from iter_parallel(
+        extract_file, archives.iter_files(filenames), get_worker_count(n_workers, len(filenames)),
+        init_extract, (plan,),
+        prejudge
+    )
+
+def read_row(plan, filename):
+    """ Extracts the report row of one file in this process.
+    Returns (status, row) """
+    pf = next(archives.iter_files([filename]))
+    return(batch.process_file(plan, filename, pf))
@@ -28,6 +28,7 @@ import re
 import glob
 import os
 import fnmatch
+import threading
 import logging
 
 import tkinter as tk
@@ -39,9 +40,26 @@ from .python_modules import tk_extensions as tkext
 from . import form_data
 from . import report_template
 from . import report_entries
+from . import pdf_parser
+from . import batch
+from . import journal
+from . import row_store
+from . import archives
+from . import bulk_templates
+from . import template_index
+from . import value_index
+from . import prefilter
+from . import fanout
+from . import export_job
+from . import census
+from . import sampling
+from . import form_scan
 
 log = logging.getLogger("gui")
 
+# Where journals of folder imports are kept, so that they can be resumed after a crash
+JOURNAL_DIR = "journals"
+
 def trim_path(path, maxlen):
     if(len(path) <= maxlen):
         return(path)
@@ -133,6 +151,18 @@ class TemplateBrowser(tkext.Dialog):
             command = self.ev_but_New
         )
         x.pack(fill=tk.X)
+        x = ttk.Button(
+            top_buttons_fr,
+            text="New from Folder",
+            command = self.ev_but_NewFromDir
+        )
+        x.pack(fill=tk.X)
+        x = ttk.Button(
+            top_buttons_fr,
+            text="Folder Census...",
+            command = self.ev_but_Census
+        )
+        x.pack(fill=tk.X)
         x = ttk.Button(
             top_buttons_fr,
             text="Edit",
@@ -152,6 +182,16 @@ class TemplateBrowser(tkext.Dialog):
         )
         x.pack(fill=tk.X)
         
+        # Bottom button group container frame
+        bottom_buttons_fr = ttk.Frame(buttons_fr)
+        bottom_buttons_fr.pack(side = tk.BOTTOM)
+        x = ttk.Button(
+            bottom_buttons_fr,
+            text="Export Several...",
+            command = self.ev_but_Fanout
+        )
+        x.pack(fill=tk.X)
+        
         #--------------------------------------------------------
         # Global layout
         
@@ -236,6 +276,111 @@ class TemplateBrowser(tkext.Dialog):
             self.rt_list.insert(tk.END, TE.T.name)
             self.set_ev_selection(len(self.templates)-1)
     
+    def ev_but_NewFromDir(self):
+        options = {}
+        options['mustexist'] = True
+        options['title'] = 'Select a Folder of Blank PDFs'
+        
+        dir = filedialog.askdirectory(**options)
+        if(not dir):
+            return
+        
+        C = bulk_templates.TemplateCollector(self.templates)
+        
+        def worker(dlg_if, start_dir, C):
+            dlg_if.set_progress(0)
+            dlg_if.set_status1("Gathering files...")
+            filenames = bulk_templates.find_blanks(start_dir)
+            n_found = len(filenames)
+            
+            for n_done, (f, T, reason) in enumerate(bulk_templates.iter_blanks(filenames)):
+                if(dlg_if.stop_requested()):
+                    return
+                dlg_if.set_status1("Reading blank forms: %d/%d" % (n_done + 1, n_found))
+                dlg_if.set_status2(trim_path(f, 50))
+                dlg_if.set_progress(100*n_done/n_found)
+                C.add(f, T, reason)
+        
+        args={'start_dir':os.path.abspath(dir), 'C':C}
+        x = tkext.ProgressBox(
+            job_func = worker,
+            job_data = args,
+            parent = self.tkWindow,
+            title = "Creating Templates..."
+        )
+        
+        for T in C.templates:
+            self.templates.append(T)
+            self.rt_list.insert(tk.END, T.name)
+        if(len(C.templates)):
+            self.set_ev_selection(len(self.templates)-1)
+        
+        message = "Created %d templates.\n%d forms already had a template.\n%d files were not usable forms." % (
+            len(C.templates), C.n_duplicate, len(C.rejected)
+        )
+        for f, reason in C.rejected[:5]:
+            message = message + "\n    %s: %s" % (os.path.basename(f), reason)
+        if(len(C.rejected) > 5):
+            message = message + "\n    ..."
+        messagebox.showinfo(
+            title = "New Templates from Folder",
+            message = message
+        )
+    
+    def ev_but_Census(self):
+        dir = filedialog.askdirectory(
+            mustexist = True,
+            title = 'Select a Folder of PDFs'
+        )
+        if(not dir):
+            return
+        
+        S = census.Census(self.templates)
+        
+        # Fingerprints only. No values are read
+        def worker(dlg_if, start_dir, S):
+            dlg_if.set_progress(0)
+            dlg_if.set_status1("Gathering files...")
+            filenames = batch.find_pdfs(start_dir)
+            n_found = len(filenames)
+            
+            for n_done, result in enumerate(census.iter_fingerprints(filenames)):
+                if(dlg_if.stop_requested()):
+                    return
+                dlg_if.set_status1("Reading forms: %d/%d" % (n_done + 1, n_found))
+                dlg_if.set_status2(trim_path(result[0], 50))
+                dlg_if.set_progress(100*n_done/n_found)
+                S.add(result)
+        
+        args={'start_dir':os.path.abspath(dir), 'S':S}
+        x = tkext.ProgressBox(
+            job_func = worker,
+            job_data = args,
+            parent = self.tkWindow,
+            title = "Taking a Census..."
+        )
+        
+        def create_draft(C):
+            try:
+                T = census.make_draft(C, [T.name for T in self.templates])
+            except ValueError as E:
+                messagebox.showerror(
+                    title = "New Report Template",
+                    message = str(E)
+                )
+                return(False)
+            
+            TE = TemplateEditor(self.tkWindow, T, "New Report Template")
+            if(not TE.result):
+                return(False)
+            self.templates.append(TE.T)
+            self.rt_list.insert(tk.END, TE.T.name)
+            self.set_ev_selection(len(self.templates)-1)
+            S.add_template(TE.T)
+            return(True)
+        
+        CensusViewer(self.tkWindow, S, create_draft)
+    
     def ev_but_Edit(self):
         idx = self.rt_list.curselection()
         if(len(idx)):
@@ -294,6 +439,70 @@ class TemplateBrowser(tkext.Dialog):
                 self.rt_list.delete(idx)
                 self.set_ev_selection(idx)
             
+    def ev_but_Fanout(self):
+        if(len(self.templates) == 0):
+            return
+        
+        dlg = TemplatePicker(self.tkWindow, self.templates)
+        if(not dlg.result):
+            return
+        templates = dlg.selected_templates
+        
+        dir = filedialog.askdirectory(
+            mustexist = True,
+            title = 'Select a Folder of PDFs'
+        )
+        if(not dir):
+            return
+        
+        filename = filedialog.asksaveasfilename(
+            defaultextension = '.xlsx',
+            filetypes = [('Excel Workbook', '.xlsx'), ('Excel 97-2003 Workbook', '.xls')],
+            title = 'Export as Excel...'
+        )
+        if(not filename):
+            return
+        
+        S = fanout.FanoutSession(templates)
+        cancelled = []
+        
+        # Every PDF is parsed once and routed to all of the selected templates
+        def worker(dlg_if, start_dir, S):
+            dlg_if.set_progress(0)
+            dlg_if.set_status1("Gathering files...")
+            filenames = batch.find_pdfs(start_dir)
+            n_found = len(filenames)
+            
+            for n_done, (f, matched) in enumerate(S.process_files(filenames)):
+                if(dlg_if.stop_requested()):
+                    cancelled.append(True)
+                    return
+                dlg_if.set_status1("Processing files: %d/%d" % (n_done + 1, n_found))
+                dlg_if.set_status2(trim_path(f, 50))
+                dlg_if.set_progress(100*n_done/n_found)
+        
+        args={'start_dir':os.path.abspath(dir), 'S':S}
+        x = tkext.ProgressBox(
+            job_func = worker,
+            job_data = args,
+            parent = self.tkWindow,
+            title = "Extracting Reports..."
+        )
+        
+        # A cancelled run would only give partial reports. Nothing is written
+        if(len(cancelled)):
+            messagebox.showinfo(
+                title = "Export Several",
+                message = "Cancelled. Nothing was exported."
+            )
+            return
+        
+        S.export_excel(filename)
+        messagebox.showinfo(
+            title = "Export Several",
+            message = S.get_summary()
+        )
+    
     def dlg_validate(self):
         idx = self.rt_list.curselection()
         if(len(idx) == 0):
@@ -302,6 +511,17 @@ class TemplateBrowser(tkext.Dialog):
                 message = "You must select a template first."
             )
             return(False)
+        
+        # Templates loaded from disk may have been edited by hand
+        T = self.templates[int(idx[0])]
+        try:
+            T.validate()
+        except ValueError as E:
+            messagebox.showerror(
+                title = "Select Template",
+                message = "Template '%s' can not be used:\n\n%s\n\nEdit it to fix this first." % (T.name, E)
+            )
+            return(False)
             
         return True
     
@@ -311,6 +531,194 @@ class TemplateBrowser(tkext.Dialog):
         
         self.selected_template = self.templates[idx]
     
+#===================================================================================================
+class CensusViewer(tkext.Dialog):
+    """ Shows the form types found by a census. Ones without a template can be turned into one """
+    
+    #---------------------------------------------------------------
+    # Widgets
+    #---------------------------------------------------------------
+    def create_body(self, master_fr):
+        self.lbl_summary = ttk.Label(
+            master_fr,
+            padding=3
+        )
+        self.lbl_summary.pack(fill=tk.X)
+        
+        list_fr = ttk.Frame(
+            master_fr,
+            padding=3
+        )
+        list_fr.pack(
+            fill=tk.BOTH,
+            expand = True
+        )
+        
+        self.cluster_list = tk.Listbox(
+            list_fr,
+            highlightthickness = 0,
+            selectmode = "single",
+            exportselection = False,
+            activestyle = "none",
+            width = 90
+        )
+        self.cluster_list.bind('<<ListboxSelect>>', self.ev_cluster_list_Select)
+        self.cluster_list.pack(
+            side = tk.LEFT,
+            fill = tk.BOTH,
+            expand = True
+        )
+        
+        cluster_list_scroll = ttk.Scrollbar(list_fr)
+        cluster_list_scroll.pack(
+            side = tk.RIGHT,
+            fill = tk.Y
+        )
+        
+        # Link scrollbar <--> list
+        self.cluster_list.configure(yscrollcommand=cluster_list_scroll.set)
+        cluster_list_scroll.configure(command=self.cluster_list.yview)
+        
+        self.txt_samples = tk.Text(
+            master_fr,
+            height = census.MAX_SAMPLES,
+            width = 90
+        )
+        self.txt_samples.pack(fill=tk.X)
+        self.txt_samples.configure(state=tk.DISABLED)
+        
+        x = ttk.Button(
+            master_fr,
+            text="Create Template from Selected",
+            command = self.ev_but_CreateDraft
+        )
+        x.pack(side=tk.LEFT)
+    
+    #---------------------------------------------------------------
+    # Events
+    #---------------------------------------------------------------
+    def __init__(self, parent, S, create_draft):
+        self.S = S
+        self.clusters = S.get_clusters()
+        self.create_draft = create_draft # Called with a census.Cluster. Returns True if created
+        
+        title = "Folder Census"
+        tkext.Dialog.__init__(self, parent, title)
+    
+    def dlg_initialize(self):
+        self.lbl_summary.configure(text="%d files: %d form types, %d not forms, %d unreadable" % (
+            self.S.n_files, len(self.clusters), self.S.n_not_form, len(self.S.unreadable)
+        ))
+        self.refresh()
+    
+    def refresh(self):
+        self.cluster_list.delete(0, tk.END)
+        for i, C in enumerate(self.clusters):
+            if(len(C.templates)):
+                matched = "Template: " + ", ".join([T.name for T in C.templates])
+            else:
+                matched = "No template"
+            self.cluster_list.insert(tk.END, "%d files, %d pages, %d fields - %s - e.g. %s" % (
+                C.count, len(C.fingerprint), len(C.field_names), matched, os.path.basename(C.samples[0])
+            ))
+            if(len(C.templates) == 0):
+                self.cluster_list.itemconfig(i, foreground="dark orange")
+    
+    def ev_cluster_list_Select(self, ev):
+        idx = self.cluster_list.curselection()
+        if(len(idx) == 0):
+            return
+        C = self.clusters[int(idx[0])]
+        self.txt_samples.configure(state=tk.NORMAL)
+        self.txt_samples.delete(1.0, tk.END)
+        self.txt_samples.insert(tk.END, "\n".join(C.samples))
+        self.txt_samples.configure(state=tk.DISABLED)
+    
+    def ev_but_CreateDraft(self):
+        idx = self.cluster_list.curselection()
+        if(len(idx) == 0):
+            return
+        idx = int(idx[0])
+        C = self.clusters[idx]
+        if(len(C.templates)):
+            res = messagebox.askyesno(
+                title = "New Report Template",
+                message = "These forms already match %s. Create another template anyway?" % C.templates[0].name,
+                parent = self
+            )
+            if(not res):
+                return
+        if(self.create_draft(C)):
+            self.refresh()
+            self.cluster_list.selection_set(idx)
+
+#===================================================================================================
+class TemplatePicker(tkext.Dialog):
+    """ Selects several templates at once """
+    
+    #---------------------------------------------------------------
+    # Widgets
+    #---------------------------------------------------------------
+    def create_body(self, master_fr):
+        list_fr = ttk.Frame(
+            master_fr,
+            padding=3
+        )
+        list_fr.pack(
+            fill=tk.BOTH,
+            expand = True
+        )
+        
+        self.rt_list = tk.Listbox(
+            list_fr,
+            highlightthickness = 0,
+            selectmode = "multiple",
+            exportselection = False,
+            activestyle = "none",
+            width = 50
+        )
+        self.rt_list.pack(
+            side = tk.LEFT,
+            fill = tk.BOTH,
+            expand = True
+        )
+        
+        rt_list_scroll = ttk.Scrollbar(list_fr)
+        rt_list_scroll.pack(
+            side = tk.RIGHT,
+            fill = tk.Y
+        )
+        
+        # Link scrollbar <--> list
+        self.rt_list.configure(yscrollcommand=rt_list_scroll.set)
+        rt_list_scroll.configure(command=self.rt_list.yview)
+    
+    #---------------------------------------------------------------
+    # Events
+    #---------------------------------------------------------------
+    def __init__(self, parent, templates):
+        self.templates = templates
+        self.selected_templates = [] # dialog result
+        
+        title = "Select Report Templates"
+        tkext.Dialog.__init__(self, parent, title)
+    
+    def dlg_initialize(self):
+        for T in self.templates:
+            self.rt_list.insert(tk.END, T.name)
+    
+    def dlg_validate(self):
+        if(len(self.rt_list.curselection()) == 0):
+            messagebox.showerror(
+                title = "Select Templates",
+                message = "You must select at least one template."
+            )
+            return(False)
+        return(True)
+    
+    def dlg_apply(self):
+        self.selected_templates = [self.templates[int(idx)] for idx in self.rt_list.curselection()]
+
 #===================================================================================================
 class TemplateEditor(tkext.Dialog):
     
@@ -327,6 +735,9 @@ class TemplateEditor(tkext.Dialog):
         # "Report Entries" Tab
         self.tab_ReportEntries = TE_tab_ReportEntries(self.T, tabs)
         
+        # "Preview" Tab
+        self.tab_Preview = TE_tab_Preview(self.T, tabs)
+        
     #---------------------------------------------------------------
     # Dialog Events
     #---------------------------------------------------------------
@@ -413,6 +824,225 @@ class TE_tab_General:
         self.T.name = self.txt_name.get()
         self.T.description = self.txt_desc.get("1.0",'end-1c')
 
+class TE_tab_Preview:
+    """ Shows the rows the template makes from a sample of a folder or manifest """
+    
+    # The last sample taken. Kept when the editor is closed so that it does not have to be
+    # parsed again the next time
+    preview = None
+    
+    def __init__(self, Template, tab_book):
+        self.T = Template
+        self.tab_book = tab_book
+        self.tab_index = tab_book.index(tk.END)
+        
+        self.create_widgets(tab_book)
+        self.init_widgets()
+        
+        # Rows are remade whenever the tab is shown, to pick up edits in the other tabs
+        tab_book.bind("<<NotebookTabChanged>>", self.ev_tab_changed, add="+")
+    
+    def show(self):
+        self.tab_book.select(self.tab_index)
+        
+    def create_widgets(self, tab_book):
+        
+        tab_fr = ttk.Frame(tab_book, padding=5)
+        tab_book.add(tab_fr, text="Preview")
+        
+        # Sample settings
+        settings_fr = ttk.Frame(tab_fr)
+        settings_fr.pack(side=tk.TOP, fill=tk.X)
+        
+        x = ttk.Button(
+            settings_fr,
+            text="Sample Folder...",
+            command = self.ev_but_SampleDir
+        )
+        x.pack(side=tk.LEFT)
+        
+        x = ttk.Button(
+            settings_fr,
+            text="Sample Manifest...",
+            command = self.ev_but_SampleManifest
+        )
+        x.pack(side=tk.LEFT)
+        
+        x = ttk.Label(settings_fr, text="Group by")
+        x.pack(side=tk.LEFT, padx=(10,0))
+        self.cmb_strata = ttk.Combobox(
+            settings_fr,
+            state = 'readonly',
+            values = sampling.STRATA,
+            width = 8
+        )
+        self.cmb_strata.pack(side=tk.LEFT)
+        
+        x = ttk.Label(settings_fr, text="Seed")
+        x.pack(side=tk.LEFT, padx=(10,0))
+        self.txt_seed = ttk.Entry(settings_fr, width=6)
+        self.txt_seed.pack(side=tk.LEFT)
+        
+        x = ttk.Label(settings_fr, text="Files")
+        x.pack(side=tk.LEFT, padx=(10,0))
+        self.txt_count = ttk.Entry(settings_fr, width=6)
+        self.txt_count.pack(side=tk.LEFT)
+        
+        x = ttk.Button(
+            settings_fr,
+            text="Sample More",
+            command = self.ev_but_SampleMore
+        )
+        x.pack(side=tk.RIGHT)
+        
+        # Rows
+        rows_fr = ttk.Frame(tab_fr)
+        rows_fr.pack(side=tk.TOP, fill=tk.BOTH, expand=True)
+        
+        rows_scroll = ttk.Scrollbar(rows_fr)
+        rows_scroll.pack(side=tk.RIGHT, fill=tk.Y)
+        rows_xscroll = ttk.Scrollbar(rows_fr, orient=tk.HORIZONTAL)
+        rows_xscroll.pack(side=tk.BOTTOM, fill=tk.X)
+        
+        self.row_view = ttk.Treeview(
+            rows_fr,
+            show = "headings",
+            height = 12
+        )
+        self.row_view.tag_configure(sampling.ST_MISMATCH, foreground="gray")
+        self.row_view.tag_configure(sampling.ST_INVALID, foreground="gray")
+        self.row_view.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
+        
+        self.row_view.configure(yscrollcommand=rows_scroll.set, xscrollcommand=rows_xscroll.set)
+        rows_scroll.configure(command=self.row_view.yview)
+        rows_xscroll.configure(command=self.row_view.xview)
+        
+        self.lbl_status = ttk.Label(tab_fr)
+        self.lbl_status.pack(side=tk.TOP, fill=tk.X)
+        
+    def init_widgets(self):
+        self.cmb_strata.current(0)
+        self.txt_seed.insert(tk.END, "0")
+        self.txt_count.insert(tk.END, "25")
+        self.lbl_status.configure(text="No sample taken")
+        
+    def tab_validate(self):
+        return(True)
+        
+    def tab_apply(self):
+        pass
+    
+    #---------------------------------------------------------------
+    # Helpers
+    #---------------------------------------------------------------
+    def get_count(self):
+        try:
+            return(max(1, int(self.txt_count.get())))
+        except ValueError:
+            return(25)
+    
+    def take_sample(self, source):
+        strata = self.cmb_strata.get()
+        seed = self.txt_seed.get()
+        
+        def worker(dlg_if, source, strata, seed, n):
+            dlg_if.set_progress(0)
+            dlg_if.set_status1("Gathering files...")
+            S = sampling.Sampler(sampling.load_source(source), seed, strata)
+            if(dlg_if.stop_requested()):
+                return
+            TE_tab_Preview.preview = sampling.Preview(S)
+            self.extend(dlg_if, n)
+        
+        args={'source':source, 'strata':strata, 'seed':seed, 'n':self.get_count()}
+        x = tkext.ProgressBox(
+            job_func = worker,
+            job_data = args,
+            parent = self.tab_book.winfo_toplevel(),
+            title = "Sampling..."
+        )
+        self.refresh()
+    
+    def extend(self, dlg_if, n):
+        for n_done, f in enumerate(self.preview.iter_extend(n)):
+            dlg_if.set_status1("Parsing sample: %d/%d" % (n_done + 1, n))
+            dlg_if.set_status2(trim_path(f, 50))
+            dlg_if.set_progress(100*n_done/n)
+            if(dlg_if.stop_requested()):
+                return
+    
+    def refresh(self):
+        """ Remakes the preview rows from the sampled forms """
+        self.row_view.delete(*self.row_view.get_children())
+        if(self.preview == None):
+            return
+        
+        try:
+            headings, results = self.preview.get_rows(self.T)
+        except ValueError as E:
+            self.lbl_status.configure(text="Template has errors: %s" % E)
+            return
+        
+        columns = ["File"] + list(headings)
+        self.row_view.configure(columns=columns)
+        for i, h in enumerate(columns):
+            self.row_view.heading(i, text=h)
+            self.row_view.column(i, width=120, stretch=False)
+        
+        n_match = 0
+        for filename, status, row in results:
+            name = os.path.basename(filename)
+            if(status == sampling.ST_MATCH):
+                n_match = n_match + 1
+                values = [name] + ["" if v == None else v for v in row]
+            elif(status == sampling.ST_MISMATCH):
+                values = [name, "(does not match the template)"]
+            else:
+                values = [name, "(not a form)"]
+            self.row_view.insert("", tk.END, values=values, tags=(status,))
+        
+        self.lbl_status.configure(text="%s. %d match the template" % (self.preview.get_summary(), n_match))
+    
+    #---------------------------------------------------------------
+    # Widget Events
+    #---------------------------------------------------------------
+    def ev_tab_changed(self, ev):
+        if(self.tab_book.index("current") == self.tab_index):
+            self.refresh()
+    
+    def ev_but_SampleDir(self):
+        dir = filedialog.askdirectory(
+            mustexist = True,
+            title = 'Select a Folder of PDFs'
+        )
+        if(dir):
+            self.take_sample(os.path.abspath(dir))
+    
+    def ev_but_SampleManifest(self):
+        filename = filedialog.askopenfilename(
+            filetypes = [('Manifest', '.txt'), ('All files', '*')],
+            title = 'Select a Manifest'
+        )
+        if(filename):
+            self.take_sample(filename)
+    
+    def ev_but_SampleMore(self):
+        if((self.preview == None) or self.preview.sampler.is_exhausted()):
+            return
+        
+        def worker(dlg_if, n):
+            dlg_if.set_progress(0)
+            self.extend(dlg_if, n)
+        
+        args={'n':self.get_count()}
+        x = tkext.ProgressBox(
+            job_func = worker,
+            job_data = args,
+            parent = self.tab_book.winfo_toplevel(),
+            title = "Sampling..."
+        )
+        self.refresh()
+
 class TE_tab_ReportEntries:
     def __init__(self, Template, tab_book):
         self.T = Template
@@ -549,6 +1179,17 @@ class TE_tab_ReportEntries:
             self.entry_list.insert(tk.END, e.name)
         
     def tab_validate(self):
+        # Computed columns are parsed and their column references are checked
+        try:
+            self.T.validate()
+        except ValueError as E:
+            messagebox.showerror(
+                title = "Report Columns",
+                message = str(E)
+            )
+            self.show()
+            return(False)
+        
         return(True)
         
     # FYI: NOT the apply button, but the apply event when OKing the dialog window
@@ -733,6 +1374,42 @@ class FormImporter(tk.Tk):
     def create_widgets(self):
         self.title("Import Forms: %s" % self.T.name)
         
+        #--------------------------------------------------------
+        # Filter
+        filter_fr = ttk.Frame(
+            self,
+            padding=3
+        )
+        filter_fr.pack(
+            side = tk.TOP,
+            fill=tk.X
+        )
+        
+        x = ttk.Label(filter_fr, text="Filter")
+        x.pack(side=tk.LEFT)
+        
+        self.txt_filter = ttk.Entry(filter_fr)
+        self.txt_filter.bind("<Return>", self.ev_txt_filter_Return)
+        self.txt_filter.pack(
+            side = tk.LEFT,
+            fill = tk.X,
+            expand = True
+        )
+        
+        x = ttk.Button(
+            filter_fr,
+            text="Clear",
+            command = self.ev_but_clear_filter
+        )
+        x.pack(side=tk.RIGHT)
+        
+        x = ttk.Button(
+            filter_fr,
+            text="Apply",
+            command = self.ev_but_apply_filter
+        )
+        x.pack(side=tk.RIGHT)
+        
         #--------------------------------------------------------
         # File List
         file_list_fr = ttk.Frame(
@@ -811,6 +1488,36 @@ class FormImporter(tk.Tk):
         )
         x.pack(side=tk.RIGHT)
         
+        self.export_stats_var = tk.BooleanVar(self, value=False)
+        x = ttk.Checkbutton(
+            bottom_buttons_fr,
+            text="Add column statistics",
+            variable = self.export_stats_var
+        )
+        x.pack(side=tk.RIGHT)
+        
+        #--------------------------------------------------------
+        # Export status
+        status_fr = ttk.Frame(
+            self,
+            padding=3
+        )
+        status_fr.pack(
+            side = tk.TOP,
+            fill=tk.X
+        )
+        
+        self.but_cancel_export = ttk.Button(
+            status_fr,
+            text="Cancel Export",
+            command = self.ev_but_cancel_export,
+            state = tk.DISABLED
+        )
+        self.but_cancel_export.pack(side=tk.RIGHT)
+        
+        self.lbl_status = ttk.Label(status_fr, text="")
+        self.lbl_status.pack(side=tk.LEFT, fill=tk.X, expand=True)
+        
         # window is not allowed to be any smaller than default
         self.update_idletasks() #Give Tk a chance to update widgets and figure out the window size
         self.minsize(self.winfo_width(), self.winfo_height())
@@ -821,69 +1528,396 @@ class FormImporter(tk.Tk):
     #---------------------------------------------------------------
     
     def set_selection(self, idx):
-        if(len(self.Forms) == 0):
+        if(len(self.shown) == 0):
             # List is empty
             return
-        elif(idx >= len(self.Forms)):
-            idx = len(self.Forms) - 1
+        elif(idx >= len(self.shown)):
+            idx = len(self.shown) - 1
         
         self.file_list.selection_clear(0,tk.END)
         self.file_list.selection_set(idx)
         self.file_list.see(idx)
         
-    def add_form(self, filename):
-        
-        # check if it already exists
-        for f in self.Forms:
-            if(f.filename == filename):
-                return
-        
-        log.info("Loading: %s" % filename)
-        F = form_data.FormData(filename)
-        
+    def insert_form(self, F):
+        """ Adds a FormSummary or PendingForm object to the list """
         self.Forms.append(F)
-        self.file_list.insert(tk.END, F.filename)
+        self.form_index[F.filename] = F
+        if(F.valid and isinstance(F, form_data.FormSummary)):
+            self.value_index.add(F.key, F.row)
         
-        # Validate the form
-        if(F.valid):
-            if(self.T.is_matching_form(F) == False):
-                log.warning("Form fingerprint mismatch. Not valid: %s" % F.filename)
-                F.valid = False
+        if((len(self.filter) == 0) or self.is_filtered_in(F, self.filter)):
+            self.show_form(F)
+    
+    def is_filtered_in(self, F, conditions):
+        """ Forms without a row can not satisfy a filter """
+        return(F.valid and isinstance(F, form_data.FormSummary) and self.value_index.matches(F.key, conditions))
+    
+    def show_form(self, F):
+        """ Adds a form to the end of the visible list """
+        self.shown.append(F)
+        self.file_list.insert(tk.END, F.filename)
         
-        if(not F.valid):
+        if(F.filename in self.near_misses):
+            self.file_list.itemconfigure(tk.END, background="orange")
+        elif(not F.valid):
             self.file_list.itemconfigure(tk.END, background="red")
+    
+    def check_near_miss(self, F):
+        """ Looks for templates that are close to a form that did not match.
+        Returns a list of (similarity, template) """
+        if(self.template_index == None):
+            return([])
+        
+        near = self.template_index.query(F.get_field_names())
+        if(len(near)):
+            self.near_misses[F.filename] = near
+            log.warning("Closest templates to %s: %s" % (
+                F.filename,
+                ", ".join(["'%s' (%d%%)" % (T.name, 100*score) for score, T in near])
+            ))
+        return(near)
+    
+    def add_scanned(self, result):
+        """ Adds a form from the result of a form_scan.Scanner. Its values are not extracted yet.
+        If it was already loaded, the existing object is returned instead """
+        filename, status, field_names = result
+        if(filename in self.form_index):
+            return(self.form_index[filename])
+        
+        F = form_data.PendingForm(filename, (status == batch.STATUS_OK), field_names)
+        if(status == batch.STATUS_MISMATCH):
+            log.warning("Form fingerprint mismatch. Not valid: %s" % filename)
+            if(field_names != None):
+                self.check_near_miss(F)
+        
+        self.insert_form(F)
+        return(F)
+    
+    def add_summary(self, filename, valid, row):
+        """ Adds a form that was already scanned or extracted earlier """
+        if(filename in self.form_index):
+            return
+        if(valid and (row == None)):
+            self.insert_form(form_data.PendingForm(filename, True))
+        else:
+            self.insert_form(self.make_summary(filename, row if valid else None))
+    
+    def make_summary(self, filename, row):
+        """ Stores a form's report row. Constant and computed columns are filled in first, so the
+        stored row can be filtered on. A form without a row is not valid """
+        if(row == None):
+            return(form_data.FormSummary(filename, False))
+        row = self.plan.fill_computed(self.plan.fill_constants(row))
+        return(form_data.FormSummary(filename, True, row, self.row_store))
+    
+    def get_row(self, plan, F):
+        """ Returns the report row of a FormSummary or PendingForm object """
+        if(isinstance(F, form_data.PendingForm)):
+            # Not extracted yet. Does not update the list, since this can run on any thread
+            status, row = form_scan.read_row(plan, F.filename)
+            if(status != batch.STATUS_OK):
+                return(None)
+            return(row)
+        
+        row = F.row
+        if(row == None):
+            # Removed while it was being exported
+            return(None)
+        return(plan.fill_constants(row))
+    
+    def get_pending(self, forms):
+        """ Returns the forms that matched but were not extracted yet """
+        return([F for F in forms if F.valid and isinstance(F, form_data.PendingForm)])
+    
+    def apply_rows(self, results):
+        """ Replaces pending forms with the rows that were extracted for them.
+        results maps filename --> (status, row) """
+        for i, F in enumerate(self.Forms):
+            if((F.filename not in results) or not isinstance(F, form_data.PendingForm)):
+                continue
+            status, row = results[F.filename]
+            if(status != batch.STATUS_OK):
+                log.warning("Could not extract values from %s: %s" % (F.filename, status))
+                row = None
+            S = self.make_summary(F.filename, row)
+            self.Forms[i] = S
+            self.form_index[S.filename] = S
+            if(S.valid):
+                self.value_index.add(S.key, S.row)
+        
+        for i, F in enumerate(self.shown):
+            if((F.filename in results) and isinstance(F, form_data.PendingForm)):
+                S = self.form_index.get(F.filename)
+                if(S == None):
+                    continue
+                self.shown[i] = S
+                if(not S.valid):
+                    self.file_list.itemconfigure(i, background="red")
+    
+    def extract_forms(self, dlg_if, forms):
+        """ Extracts the values of pending forms in parallel. Call from a ProgressBox worker """
+        filenames = [F.filename for F in forms]
+        n_found = len(filenames)
+        results = {}
+        journals = {}
+        try:
+            rows = form_scan.iter_rows(self.plan, filenames)
+            for n_done, (f, status, row) in enumerate(rows):
+                dlg_if.set_status1("Extracting values: %d/%d" % (n_done + 1, n_found))
+                dlg_if.set_status2(trim_path(f, 50))
+                dlg_if.set_progress(100*n_done/n_found)
+                if(dlg_if.stop_requested()):
+                    return
+                results[f] = (status, row)
+                self.journal_row(journals, f, status, row)
+        finally:
+            for J in journals.values():
+                if(J != None):
+                    J.close()
+            # Keep whatever was extracted before a cancel
+            self.apply_rows(results)
+    
+    def journal_row(self, journals, filename, status, row):
+        """ Records an extracted row in the journal of the folder import the form came from.
+        journals maps journal path --> open Journal, or None if it could not be opened """
+        entry = self.journaled.pop(filename, None)
+        if(entry == None):
+            return
+        path, idx = entry
+        
+        if(path not in journals):
+            try:
+                journals[path] = journal.Journal(path)
+            except (OSError, ValueError, KeyError) as E:
+                log.warning("Could not read journal '%s': %s" % (path, E))
+                journals[path] = None
+        J = journals[path]
+        
+        # The folder may have been imported again since, with a new journal
+        if((J == None) or (idx >= len(J.filenames)) or (J.filenames[idx] != filename)):
+            return
+        J.record_result(idx, status, row)
+    
+    def extract_pending(self, forms):
+        """ Extracts the values of the pending forms among forms, with a progress box.
+        Returns False if any are still pending afterwards (cancelled) """
+        pending = self.get_pending(forms)
+        if(len(pending) == 0):
+            return(True)
+        
+        def worker(dlg_if, forms):
+            dlg_if.set_progress(0)
+            self.extract_forms(dlg_if, forms)
         
+        args={'forms':pending}
+        x = tkext.ProgressBox(
+            job_func = worker,
+            job_data = args,
+            parent = self,
+            title = "Extracting Values..."
+        )
+        
+        return(len(self.get_pending([self.form_index.get(F.filename, F) for F in pending])) == 0)
+    
+    def get_journal_path(self, start_dir):
+        key = "%s\n%s" % (self.T.name, start_dir)
+        return(os.path.join(JOURNAL_DIR, "%08x.journal" % pdf_parser.fnv_hash32(key)))
+    
+    def open_journal(self, start_dir, plan):
+        """ Returns the journal of an unfinished import of start_dir, if the user wants to resume
+        it. Otherwise returns None """
+        path = self.get_journal_path(start_dir)
+        if(not os.path.exists(path)):
+            return(None)
+        
+        try:
+            J = journal.Journal(path)
+        except (OSError, ValueError, KeyError) as E:
+            log.warning("Could not read journal '%s': %s" % (path, E))
+            return(None)
+        
+        if((J.headings != list(plan.headings)) or J.is_complete()):
+            # Template was changed since, or there is nothing left to do
+            J.close()
+            return(None)
+        
+        res = messagebox.askyesno(
+            title = "Resume Import",
+            message = "A previous import of this folder stopped after %d of %d files.\n\nResume it?"
+                      % (J.count_done(), len(J.filenames)),
+            parent = self
+        )
+        if(not res):
+            J.close()
+            return(None)
+        return(J)
+    
     def remove_form(self, idx):
-        if(len(self.Forms) == 0):
+        """ Removes the form at position idx of the visible list """
+        if(len(self.shown) == 0):
             # List is empty
             return
-        elif(idx >= len(self.Forms)):
+        elif(idx >= len(self.shown)):
             return
         
-        del self.Forms[idx]
+        F = self.shown[idx]
+        if(isinstance(F, form_data.FormSummary)):
+            # The index reads the row back to remove it, so it goes first
+            if(F.valid):
+                self.value_index.remove(F.key)
+            F.discard()
+        del self.form_index[F.filename]
+        self.near_misses.pop(F.filename, None)
+        self.Forms.remove(F)
+        del self.shown[idx]
         self.file_list.delete(idx)
         self.set_selection(idx)
+    
+    def set_filter(self, conditions):
+        """ Shows only the forms whose report rows satisfy the value_index conditions.
+        An empty list shows all forms """
+        self.filter = conditions
+        if(len(conditions)):
+            keys = self.value_index.query(conditions)
+        
+        self.shown = []
+        self.file_list.delete(0, tk.END)
+        for F in self.Forms:
+            if((len(conditions) == 0) or (isinstance(F, form_data.FormSummary) and F.valid and (F.key in keys))):
+                self.show_form(F)
+        self.set_selection(0)
         
     #---------------------------------------------------------------
     # Events
     #---------------------------------------------------------------
-    def __init__(self, parent, Template):
+    def __init__(self, parent, Template, templates = None):
         self.T = Template
+        
+        try:
+            self.plan = self.T.compile()
+        except ValueError as E:
+            # Template can not be used. Say why and close again
+            tk.Tk.__init__(self, parent)
+            self.withdraw()
+            messagebox.showerror(
+                title = "Import Forms",
+                message = "Template '%s' can not be used:\n\n%s" % (self.T.name, E),
+                parent = self
+            )
+            self.after_idle(self.destroy)
+            return
+        
         self.Forms = []
+        self.form_index = {} # filename --> object in Forms
+        self.shown = [] # Forms that pass the filter, in the order of the list widget
+        
+        # Forms that do not match are compared against all templates, to catch revised forms
+        self.template_index = None
+        if(templates != None):
+            self.template_index = template_index.TemplateIndex(templates)
+        self.near_misses = {} # filename --> [(similarity, template), ...]
+        
+        # Imports are two-phase. A scan checks which files match, and the report rows of the
+        # matching forms are only extracted when they are needed (see form_scan). Only the row of
+        # each form is kept, packed in the template's column layout (see form_data.FieldSchema).
+        # Rows beyond the memory budget are spilled to a temporary file
+        self.row_store = row_store.RowStore(schema = form_data.FieldSchema(self.plan.headings))
+        
+        # Pending forms from a folder import. Their rows are added to that import's journal once
+        # they are extracted, so a resumed import does not have to extract them again
+        self.journaled = {} # filename --> (journal path, index in its manifest)
+        
+        # Report rows of the valid forms are indexed so the list can be filtered by value
+        self.value_index = value_index.ValueIndex(self.plan.headings, self.row_store)
+        self.filter = []
+        
+        # Files that were rejected before are remembered between sessions
+        os.makedirs(JOURNAL_DIR, exist_ok=True)
+        self.prefilter = prefilter.Prefilter.from_plan(
+            self.plan,
+            cache_path = os.path.join(JOURNAL_DIR, "rejects.cache")
+        )
+        
+        # Export that is running in the background, if any
+        self.export_job = None
+        
+        # Files whose values are being read on a background thread for the status bar
+        self.row_reads = set()
         
         tk.Tk.__init__(self, parent)
         self.create_widgets()
+        self.protocol("WM_DELETE_WINDOW", self.ev_close)
         
     def ev_file_list_Select(self, ev):
         idx = self.file_list.curselection()
         if(len(idx) == 0):
             return
         idx = int(idx[0])
+        
+        F = self.shown[idx]
+        if(F.filename in self.near_misses):
+            self.title("Import Forms: %s - Closest templates: %s" % (
+                self.T.name,
+                ", ".join(["%s (%d%%)" % (T.name, 100*score) for score, T in self.near_misses[F.filename]])
+            ))
+        else:
+            self.title("Import Forms: %s" % self.T.name)
+        
+        if(isinstance(F, form_data.PendingForm) and F.valid):
+            # Values are extracted on demand. This is done on a thread, since the file can be
+            # far into a compressed tar
+            self.start_row_read(F.filename)
+            return
+        self.show_row(F)
+    
+    def show_row(self, F):
+        """ Shows the values of a form in the status bar """
+        if(((self.export_job == None) or not self.export_job.is_running()) and
+           isinstance(F, form_data.FormSummary) and F.valid):
+            row = self.get_row(self.plan, F)
+            text = ", ".join(["%s: %s" % (h, v) for h, v in zip(self.plan.headings, row)])
+            if(len(text) > 200):
+                text = text[:197] + "..."
+            self.lbl_status.configure(text=text)
+    
+    def start_row_read(self, filename):
+        if(filename in self.row_reads):
+            return
+        self.row_reads.add(filename)
+        if((self.export_job == None) or not self.export_job.is_running()):
+            self.lbl_status.configure(text="Reading %s..." % trim_path(filename, 50))
+        
+        plan = self.plan
+        result = []
+        def worker():
+            try:
+                result.append(form_scan.read_row(plan, filename))
+            except Exception:
+                log.exception("Failed to read '%s'" % filename)
+        th = threading.Thread(target=worker, daemon=True)
+        th.start()
+        self.after(50, self.poll_row_read, filename, plan, th, result)
+    
+    def poll_row_read(self, filename, plan, th, result):
+        if(th.is_alive()):
+            self.after(50, self.poll_row_read, filename, plan, th, result)
+            return
+        self.row_reads.discard(filename)
+        
+        # Dropped if the template changed meanwhile
+        if((plan is not self.plan) or (len(result) == 0)):
+            return
+        self.apply_rows({filename: result[0]})
+        
+        # Shown if it is still selected
+        idx = self.file_list.curselection()
+        if(len(idx) and (self.shown[int(idx[0])].filename == filename)):
+            self.show_row(self.form_index.get(filename))
     
     def ev_but_import(self):
         options = {}
         options['defaultextension'] = '.pdf'
-        options['filetypes'] = [('PDF files', '.pdf')]
+        options['filetypes'] = [('PDF files', '.pdf')] + archives.FILETYPES
         options['parent'] = self
         options['title'] = 'Open...'
         
@@ -895,17 +1929,26 @@ class FormImporter(tk.Tk):
         # define a separate worker function to import the PDFs
         def worker(dlg_if, filenames):
             dlg_if.set_progress(0)
+            
+            # PDFs inside archives are read straight out of them
+            dlg_if.set_status1("Gathering files...")
+            filenames = archives.expand([os.path.abspath(f) for f in filenames])
             n_found = len(filenames)
-            n_done = 0;
             
-            for f in filenames:
-                dlg_if.set_status1("Processing files: %d/%d" % (n_done + 1, n_found))
+            # Only check which files match for now. Values are extracted when they are needed
+            S = form_scan.Scanner(self.plan, self.prefilter)
+            added = []
+            for n_done, result in enumerate(S.iter_scan(filenames)):
+                f = result[0]
+                dlg_if.set_status1("Scanning files: %d/%d" % (n_done + 1, n_found))
                 dlg_if.set_status2(trim_path(f, 50))
                 dlg_if.set_progress(100*n_done/n_found)
                 if(dlg_if.stop_requested()):
-                    return
-                f = os.path.abspath(f)
-                self.add_form(f)
+                    break
+                added.append(self.add_scanned(result))
+            self.plan.widget_map = S.widget_map
+            
+            self.refresh_filter(dlg_if, added)
         
         # Start the job
         args={'filenames':filenames}
@@ -929,34 +1972,85 @@ class FormImporter(tk.Tk):
             return
         dir = os.path.abspath(dir)
         
+        plan = self.T.compile()
+        J = self.open_journal(dir, plan)
+        
         # define a separate worker function to import the PDFs
-        def worker(dlg_if, start_dir):
+        def worker(dlg_if, start_dir, J):
             dlg_if.set_progress(0)
-            dlg_if.set_status1("Gathering files...")
-            n_found = 0
             
-            matches = []
-            for root, dirnames, filenames in os.walk(dir):
-                if(dlg_if.stop_requested()):
-                    return
-                for filename in fnmatch.filter(filenames, '*.pdf'):
-                    matches.append(os.path.join(root, filename))
-                    n_found = n_found + 1
-                    dlg_if.set_status2("Found: %d" % n_found)
-            
-            n_done = 0
-            for f in matches:
-                dlg_if.set_status1("Processing files: %d/%d" % (n_done + 1, n_found))
-                dlg_if.set_status2(trim_path(f, 50))
-                dlg_if.set_progress(100*n_done/n_found)
+            if(J == None):
+                dlg_if.set_status1("Gathering files...")
+                n_found = 0
                 
-                if(dlg_if.stop_requested()):
-                    return
-                self.add_form(f)
-                n_done = n_done + 1
+                matches = []
+                for root, dirnames, filenames in os.walk(start_dir):
+                    if(dlg_if.stop_requested()):
+                        return
+                    for filename in filenames:
+                        if(fnmatch.fnmatch(filename, '*.pdf') or archives.is_archive(filename)):
+                            matches.append(os.path.join(root, filename))
+                            n_found = n_found + 1
+                            dlg_if.set_status2("Found: %d" % n_found)
+                
+                # Look inside any archives
+                matches = archives.expand(matches)
+                
+                os.makedirs(JOURNAL_DIR, exist_ok=True)
+                J = journal.Journal.create(self.get_journal_path(start_dir), matches, plan.headings)
+                pending = J.get_pending()
+            else:
+                # Restore what the previous run already scanned or extracted. A form's row is
+                # recorded after its scan result, so only the latest result of each file is read
+                dlg_if.set_status1("Restoring previous import...")
+                pending = J.get_pending()
+                for idx, status, row in J.iter_results(skip = set(pending)):
+                    f = J.filenames[idx]
+                    self.add_summary(f, (status == batch.STATUS_OK), row)
+                    if(isinstance(self.form_index.get(f), form_data.PendingForm)):
+                        self.journaled[f] = (J.path, idx)
+                
+                # Files that were tried too often are not retried. Show them as failed
+                for idx in J.get_abandoned():
+                    log.warning("Gave up on '%s' after %d attempts" % (J.filenames[idx], J.attempts[idx]))
+                    self.add_summary(J.filenames[idx], False, None)
+            
+            # Only check which files match for now. Values are extracted when they are needed.
+            # The journal records the scan results without rows. Each file is marked as begun
+            # when it is handed to the scan, and its row is added once it is extracted
+            added = []
+            S = form_scan.Scanner(self.plan, self.prefilter)
+            try:
+                n_found = len(pending)
+                results = S.iter_scan(
+                    [J.filenames[idx] for idx in pending],
+                    begin = lambda n: J.record_begin(pending[n])
+                )
+                for n_done, (idx, result) in enumerate(zip(pending, results)):
+                    f, status, field_names = result
+                    dlg_if.set_status1("Scanning files: %d/%d" % (n_done + 1, n_found))
+                    dlg_if.set_status2(trim_path(f, 50))
+                    dlg_if.set_progress(100*n_done/n_found)
+                    
+                    if(dlg_if.stop_requested()):
+                        break
+                    
+                    if(status == batch.STATUS_FAILED):
+                        J.record_result(idx, batch.STATUS_FAILED)
+                        continue
+                    F = self.add_scanned(result)
+                    added.append(F)
+                    J.record_result(idx, status)
+                    if(isinstance(F, form_data.PendingForm) and F.valid):
+                        self.journaled[f] = (J.path, idx)
+            finally:
+                J.close()
+                self.plan.widget_map = S.widget_map
+            
+            self.refresh_filter(dlg_if, added)
         
         # Start the job
-        args={'start_dir':dir}
+        args={'start_dir':dir, 'J':J}
         x = tkext.ProgressBox(
             job_func = worker,
             job_data = args,
@@ -966,6 +2060,39 @@ class FormImporter(tk.Tk):
         
         self.set_selection(len(self.Forms)-1)
         
+    def refresh_filter(self, dlg_if, forms):
+        """ Forms that were just scanned can not be filtered by value. If a filter is set, their
+        values are extracted right away. Call from a ProgressBox worker """
+        if(len(self.filter) == 0):
+            return
+        pending = self.get_pending(forms)
+        if(len(pending)):
+            self.extract_forms(dlg_if, pending)
+            self.set_filter(self.filter)
+    
+    def ev_txt_filter_Return(self, ev):
+        self.ev_but_apply_filter()
+    
+    def ev_but_apply_filter(self):
+        try:
+            conditions = value_index.parse_query(self.txt_filter.get(), self.plan.headings)
+        except ValueError as E:
+            messagebox.showerror(
+                title = "Filter",
+                message = "%s\n\nExamples:\n  City = Toronto\n  Name ^= Al\n  Postcode is empty\n  City != Toronto & Postcode is not empty\n  Company = \"Smith & Sons\"" % E,
+                parent = self
+            )
+            return
+        
+        # Filtering by value needs every form's values
+        if(len(conditions) and not self.extract_pending(self.Forms)):
+            return
+        self.set_filter(conditions)
+    
+    def ev_but_clear_filter(self):
+        self.txt_filter.delete(0, tk.END)
+        self.set_filter([])
+    
     def ev_but_remove(self):
         idx = self.file_list.curselection()
         if(len(idx)):
@@ -973,6 +2100,13 @@ class FormImporter(tk.Tk):
             self.remove_form(idx)
         
     def ev_but_export(self):
+        if((self.export_job != None) and self.export_job.is_running()):
+            messagebox.showinfo(
+                title = "Export to Excel",
+                message = "An export is already running.",
+                parent = self
+            )
+            return
         
         options = {}
         options['defaultextension'] = '.xlsx'
@@ -983,13 +2117,52 @@ class FormImporter(tk.Tk):
         if(not filename):
             return
         
-        TBL = report_template.DataTable()
-        TBL.init_blank(self.T)
+        # Only the forms that pass the filter are exported. The rows are built and written on
+        # a background thread, so importing can continue meanwhile
+        # Values that were not extracted yet are extracted in parallel first
+        if(not self.extract_pending(self.shown)):
+            return
+        forms = [form for form in self.shown if form.valid]
+        self.export_job = export_job.ExportJob(
+            self.T.compile(), forms, filename, self.get_row,
+            stats = self.export_stats_var.get()
+        )
+        self.export_job.start()
+        self.but_cancel_export.configure(state=tk.NORMAL)
+        self.poll_export()
+    
+    def poll_export(self):
+        J = self.export_job
+        if(J == None):
+            return
+        self.lbl_status.configure(text=J.get_status_text())
         
-        for form in self.Forms:
-            if(form.valid):
-                form_report = self.T.create_report(form)
-                TBL.append_row(form_report)
+        if(J.is_running()):
+            self.after(250, self.poll_export)
+            return
         
-        TBL.export_excel(filename)
+        self.but_cancel_export.configure(state=tk.DISABLED)
+        if(J.state == export_job.ST_FAILED):
+            messagebox.showerror(
+                title = "Export to Excel",
+                message = "Export failed:\n%s" % J.error,
+                parent = self
+            )
+    
+    def ev_but_cancel_export(self):
+        if(self.export_job != None):
+            self.export_job.cancel()
+    
+    def ev_close(self):
+        if((self.export_job != None) and self.export_job.is_running()):
+            res = messagebox.askyesno(
+                title = "Export in Progress",
+                message = "An export is still running. Cancel it and close?",
+                parent = self
+            )
+            if(not res):
+                return
+            self.export_job.cancel()
+            self.export_job.join()
+        self.destroy()
 
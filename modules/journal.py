@@ -0,0 +1,248 @@
+####################################################################################################
+# The MIT License (MIT)
+#
+# Copyright (c) 2015, Alexander I. Mykyta
+# All rights reserved.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+####################################################################################################
+
+# Append-only journal for long-running import jobs
+#
+# <name>.manifest   One filename per line. Written once when the job is created
+# <name>            JSON lines. A header, then a "begin" record before each file is processed
+#                   and a "result" record (status + report row) after it
+# <name>.ckpt       Status of every file, where its latest result record is, and the journal
+#                   offset it is valid up to. Rewritten periodically so a restart only replays
+#                   the tail of the journal, and only reads the latest result of each file
+#
+# A crash can only lose the record that was being written. A partial last line is cut off
+# when the journal is reopened.
+
+import os
+import json
+import time
+import array
+import logging
+
+from . import batch
+
+log = logging.getLogger("journal")
+
+# Per-file status codes, stored one byte per file
+ST_PENDING = 0
+ST_OK = 1
+ST_MISMATCH = 2
+ST_INVALID = 3
+ST_FAILED = 4
+
+STATUS_CODES = {
+    batch.STATUS_OK: ST_OK,
+    batch.STATUS_MISMATCH: ST_MISMATCH,
+    batch.STATUS_INVALID: ST_INVALID,
+    batch.STATUS_FAILED: ST_FAILED
+}
+
+DEFAULT_MAX_ATTEMPTS = 3
+
+#===================================================================================================
+class Journal:
+    """ Status and results of a batch job, persisted so it can be resumed after a crash """
+
+    # Checkpoint after this many records or seconds, whichever comes first
+    CHECKPOINT_RECORDS = 1000
+    CHECKPOINT_SECONDS = 30
+
+    def __init__(self, path):
+        self.path = path
+        self.filenames = batch.read_manifest(path + ".manifest")
+        n = len(self.filenames)
+
+        self.status = bytearray(n)
+        self.attempts = bytearray(n) # Number of times processing of a file was started
+        self.result_at = array.array('q', [-1]) * n # Offset of each file's latest result record
+
+        with open(path, 'rb') as f:
+            header = json.loads(f.readline().decode("utf-8"))
+            self.header_end = f.tell()
+        self.headings = header['headings']
+
+        self.replay()
+
+        self.fp = open(path, 'ab')
+        self.n_unsaved = 0
+        self.last_checkpoint = time.time()
+
+    @classmethod
+    def create(cls, path, filenames, headings):
+        """ Starts a new journal, replacing any existing one """
+        if(os.path.exists(path + ".ckpt")):
+            os.remove(path + ".ckpt")
+
+        batch.write_manifest(path + ".manifest", filenames)
+
+        header = {
+            't': "job",
+            'n_files': len(filenames),
+            'headings': list(headings)
+        }
+        with open(path, 'wb') as f:
+            f.write(json.dumps(header).encode("utf-8") + b"\n")
+
+        return(cls(path))
+
+    #--------------------------------------------------------------------------
+    def replay(self):
+        """ Restores the file status from the checkpoint and the journal records after it """
+        offset = self.header_end
+        n = len(self.filenames)
+
+        try:
+            with open(self.path + ".ckpt", 'rb') as f:
+                ckpt = json.loads(f.readline().decode("utf-8"))
+                status = f.read(n)
+                attempts = f.read(n)
+                result_at = f.read(8 * n)
+            if((ckpt['n_files'] == n) and (len(status) == n) and (len(attempts) == n)
+               and (len(result_at) == 8 * n)):
+                offset = ckpt['offset']
+                self.status[:] = status
+                self.attempts[:] = attempts
+                self.result_at = array.array('q', result_at)
+        except (FileNotFoundError, ValueError, KeyError):
+            pass
+
+        with open(self.path, 'rb') as f:
+            f.seek(offset)
+            good_end = offset
+            for line in f:
+                if(not line.endswith(b"\n")):
+                    break
+                try:
+                    rec = json.loads(line.decode("utf-8"))
+                except ValueError:
+                    break
+                self.apply(rec, good_end)
+                good_end = good_end + len(line)
+            file_end = f.seek(0, os.SEEK_END)
+
+        if(good_end != file_end):
+            # Partial record from a crash. Drop it
+            log.warning("Discarding incomplete record at the end of %s" % self.path)
+            with open(self.path, 'r+b') as f:
+                f.truncate(good_end)
+
+    def apply(self, rec, offset):
+        """ Applies a record that was written at offset """
+        i = rec['i']
+        if(rec['t'] == "b"):
+            self.attempts[i] = min(self.attempts[i] + 1, 255)
+        elif(rec['t'] == "r"):
+            self.status[i] = STATUS_CODES[rec['s']]
+            self.result_at[i] = offset
+
+    def iter_results(self, skip = ()):
+        """ Yields (index, status, row) of the latest result of each file, in file order.
+        Only those records are read. Files in skip are left out """
+        with open(self.path, 'rb') as f:
+            for i, offset in enumerate(self.result_at):
+                if((offset < 0) or (i in skip)):
+                    continue
+                f.seek(offset)
+                rec = json.loads(f.readline().decode("utf-8"))
+                yield((i, rec['s'], rec.get('row')))
+
+    #--------------------------------------------------------------------------
+    def get_abandoned(self, max_attempts = DEFAULT_MAX_ATTEMPTS):
+        """ Returns indexes of files that were not processed successfully, and are not retried
+        any more since they have been attempted max_attempts times """
+        abandoned = []
+        for i in range(len(self.filenames)):
+            if((self.status[i] == ST_PENDING) or (self.status[i] == ST_FAILED)):
+                if(self.attempts[i] >= max_attempts):
+                    abandoned.append(i)
+        return(abandoned)
+
+    def get_pending(self, max_attempts = DEFAULT_MAX_ATTEMPTS):
+        """ Returns indexes of files that still need to be processed.
+        Files that failed, or that were being processed during a crash, are retried until they
+        have been attempted max_attempts times """
+        pending = []
+        for i in range(len(self.filenames)):
+            if((self.status[i] == ST_PENDING) or (self.status[i] == ST_FAILED)):
+                if(self.attempts[i] < max_attempts):
+                    pending.append(i)
+        return(pending)
+
+    def is_complete(self, max_attempts = DEFAULT_MAX_ATTEMPTS):
+        return(len(self.get_pending(max_attempts)) == 0)
+
+    def count_done(self):
+        return(len(self.filenames) - self.status.count(ST_PENDING))
+
+    #--------------------------------------------------------------------------
+    def write(self, rec):
+        offset = self.fp.tell()
+        self.fp.write(json.dumps(rec, separators=(',',':')).encode("utf-8") + b"\n")
+        self.fp.flush()
+        self.apply(rec, offset)
+
+        self.n_unsaved = self.n_unsaved + 1
+        if((self.n_unsaved >= self.CHECKPOINT_RECORDS) or
+           (time.time() - self.last_checkpoint >= self.CHECKPOINT_SECONDS)):
+            self.checkpoint()
+
+    def record_begin(self, idx):
+        """ Call before processing a file """
+        self.write({'t': "b", 'i': idx})
+
+    def record_result(self, idx, status, row = None):
+        """ Call after processing a file """
+        rec = {'t': "r", 'i': idx, 's': status}
+        if(row != None):
+            rec['row'] = list(row)
+        self.write(rec)
+
+    def checkpoint(self):
+        """ Saves the current status so a restart does not need to replay the whole journal """
+        self.fp.flush()
+        os.fsync(self.fp.fileno())
+
+        ckpt = {
+            'n_files': len(self.filenames),
+            'offset': self.fp.tell()
+        }
+        tmp_path = self.path + ".ckpt.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(json.dumps(ckpt).encode("utf-8") + b"\n")
+            f.write(self.status)
+            f.write(self.attempts)
+            f.write(self.result_at.tobytes())
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path + ".ckpt")
+
+        self.n_unsaved = 0
+        self.last_checkpoint = time.time()
+
+    def close(self):
+        if(self.fp):
+            self.checkpoint()
+            self.fp.close()
+            self.fp = None
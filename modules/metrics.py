@@ -0,0 +1,293 @@
+####################################################################################################
+# The MIT License (MIT)
+#
+# Copyright (c) 2015, Alexander I. Mykyta
+# All rights reserved.
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+# 
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+####################################################################################################
+
+# Run metrics of an extraction process
+#
+# Metrics are plain attributes that are bumped in place, so updating them costs about as much
+# as an attribute increment. They are not locked: each metric should only be updated by one
+# thread at a time. Readers only ever see a slightly stale value.
+#
+# The metrics of a process can be:
+#   - written periodically to a Prometheus text file (for node_exporter's textfile collector)
+#     and a JSON file, by a MetricsReporter
+#   - served over HTTP, along with a health check, by serve()
+
+import os
+import json
+import time
+import bisect
+import threading
+import logging
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+log = logging.getLogger("metrics")
+
+PREFIX = "pdform_"
+
+# Seconds
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+#===================================================================================================
+class Counter:
+    kind = "counter"
+    
+    def __init__(self, name, help):
+        self.name = PREFIX + name
+        self.help = help
+        self.value = 0
+    
+    def inc(self, n = 1):
+        self.value = self.value + n
+    
+    def samples(self):
+        return([(self.name, {}, self.value)])
+    
+    def to_json(self):
+        return(self.value)
+
+class Gauge:
+    kind = "gauge"
+    
+    def __init__(self, name, help, func = None):
+        self.name = PREFIX + name
+        self.help = help
+        self.value = 0
+        self.func = func # If given, the value is read from it instead
+    
+    def set(self, v):
+        self.value = v
+    
+    def get(self):
+        if(self.func != None):
+            return(self.func())
+        return(self.value)
+    
+    def samples(self):
+        return([(self.name, {}, self.get())])
+    
+    def to_json(self):
+        return(self.get())
+
+class Histogram:
+    kind = "histogram"
+    
+    def __init__(self, name, help, buckets = LATENCY_BUCKETS):
+        self.name = PREFIX + name
+        self.help = help
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1) # Last one is +Inf
+        self.count = 0
+        self.sum = 0.0
+    
+    def observe(self, v):
+        self.counts[bisect.bisect_left(self.buckets, v)] += 1
+        self.count = self.count + 1
+        self.sum = self.sum + v
+    
+    def samples(self):
+        result = []
+        total = 0
+        for le, n in zip(self.buckets + ("+Inf",), self.counts):
+            total = total + n
+            result.append((self.name + "_bucket", {'le': str(le)}, total))
+        result.append((self.name + "_sum", {}, self.sum))
+        result.append((self.name + "_count", {}, self.count))
+        return(result)
+    
+    def to_json(self):
+        return({
+            'count': self.count,
+            'sum': self.sum,
+            'buckets': dict(zip([str(le) for le in self.buckets + ("+Inf",)], self.counts))
+        })
+
+#===================================================================================================
+class Registry:
+    """ All metrics of the process. labels are added to every sample """
+    def __init__(self):
+        self.metrics = []
+        self.labels = {}
+        self.start_time = time.time()
+    
+    def add(self, metric):
+        self.metrics.append(metric)
+        return(metric)
+    
+    def counter(self, name, help):
+        return(self.add(Counter(name, help)))
+    
+    def gauge(self, name, help, func = None):
+        return(self.add(Gauge(name, help, func)))
+    
+    def histogram(self, name, help, buckets = LATENCY_BUCKETS):
+        return(self.add(Histogram(name, help, buckets)))
+    
+    def get_uptime(self):
+        return(time.time() - self.start_time)
+    
+    #--------------------------------------------------------------------------
+    def render_prometheus(self):
+        """ Returns the metrics in the Prometheus text exposition format """
+        lines = []
+        for m in self.metrics:
+            lines.append("# HELP %s %s" % (m.name, m.help))
+            lines.append("# TYPE %s %s" % (m.name, m.kind))
+            for name, labels, value in m.samples():
+                all_labels = dict(self.labels)
+                all_labels.update(labels)
+                if(all_labels):
+                    label_text = ",".join(['%s="%s"' % (k, escape_label(v)) for k,v in sorted(all_labels.items())])
+                    lines.append("%s{%s} %s" % (name, label_text, format_value(value)))
+                else:
+                    lines.append("%s %s" % (name, format_value(value)))
+        return("\n".join(lines) + "\n")
+    
+    def to_dict(self):
+        d = {
+            'labels': dict(self.labels),
+            'timestamp': time.time(),
+            'metrics': {}
+        }
+        for m in self.metrics:
+            d['metrics'][m.name[len(PREFIX):]] = m.to_json()
+        return(d)
+    
+    def write_files(self, path_base):
+        """ Writes path_base.prom and path_base.json. Each is replaced atomically so that a
+        collector never reads half a file """
+        write_atomic(path_base + ".prom", self.render_prometheus())
+        write_atomic(path_base + ".json", json.dumps(self.to_dict(), indent=2))
+
+def escape_label(v):
+    return(str(v).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n"))
+
+def format_value(v):
+    if(isinstance(v, float)):
+        return(repr(v))
+    return(str(v))
+
+def write_atomic(path, text):
+    tmp_path = "%s.%d.tmp" % (path, os.getpid())
+    with open(tmp_path, 'w', encoding="utf-8") as f:
+        f.write(text)
+    os.replace(tmp_path, path)
+
+#===================================================================================================
+# Metrics of this process
+#===================================================================================================
+REGISTRY = Registry()
+
+FILES_DISCOVERED = REGISTRY.counter("files_discovered_total", "Files queued for extraction")
+FILES_PARSED = REGISTRY.counter("files_parsed_total", "Files that were parsed as PDF forms")
+FILES_MATCHED = REGISTRY.counter("files_matched_total", "Forms that matched the template")
+FILES_MISMATCHED = REGISTRY.counter("files_mismatched_total", "Forms of a different template")
+FILES_INVALID = REGISTRY.counter("files_invalid_total", "Files that are not forms, or no longer exist")
+FILES_FAILED = REGISTRY.counter("files_failed_total", "Files that could not be read or parsed")
+BYTES_READ = REGISTRY.counter("bytes_read_total", "Bytes of PDF files read")
+PARSE_SECONDS = REGISTRY.histogram("parse_seconds", "Time to extract one file")
+
+PREFETCH_QUEUE = REGISTRY.gauge("prefetch_queue_files", "Files queued up to be read ahead")
+PREFETCH_BUFFERED = REGISTRY.gauge("prefetch_buffered_bytes", "Bytes read ahead that were not parsed yet")
+CHUNKS_PENDING = REGISTRY.gauge("batch_chunks_pending", "Chunks of the batch job that are not finished")
+CHUNKS_DONE = REGISTRY.counter("batch_chunks_done_total", "Chunks finished by this worker")
+
+BUSY_SECONDS = REGISTRY.counter("worker_busy_seconds_total", "Time spent extracting files")
+REGISTRY.gauge("uptime_seconds", "Time since the process started", REGISTRY.get_uptime)
+REGISTRY.gauge(
+    "worker_utilisation", "Fraction of the uptime spent extracting files",
+    lambda: BUSY_SECONDS.value / max(REGISTRY.get_uptime(), 1e-9)
+)
+
+#===================================================================================================
+class MetricsReporter:
+    """ Writes the registry to path_base.prom and path_base.json every interval seconds, on a
+    background thread, and once more when stopped """
+    def __init__(self, path_base, interval = 15, registry = REGISTRY):
+        self.path_base = path_base
+        self.interval = interval
+        self.registry = registry
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+    
+    def start(self):
+        os.makedirs(os.path.dirname(os.path.abspath(self.path_base)), exist_ok=True)
+        self.thread.start()
+        return(self)
+    
+    def write(self):
+        try:
+            self.registry.write_files(self.path_base)
+        except OSError as E:
+            log.warning("Could not write metrics to '%s': %s" % (self.path_base, E))
+    
+    def run(self):
+        while(not self.stop_event.wait(self.interval)):
+            self.write()
+    
+    def stop(self):
+        self.stop_event.set()
+        self.thread.join()
+        self.write()
+
+#===================================================================================================
+class MetricsHandler(BaseHTTPRequestHandler):
+    registry = REGISTRY
+    
+    def do_GET(self):
+        path = self.path.split("?")[0]
+        if(path == "/metrics"):
+            self.reply("text/plain; version=0.0.4", self.registry.render_prometheus())
+        elif(path == "/metrics.json"):
+            self.reply("application/json", json.dumps(self.registry.to_dict()))
+        elif(path == "/health"):
+            self.reply("application/json", json.dumps({
+                'status': "ok",
+                'uptime': self.registry.get_uptime(),
+                'labels': self.registry.labels
+            }))
+        else:
+            self.send_error(404)
+    
+    def reply(self, content_type, text):
+        body = text.encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+    
+    def log_message(self, format, *args):
+        log.debug(format % args)
+
+def serve(port, host = "", registry = REGISTRY):
+    """ Serves /metrics, /metrics.json and /health on a background thread.
+    Returns the server. Call shutdown() on it to stop """
+    handler = type("Handler", (MetricsHandler,), {'registry': registry})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    th = threading.Thread(target=server.serve_forever, daemon=True)
+    th.start()
+    log.info("Serving metrics on port %d" % server.server_address[1])
+    return(server)
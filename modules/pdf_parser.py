@@ -25,18 +25,30 @@
 
 import sys
 import re
+import io
 import logging
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 
 from pdfminer.pdfparser import PDFParser
 from pdfminer.pdfdocument import PDFDocument
 from pdfminer.pdfpage import PDFPage
-from pdfminer.pdfinterp import PDFResourceManager
-from pdfminer.pdfdevice import PDFDevice
 from pdfminer.pdftypes import PDFObjRef
 from pdfminer.psparser import PSLiteral
 
+from . import fast_pdf
+
 log = logging.getLogger("pdf_parser")
 
+# Try the lightweight reader before falling back to pdfminer
+USE_FAST_READER = True
+
+# Documents with at least this many pages have their pages split across worker processes.
+# PAGE_WORKERS is the number of processes to use. 1 disables it
+PARALLEL_MIN_PAGES = 256
+PAGE_WORKERS = multiprocessing.cpu_count()
+
 #===================================================================================================
 Ff_RADIO = 0x00010000
 Ff_PUSHBUTTON = 0x00020000
@@ -54,8 +66,16 @@ def decode_pdf_string(bytestring):
 
 #===================================================================================================
 class Field:
-    def __init__(self, obj):
+    """ A fillable widget field
+    
+    If field_filter is given and does not contain this field's name, only the name and type are
+    checked. The value and geometry are not decoded and are left as None.
+    """
+    def __init__(self, obj, field_filter = None):
         self.valid = False
+        self.value = None
+        self.rect = None
+        self.objid = None # Object number of the widget, if known
         
         # bulletproof checks
         if('Subtype' not in obj): return
@@ -67,12 +87,16 @@ class Field:
         if(not isinstance(obj['FT'], PSLiteral)): return
         
         # Get the field name
-        self.name = decode_pdf_string(obj['T'])
+        # Interned, since the same names repeat in every copy of a form
+        self.name = sys.intern(decode_pdf_string(obj['T']))
+        decode = (field_filter == None) or (self.name in field_filter)
         
         # Determine the type of field, and get the value
         if(obj['FT'].name == "Tx"):
             # Text Field
-            if('V' in obj):
+            if(not decode):
+                pass
+            elif('V' in obj):
                 self.value = decode_pdf_string(obj['V'])
             else:
                 self.value = ""
@@ -97,7 +121,9 @@ class Field:
                 return
             else:
                 # is a checkbox
-                if('V' in obj):
+                if(not decode):
+                    pass
+                elif('V' in obj):
                     if(obj['V'].name == "Yes"):
                         self.value = 1
                     else:
@@ -107,7 +133,9 @@ class Field:
             
         elif(obj['FT'].name == "Ch"):
             # Choice Field
-            if('V' in obj):
+            if(not decode):
+                pass
+            elif('V' in obj):
                 self.value = decode_pdf_string(obj['V'])
             else:
                 self.value = ""
@@ -120,7 +148,8 @@ class Field:
         # I THINK it is: [x1,y1,x2,y2]
         # where x1, y1 are the smallest of the two
         # coordinates seem to be counted from the bottom left of the page
-        self.rect = obj['Rect']
+        if(decode):
+            self.rect = obj['Rect']
         
         self.valid = True
         
@@ -136,9 +165,14 @@ def fnv_hash32(s):
 
 #===================================================================================================
 class Page:
-    """ Wrapper class for the PDFMiner page class """
-    def __init__(self, pdfminer_page):
+    """ Wrapper class for the PDFMiner page class
+    
+    field_filter is an optional set of field names whose values are needed. Other fields are
+    only named (for the page hash) and their values are not decoded.
+    """
+    def __init__(self, pdfminer_page, field_filter = None):
         self.valid = False
+        self.field_filter = field_filter
         
         # Get the page dimensions
         self.mediabox = pdfminer_page.mediabox
@@ -181,7 +215,8 @@ class Page:
             if(isinstance(obj['Subtype'], PSLiteral) == False): continue
             if(obj['Subtype'].name != "Widget"): continue
             
-            F = Field(obj)
+            F = Field(obj, self.field_filter)
+            F.objid = getattr(objref, 'objid', None)
             if(F.valid):
                 self.fields.append(F)
     
@@ -195,28 +230,187 @@ class Page:
                 h = fnv_hash32(F.name)
                 self.page_hash = self.page_hash ^ h
     
+#===================================================================================================
+def get_doc_id(data):
+    """ Returns the permanent part of the file identifier (the first /ID string) as hex.
+    Filled copies of a blank form keep the blank's identifier.
+    Returns an empty string if there is none """
+    try:
+        return(get_reader_doc_id(fast_pdf.Reader(data)))
+    except fast_pdf.READ_ERRORS:
+        pass
+    return("")
+
+def get_reader_doc_id(R):
+    """ Same as get_doc_id(), for an already opened fast_pdf.Reader """
+    doc_id = fast_pdf.resolve(R.trailer.get('ID'))
+    if(isinstance(doc_id, list) and len(doc_id) and isinstance(doc_id[0], bytes)):
+        return(doc_id[0].hex())
+    return("")
+
+#===================================================================================================
+class WidgetMap:
+    """ Object numbers of the widgets in a known blank form
+    
+    Filled copies of the same blank usually keep the same object numbers. The values can then
+    be read by looking the objects up in the xref directly instead of walking the page tree.
+    A file is only read this way if it has the same /ID and number of pages, and every mapped
+    object is still a widget with the same name. The page tree is not walked, so a widget that
+    was added to a page of a copy is not noticed. page_count can be None if it is not known.
+    """
+    def __init__(self, doc_id, objids, fingerprint, page_count = None):
+        self.doc_id = doc_id
+        self.objids = objids # dict of field name --> object number
+        self.fingerprint = list(fingerprint)
+        self.page_count = page_count
+    
+    @classmethod
+    def from_pages(cls, doc_id, pages, fingerprint):
+        objids = {}
+        for pg in pages:
+            for F in pg.fields:
+                if(F.objid != None):
+                    objids[F.name] = F.objid
+        return(cls(doc_id, objids, fingerprint, len(pages)))
+    
+    def read_fields(self, data, field_filter = None):
+        """ Reads the field values directly from the mapped objects.
+        Returns a dict of values, or None if the file does not match the map """
+        if(not self.doc_id):
+            return(None)
+        
+        if(field_filter != None):
+            # A requested field that is not mapped would silently be missing from the values
+            for name in field_filter:
+                if(name not in self.objids):
+                    return(None)
+        
+        try:
+            R = fast_pdf.Reader(data)
+            doc_id = fast_pdf.resolve(R.trailer.get('ID'))
+            if((not isinstance(doc_id, list)) or (len(doc_id) == 0)):
+                return(None)
+            if(doc_id[0] != bytes.fromhex(self.doc_id)):
+                return(None)
+            
+            # Pages that were added or removed change the fingerprint
+            if(self.page_count != None):
+                pages = fast_pdf.resolve(R.get_catalog().get('Pages'))
+                if((not isinstance(pages, dict)) or (fast_pdf.resolve(pages.get('Count')) != self.page_count)):
+                    return(None)
+            
+            fields = {}
+            for name, objid in self.objids.items():
+                # Verify that every mapped object is still the same widget, even the ones whose
+                # values are not needed. Only the values in field_filter are decoded
+                obj = R.get_object(objid)
+                if(not isinstance(obj, dict)):
+                    return(None)
+                F = Field(obj, field_filter)
+                if((not F.valid) or (F.name != name)):
+                    return(None)
+                
+                if((field_filter == None) or (name in field_filter)):
+                    fields[name] = F.value
+        except fast_pdf.READ_ERRORS:
+            return(None)
+        
+        return(fields)
+
 #===================================================================================================
 # Instead of looping through every object ever, traverse the page tree and get the fields
 # directly via the Annot entry of each page.
 # Bonus: they seem to be sorted in tab-order
-def get_pdf_pages(filename):
+def get_pdf_pages(filename, field_filter = None, data = None):
+    
+    # Load PDF, unless the caller already has its contents
+    if(data == None):
+        with open(filename, 'rb') as fp:
+            data = fp.read()
     
-    # Load PDF
-    fp = open(filename, 'rb')
+    if(USE_FAST_READER):
+        try:
+            return(get_pdf_pages_fast(data, field_filter))
+        except fast_pdf.READ_ERRORS as E:
+            log.debug("Fast reader gave up on '%s' (%s). Using pdfminer" % (filename, E))
+    
+    return(get_pdf_pages_pdfminer(data, field_filter))
+
+def get_pdf_pages_fast(data, field_filter = None):
+    """ Gather the pages using the minimal reader in fast_pdf.
+    Raises one of fast_pdf.READ_ERRORS if the file could not be handled """
+    fast_pages = fast_pdf.Reader(data).get_pages()
+    
+    n_workers = min(PAGE_WORKERS, len(fast_pages) // (PARALLEL_MIN_PAGES // 2))
+    if((len(fast_pages) >= PARALLEL_MIN_PAGES) and (n_workers > 1)
+       and not multiprocessing.current_process().daemon):
+        try:
+            return(get_pdf_pages_parallel(data, field_filter, len(fast_pages), n_workers))
+        except (BrokenProcessPool, OSError) as E:
+            log.warning("Parallel page parsing failed (%s). Parsing serially" % E)
+    
+    pages = []
+    for pg in fast_pages:
+        P = Page(pg, field_filter)
+        pages.append(P)
+    
+    return(pages)
+
+#---------------------------------------------------------------------------------------------------
+# Splitting the pages of a large document across processes.
+# Each worker opens its own fast_pdf.Reader on the file contents it was given when it started,
+# parses a contiguous range of pages, and sends back the Page objects
+_worker_pages = None
+_worker_filter = None
+
+def _init_page_worker(data, field_filter):
+    global _worker_pages, _worker_filter
+    _worker_pages = fast_pdf.Reader(data).get_pages()
+    _worker_filter = field_filter
+
+def _detach(v):
+    """ Resolves any references to the reader so that a value can be sent between processes """
+    v = fast_pdf.resolve(v)
+    if(isinstance(v, list)):
+        return([_detach(x) for x in v])
+    return(v)
+
+def _parse_page_range(start, end):
+    pages = []
+    for pg in _worker_pages[start:end]:
+        P = Page(pg, _worker_filter)
+        P.mediabox = _detach(P.mediabox)
+        for field in P.fields:
+            field.rect = _detach(field.rect)
+        pages.append(P)
+    return(pages)
+
+def get_pdf_pages_parallel(data, field_filter, n_pages, n_workers):
+    """ Parses the pages in ranges on n_workers processes. Returns them in page order """
+    # A few ranges per worker, so that a slow range does not hold up the rest
+    n_ranges = n_workers * 4
+    bounds = [(n_pages * i) // n_ranges for i in range(n_ranges + 1)]
+    
+    with ProcessPoolExecutor(n_workers, initializer=_init_page_worker, initargs=(data, field_filter)) as ex:
+        futures = [ex.submit(_parse_page_range, a, b) for a,b in zip(bounds[:-1], bounds[1:]) if b > a]
+        pages = []
+        for f in futures:
+            pages.extend(f.result())
+    
+    return(pages)
+
+def get_pdf_pages_pdfminer(data, field_filter = None):
+    """ Gather the pages using pdfminer """
+    fp = io.BytesIO(data)
     
     # Initialize pdfminer
     parser = PDFParser(fp)
     doc = PDFDocument(parser)
-    rsrcmgr = PDFResourceManager()
-    device = PDFDevice(rsrcmgr)
-    
     
     # Gather all the pages
     pages = []
     for pg in PDFPage.create_pages(doc):
-        P = Page(pg)
+        P = Page(pg, field_filter)
         pages.append(P)
-        
-    fp.close()
     
     return(pages)
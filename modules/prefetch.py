@@ -0,0 +1,192 @@
+####################################################################################################
+# The MIT License (MIT)
+#
+# Copyright (c) 2015, Alexander I. Mykyta
+# All rights reserved.
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+# 
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+####################################################################################################
+
+# Read-ahead of upcoming files
+#
+# On network shares most of the time goes into waiting for small reads. The Prefetcher reads
+# whole files with a few I/O threads while the previous file is being parsed, and hands the
+# contents over as in-memory buffers.
+
+import os
+import datetime
+import threading
+import collections
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from . import metrics
+
+log = logging.getLogger("prefetch")
+
+DEFAULT_THREADS = 4
+DEFAULT_MAX_BYTES = 64 * 1024 * 1024
+
+#===================================================================================================
+class PrefetchedFile:
+    """ Contents of a file that was read ahead """
+    __slots__ = ("filename", "data", "timestamp", "error", "rejected")
+    
+    def __init__(self, filename, data = None, timestamp = None, error = None, rejected = None):
+        self.filename = filename
+        self.data = data            # bytes, or None if it could not be read
+        self.timestamp = timestamp  # datetime of the file's ctime
+        self.error = error          # OSError, if it could not be read
+        self.rejected = rejected    # Reason the screen gave for not reading it, if it did
+
+#===================================================================================================
+class ByteBudget:
+    """ Limits how many bytes are buffered.
+    
+    Budget is handed out strictly in ticket order. Otherwise later files could use up the
+    budget while the consumer is still waiting for an earlier one.
+    """
+    def __init__(self, max_bytes):
+        self.cv = threading.Condition()
+        self.max_bytes = max_bytes
+        self.available = max_bytes
+        self.turn = 0
+        self.closed = False
+    
+    def acquire(self, ticket, n):
+        with self.cv:
+            # A file bigger than the whole budget is let through once nothing else is buffered
+            self.cv.wait_for(lambda: self.closed or ((self.turn == ticket) and
+                ((n <= self.available) or (self.available == self.max_bytes))))
+            self.available = self.available - n
+            self.turn = self.turn + 1
+            self.cv.notify_all()
+    
+    def release(self, n):
+        with self.cv:
+            self.available = self.available + n
+            self.cv.notify_all()
+    
+    def close(self):
+        with self.cv:
+            self.closed = True
+            self.cv.notify_all()
+
+#===================================================================================================
+class Prefetcher:
+    """ Iterates over filenames, yielding PrefetchedFile objects in the same order.
+    
+    Files are read ahead by n_threads I/O threads, with at most max_bytes buffered that the
+    consumer has not got to yet.
+    Subclasses can read from somewhere other than the filesystem by overriding get_name(),
+    stat() and load().
+    
+    screen is an optional prefilter.Prefilter. Files it rejects from their size, cached verdict
+    or a partial read are not loaded. They come back with data=None and the reason in rejected.
+    """
+    def __init__(self, filenames, n_threads = DEFAULT_THREADS, max_bytes = DEFAULT_MAX_BYTES, screen = None):
+        self.filenames = filenames
+        self.n_threads = n_threads
+        self.max_bytes = max_bytes
+        self.screen = screen
+    
+    # Errors that mark a single file as unreadable
+    read_errors = (OSError,)
+    
+    def get_name(self, item):
+        """ Returns the filename reported for an item """
+        return(item)
+    
+    def stat(self, item):
+        """ Returns (size, timestamp) of an item """
+        st = os.stat(item)
+        return((st.st_size, datetime.datetime.fromtimestamp(st.st_ctime)))
+    
+    def load(self, item):
+        """ Returns the contents of an item """
+        # One big sequential read
+        with open(item, 'rb', buffering=0) as fp:
+            return(fp.readall())
+    
+    def read(self, budget, ticket, item):
+        filename = self.get_name(item)
+        try:
+            size, timestamp = self.stat(item)
+        except self.read_errors as E:
+            budget.acquire(ticket, 0)
+            return(PrefetchedFile(filename, error=E))
+        
+        if(self.screen != None):
+            try:
+                reason = self.screen.check_path(item, size, timestamp)
+            except self.read_errors:
+                # Reported when it is loaded
+                reason = None
+            if(reason != None):
+                budget.acquire(ticket, 0)
+                return(PrefetchedFile(filename, timestamp=timestamp, rejected=reason))
+        
+        budget.acquire(ticket, size)
+        if(budget.closed):
+            return(None)
+        
+        try:
+            data = self.load(item)
+        except self.read_errors as E:
+            budget.release(size)
+            return(PrefetchedFile(filename, timestamp=timestamp, error=E))
+        
+        # Size might have changed since the stat
+        budget.release(size - len(data))
+        return(PrefetchedFile(filename, data, timestamp))
+    
+    def __iter__(self):
+        budget = ByteBudget(self.max_bytes)
+        executor = ThreadPoolExecutor(self.n_threads)
+        window = collections.deque()
+        max_window = self.n_threads * 4
+        filenames = iter(self.filenames)
+        ticket = 0
+        
+        try:
+            while(True):
+                # Keep enough reads queued up. The budget decides how far they actually get
+                while(len(window) < max_window):
+                    filename = next(filenames, None)
+                    if(filename == None):
+                        break
+                    window.append(executor.submit(self.read, budget, ticket, filename))
+                    ticket = ticket + 1
+                
+                if(len(window) == 0):
+                    break
+                
+                item = window.popleft().result()
+                metrics.PREFETCH_QUEUE.set(len(window))
+                metrics.PREFETCH_BUFFERED.set(self.max_bytes - budget.available)
+                yield(item)
+                
+                # Consumer is done with it
+                if(item.data != None):
+                    budget.release(len(item.data))
+        finally:
+            budget.close()
+            for fut in window:
+                fut.cancel()
+            executor.shutdown(wait=True)
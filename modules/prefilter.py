@@ -0,0 +1,204 @@
+####################################################################################################
+# The MIT License (MIT)
+#
+# Copyright (c) 2015, Alexander I. Mykyta
+# All rights reserved.
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+# 
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+####################################################################################################
+
+# Rejecting files that cannot be a match before they are fully parsed
+#
+# Only the trailer, the document catalog and the root of the page tree are read. A file is
+# rejected if it is not a PDF, has no /AcroForm, or has fewer pages than the template has
+# pages with fields. Files whose permanent /ID is the template's source are always let through.
+#
+# The facts read from rejected files are cached, keyed by name, size and timestamp, so the
+# same file is not opened again in later imports.
+#
+# check_path() judges a file on disk before it is read. The file is memory-mapped, so only the
+# trailer, the xref and the few objects looked at are actually read from disk.
+
+import os
+import mmap
+import json
+import datetime
+import threading
+import logging
+
+from . import fast_pdf
+from . import pdf_parser
+
+log = logging.getLogger("prefilter")
+
+REJECT_SIZE = "size out of bounds"
+REJECT_NOT_PDF = "not a PDF"
+REJECT_NO_FORM = "no form fields"
+REJECT_PAGES = "too few pages"
+
+MIN_PDF_SIZE = 64 # Nothing smaller can hold a page
+
+#===================================================================================================
+class DocFacts:
+    """ What the prefilter knows about a file """
+    __slots__ = ('is_pdf', 'has_form', 'n_pages', 'doc_id')
+    
+    def __init__(self, is_pdf, has_form = False, n_pages = 0, doc_id = ""):
+        self.is_pdf = is_pdf
+        self.has_form = has_form
+        self.n_pages = n_pages
+        self.doc_id = doc_id
+    
+    def to_list(self):
+        return([self.is_pdf, self.has_form, self.n_pages, self.doc_id])
+
+def read_facts(data):
+    """ Reads the DocFacts of a file's contents.
+    Returns None if the file could not be judged cheaply (for example, encrypted files) """
+    if(data.find(b'%PDF-', 0, 1024) < 0):
+        return(DocFacts(False))
+    
+    try:
+        R = fast_pdf.Reader(data)
+        catalog = R.get_catalog()
+        
+        acroform = fast_pdf.resolve(catalog.get('AcroForm'))
+        has_form = False
+        if(isinstance(acroform, dict)):
+            fields = fast_pdf.resolve(acroform.get('Fields'))
+            has_form = isinstance(fields, list) and (len(fields) > 0)
+        
+        pages = fast_pdf.resolve(catalog.get('Pages'))
+        n_pages = fast_pdf.resolve(pages.get('Count'))
+        if(not isinstance(n_pages, int)):
+            return(None)
+        
+        return(DocFacts(True, has_form, n_pages, pdf_parser.get_reader_doc_id(R)))
+    except fast_pdf.READ_ERRORS:
+        return(None)
+
+def read_file_facts(filename):
+    """ Same as read_facts(), for a file on disk. Only the parts that are looked at are read """
+    with open(filename, 'rb') as fp:
+        try:
+            m = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # Empty file
+            return(DocFacts(False))
+    try:
+        return(read_facts(m))
+    finally:
+        m.close()
+
+#===================================================================================================
+class Prefilter:
+    """ Cheap check of whether a file could match an extraction plan """
+    
+    def __init__(self, n_fingerprint = 0, source_id = "", min_size = MIN_PDF_SIZE, max_size = None, cache_path = None):
+        self.n_fingerprint = n_fingerprint
+        self.source_id = source_id
+        self.min_size = min_size
+        self.max_size = max_size
+        
+        self.cache = {} # filename --> (size, timestamp, DocFacts) of rejected files
+        self.cache_lock = threading.Lock() # Prefetch threads check files concurrently
+        self.cache_path = cache_path
+        self.cache_fp = None
+        if(cache_path != None):
+            self.load_cache()
+            self.cache_fp = open(cache_path, 'a', encoding="utf-8")
+    
+    @classmethod
+    def from_plan(cls, plan, **kwargs):
+        source_id = ""
+        if(plan.widget_map != None):
+            source_id = plan.widget_map.doc_id
+        return(cls(len(plan.form_fingerprint), source_id, **kwargs))
+    
+    def judge(self, facts):
+        """ Returns the reason to reject a file with the given DocFacts, or None """
+        if(not facts.is_pdf):
+            return(REJECT_NOT_PDF)
+        if(self.source_id and (facts.doc_id == self.source_id)):
+            return(None)
+        if(not facts.has_form):
+            return(REJECT_NO_FORM)
+        if(facts.n_pages < self.n_fingerprint):
+            return(REJECT_PAGES)
+        return(None)
+    
+    def check(self, filename, data, timestamp = None):
+        """ Returns the reason to reject a file, or None if it is a candidate """
+        return(self.check_facts(filename, len(data), timestamp, read_facts, data))
+    
+    def check_path(self, filename, size = None, timestamp = None):
+        """ Same as check(), for a file that was not read yet. Files that were rejected before
+        are not opened at all """
+        if((size == None) or (timestamp == None)):
+            st = os.stat(filename)
+            size = st.st_size
+            timestamp = datetime.datetime.fromtimestamp(st.st_ctime)
+        return(self.check_facts(filename, size, timestamp, read_file_facts, filename))
+    
+    def check_facts(self, filename, size, timestamp, reader, source):
+        """ reader(source) is called to get the DocFacts if there is no up to date cache entry """
+        if((size < self.min_size) or ((self.max_size != None) and (size > self.max_size))):
+            return(REJECT_SIZE)
+        
+        key = str(timestamp)
+        cached = self.cache.get(filename)
+        fresh = (cached != None) and (cached[0] == size) and (cached[1] == key)
+        if(fresh):
+            facts = cached[2]
+        else:
+            facts = reader(source)
+            if(facts == None):
+                return(None)
+        
+        reason = self.judge(facts)
+        if(not fresh):
+            # New file, or it changed since it was cached
+            with self.cache_lock:
+                if(reason == None):
+                    self.cache.pop(filename, None)
+                else:
+                    self.cache[filename] = (size, key, facts)
+                    if(self.cache_fp):
+                        self.cache_fp.write(json.dumps([filename, size, key] + facts.to_list()) + "\n")
+                        self.cache_fp.flush()
+        return(reason)
+    
+    #--------------------------------------------------------------------------
+    def load_cache(self):
+        try:
+            with open(self.cache_path, 'r', encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        filename, size, key, is_pdf, has_form, n_pages, doc_id = json.loads(line)
+                    except ValueError:
+                        # Partial line from a crash
+                        continue
+                    self.cache[filename] = (size, key, DocFacts(is_pdf, has_form, n_pages, doc_id))
+        except FileNotFoundError:
+            pass
+    
+    def close(self):
+        if(self.cache_fp):
+            self.cache_fp.close()
+            self.cache_fp = None
@@ -31,6 +31,20 @@ from tkinter import ttk
 from tkinter import messagebox
 
 from .python_modules.encodable_class import EncodableClass
+from . import expressions
+
+#===================================================================================================
+# Extraction plan column kinds
+# Returned by _entry.compile() to tell the ExtractionPlan how a column gets filled
+#===================================================================================================
+COL_ENTRY = 0       # Fall back to calling the entry's get_value() for every row
+COL_CONST = 1       # Value is the same for every row of an export run
+COL_FIELD = 2       # Value is copied from the named PDF field
+COL_FILENAME = 3    # Value is the form's filename
+COL_TIMESTAMP = 4   # Value is the form's timestamp
+COL_COMPUTED = 5    # Value is computed from other columns once the whole table is built
+
+TIMESTAMP_FORMAT = "%Y-%m-%d %H:%M:%S"
 
 #===================================================================================================
 # Base Classes
@@ -52,6 +66,17 @@ class _entry(EncodableClass):
     def get_value(self, pdf_object):
         return(None)
     
+    # override this
+    def get_required_fields(self):
+        """ Returns a list of PDF field names that this entry reads """
+        return([])
+    
+    # override this
+    def compile(self, batch):
+        """ Returns a (kind, arg) tuple that describes how an ExtractionPlan fills this column.
+        batch is a dict of values that stay constant for an entire export run """
+        return((COL_ENTRY, self))
+    
     # override this
     def __deepcopy__(self, memo):
         cls = self.__class__
@@ -163,6 +188,12 @@ class PDF_Field(_entry):
         else:
             return(None)
     
+    def get_required_fields(self):
+        return([self.field_name])
+    
+    def compile(self, batch):
+        return((COL_FIELD, self.field_name))
+    
     def __deepcopy__(self, memo):
         cls = self.__class__
         C = cls.__new__(cls)
@@ -218,9 +249,13 @@ class Export_Timestamp(_entry):
         
     def get_value(self, pdf_object):
         now = datetime.datetime.now()
-        str = now.strftime("%Y-%m-%d %H:%M:%S")
+        str = now.strftime(TIMESTAMP_FORMAT)
         return(str)
     
+    def compile(self, batch):
+        # Everything in an export run gets the same timestamp
+        return((COL_CONST, batch['export_time'].strftime(TIMESTAMP_FORMAT)))
+    
     def __deepcopy__(self, memo):
         cls = self.__class__
         C = cls.__new__(cls)
@@ -254,9 +289,12 @@ class PDF_Timestamp(_entry):
         _entry.__init__(self, parent_template, name)
         
     def get_value(self, pdf_object):
-        str = pdf_object.timestamp.strftime("%Y-%m-%d %H:%M:%S")
+        str = pdf_object.timestamp.strftime(TIMESTAMP_FORMAT)
         return(str)
     
+    def compile(self, batch):
+        return((COL_TIMESTAMP, None))
+    
     def __deepcopy__(self, memo):
         cls = self.__class__
         C = cls.__new__(cls)
@@ -292,6 +330,9 @@ class PDF_Filename(_entry):
     def get_value(self, pdf_object):
         return(pdf_object.filename)
     
+    def compile(self, batch):
+        return((COL_FILENAME, None))
+    
     def __deepcopy__(self, memo):
         cls = self.__class__
         C = cls.__new__(cls)
@@ -312,3 +353,91 @@ class PDF_Filename_settings_gui(_settings_gui):
     
     def force_commit(self):
         pass
+
+#===================================================================================================
+# Value computed from other columns
+#===================================================================================================
+class Computed_Column(_entry):
+    type_name = "Computed"
+    
+    encode_schema = {
+        "expression": str
+    }
+    
+    def __init__(self, parent_template, name):
+        _entry.__init__(self, parent_template, name)
+        self.expression = ""
+    
+    def get_expression(self):
+        """ Returns the parsed expressions.Expression. Raises ValueError if it is not valid.
+        Parsed once and kept until the text changes """
+        parsed = getattr(self, "_parsed", None)
+        if((parsed == None) or (parsed.text != self.expression)):
+            parsed = expressions.Expression(self.expression)
+            self._parsed = parsed
+        return(parsed)
+    
+    def get_value(self, pdf_object):
+        # Depends on the other columns. Only available through an ExtractionPlan
+        return(None)
+    
+    def compile(self, batch):
+        return((COL_COMPUTED, self.get_expression()))
+    
+    def __deepcopy__(self, memo):
+        cls = self.__class__
+        C = cls.__new__(cls)
+        memo[id(self)] = C
+        
+        C.parent_template = self.parent_template
+        C.name = self.name
+        C.expression = self.expression
+        
+        return(C)
+
+#---------------------------------------------------------------------------------------------------
+class Computed_Column_settings_gui(_settings_gui):
+    data_t = Computed_Column
+    
+    def __init__(self, Data, container_frame):
+        _settings_gui.__init__(self, Data, container_frame)
+        
+        # Create GUI widgets inside container_frame
+        x = ttk.Label(container_frame, text="Expression")
+        x.grid(row=0, column=0, sticky=(tk.N, tk.E))
+        self.txt_expression = ttk.Entry(container_frame)
+        self.txt_expression.insert(0, self.Data.expression)
+        self.txt_expression.grid(row=0, column=1, sticky=(tk.N, tk.W, tk.E))
+        self.txt_expression.bind("<KeyRelease>", self.txt_expression_Changed)
+        
+        x = ttk.Label(
+            container_frame,
+            text = "Refer to other columns by name in braces. For example:\n"
+                   "{Height} * 2.54\n"
+                   "{First Name} + \" \" + {Last Name}\n"
+                   "num({lang_en}) + num({lang_fr})\n"
+                   "Functions: " + ", ".join(sorted(expressions.FUNCTIONS))
+        )
+        x.grid(row=1, column=1, sticky=(tk.N, tk.W))
+        
+        self.lbl_error = ttk.Label(container_frame, text="", foreground="red")
+        self.lbl_error.grid(row=2, column=1, sticky=(tk.N, tk.W))
+        self.check_expression()
+        
+        container_frame.columnconfigure(1, weight=1)
+        container_frame.columnconfigure(tk.ALL, pad=5)
+        container_frame.rowconfigure(tk.ALL, pad=5)
+    
+    def check_expression(self):
+        try:
+            self.Data.get_expression()
+            self.lbl_error.configure(text="")
+        except ValueError as E:
+            self.lbl_error.configure(text=str(E))
+    
+    def force_commit(self):
+        self.Data.expression = self.txt_expression.get()
+    
+    def txt_expression_Changed(self, ev):
+        self.Data.expression = self.txt_expression.get()
+        self.check_expression()
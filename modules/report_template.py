@@ -25,14 +25,21 @@
 
 import copy
 import ast
+import datetime
 
 import pyexcel
 
 from . import form_data
+from . import pdf_parser
 from . import report_entries
+from . import column_stats
+from . import rollover
 
 from .python_modules.encodable_class import EncodableClass
 
+# Rows kept in a DataTable between writes when streaming an export
+STREAM_BATCH_ROWS = 10000
+
 class ReportTemplate(EncodableClass):
     
     encode_schema = {
@@ -40,7 +47,10 @@ class ReportTemplate(EncodableClass):
         "description": str,
         "form_fingerprint": [int],
         "avail_fields": [str],
-        "entries": [report_entries._entry]
+        "entries": [report_entries._entry],
+        "source_id": str,
+        "widget_objids": [int],
+        "source_pages": int
     }
     
     def __init__(self):
@@ -49,11 +59,18 @@ class ReportTemplate(EncodableClass):
         self.form_fingerprint = [] # Array of page hashes, in order of appearance.
         self.avail_fields = []
         self.entries = [] # array of report_entry._entry classes
+        
+        # Optional map of where the widgets are in the source PDF
+        self.source_id = "" # hex of the source PDF's permanent /ID
+        self.widget_objids = [] # Object number of each avail_fields entry. 0 if unknown
+        self.source_pages = 0 # Number of pages of the source PDF. 0 if unknown
     
     @classmethod
-    def from_pdf(cls, filename):
+    def from_pdf(cls, filename, data = None, timestamp = None):
+        """ Creates a template from a blank form. data and timestamp can be given if the file
+        was already read, such as a member of an archive """
         self = cls.__new__(cls)
-        P = form_data.FormData(filename)
+        P = form_data.FormData(filename, data = data, timestamp = timestamp)
         if(P.valid):
             self.name = ""
             self.description = ""
@@ -68,13 +85,44 @@ class ReportTemplate(EncodableClass):
             
             self.form_fingerprint = P.get_fingerprint()
             
+            self.set_widget_map(P.get_widget_map(data))
+            
         else:
             raise ValueError()
         
         return(self)
         
     #--------------------------------------------------------------------------
+    
+    def set_widget_map(self, widget_map):
+        """ Records the object numbers from a pdf_parser.WidgetMap """
+        if(widget_map == None):
+            self.source_id = ""
+            self.widget_objids = []
+            self.source_pages = 0
+            return
         
+        self.source_id = widget_map.doc_id
+        self.source_pages = widget_map.page_count or 0
+        self.widget_objids = []
+        for name in self.avail_fields:
+            self.widget_objids.append(widget_map.objids.get(name, 0))
+    
+    def get_widget_map(self):
+        """ Returns a pdf_parser.WidgetMap of the source PDF, or None if it was not recorded """
+        # Templates saved before the map existed do not have these
+        source_id = getattr(self, "source_id", "")
+        widget_objids = getattr(self, "widget_objids", [])
+        if((not source_id) or (len(widget_objids) != len(self.avail_fields))):
+            return(None)
+        
+        objids = {}
+        for name, objid in zip(self.avail_fields, widget_objids):
+            if(objid != 0):
+                objids[name] = objid
+        page_count = getattr(self, "source_pages", 0) or None
+        return(pdf_parser.WidgetMap(source_id, objids, self.form_fingerprint, page_count))
+    
     def is_matching_form(self, form_data):
         """ Checks if the given form_data's fingerprint is compatible with the template's fingerprint """
         return(form_data.has_matching_fingerprint(self.form_fingerprint))
@@ -86,6 +134,22 @@ class ReportTemplate(EncodableClass):
             R[e.name] = e.get_value(form_data)
         
         return(R)
+    
+    def get_required_fields(self):
+        """ Returns the set of PDF field names that the report entries read """
+        names = set()
+        for e in self.entries:
+            names.update(e.get_required_fields())
+        return(names)
+    
+    def compile(self, export_time = None):
+        """ Compiles the template into an ExtractionPlan for a batch of forms """
+        return(ExtractionPlan(self, export_time))
+    
+    def validate(self):
+        """ Raises ValueError if the template can not be compiled. For example, a computed column
+        with a bad expression or a reference to a column that does not exist """
+        self.compile()
         
     def __deepcopy__(self, memo):
         cls = self.__class__
@@ -100,8 +164,151 @@ class ReportTemplate(EncodableClass):
         
         return(C)
     
+#===================================================================================================
+class ExtractionPlan:
+    """ A ReportTemplate compiled into a fixed column layout.
+    
+    Column slots and batch-constant values are resolved once so that make_row() can turn a
+    FormData object into a row tuple in a single pass.
+    Plans only contain plain data, so they can be pickled and sent to worker processes.
+    """
+    def __init__(self, template, export_time = None):
+        if(export_time == None):
+            export_time = datetime.datetime.now()
+        batch = {
+            'export_time': export_time
+        }
+        
+        self.headings = tuple(e.name for e in template.entries)
+        self.form_fingerprint = list(template.form_fingerprint)
+        self.required_fields = frozenset(template.get_required_fields())
+        self.widget_map = template.get_widget_map()
+        
+        self.field_slots = {}   # field name --> list of column indexes
+        self.filename_slots = []
+        self.timestamp_slots = []
+        self.entry_slots = []   # (column index, entry class, entry state) evaluated per row
+        self.entries = None     # Entries rebuilt from entry_slots. Not pickled
+        self.const_slots = []
+        self.computed_slots = [] # (column index, expression, indexes of its input columns)
+        
+        # Constant columns are pre-filled into the blank row
+        self.blank_row = [None] * len(self.headings)
+        
+        for i,e in enumerate(template.entries):
+            kind, arg = e.compile(batch)
+            if(kind == report_entries.COL_CONST):
+                self.blank_row[i] = clean_value(arg)
+                self.const_slots.append(i)
+            elif(kind == report_entries.COL_FIELD):
+                self.field_slots.setdefault(arg, []).append(i)
+            elif(kind == report_entries.COL_FILENAME):
+                self.filename_slots.append(i)
+            elif(kind == report_entries.COL_TIMESTAMP):
+                self.timestamp_slots.append(i)
+            elif(kind == report_entries.COL_COMPUTED):
+                self.computed_slots.append((i, arg, None))
+            else:
+                # Kept as plain data. The entry itself would pickle its whole parent template
+                state = dict(e.__dict__)
+                state['parent_template'] = None
+                self.entry_slots.append((i, e.__class__, state))
+        
+        self.computed_slots = [(i, expr, self.bind_columns(i, expr)) for i, expr, _ in self.computed_slots]
+    
+    def bind_columns(self, col, expr):
+        """ Resolves the column names an expression refers to. Computed columns can only refer
+        to columns that are not computed, or that are computed before them """
+        computed = set([i for i, e, cols in self.computed_slots])
+        indexes = []
+        for name in expr.columns:
+            if(name not in self.headings):
+                raise ValueError("'%s' refers to unknown column '%s'" % (self.headings[col], name))
+            i = self.headings.index(name)
+            if((i in computed) and (i >= col)):
+                raise ValueError("'%s' can not refer to '%s', which is computed after it" % (self.headings[col], name))
+            indexes.append(i)
+        return(indexes)
+    
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state['entries'] = None
+        return(state)
+    
+    def get_entries(self):
+        """ Returns (column index, entry) pairs of the entries that are evaluated per row.
+        The entries are detached: their parent_template is None """
+        if(self.entries == None):
+            entries = []
+            for i, cls, state in self.entry_slots:
+                e = cls.__new__(cls)
+                e.__dict__.update(state)
+                entries.append((i, e))
+            self.entries = entries
+        return(self.entries)
+    
+    def is_matching_form(self, form_data):
+        """ Same as ReportTemplate.is_matching_form() """
+        return(form_data.has_matching_fingerprint(self.form_fingerprint))
+    
+    def make_row(self, form_data):
+        """ Given a FormData object, returns a tuple of cleaned values in column order """
+        row = list(self.blank_row)
+        
+        fields = form_data.fields
+        for name, cols in self.field_slots.items():
+            v = clean_value(fields.get(name))
+            for i in cols:
+                row[i] = v
+        
+        for i in self.filename_slots:
+            row[i] = form_data.filename
+        
+        if(self.timestamp_slots):
+            v = form_data.timestamp.strftime(report_entries.TIMESTAMP_FORMAT)
+            for i in self.timestamp_slots:
+                row[i] = v
+        
+        if(self.entry_slots):
+            for i,e in self.get_entries():
+                row[i] = clean_value(e.get_value(form_data))
+        
+        return(tuple(row))
+    
+    def fill_computed(self, row):
+        """ Fills in the computed columns of a single row. DataTable.compute_columns() does the
+        same a whole column at a time """
+        if(len(self.computed_slots) == 0):
+            return(tuple(row))
+        
+        row = list(row)
+        for i, expr, cols in self.computed_slots:
+            row[i] = expr.evaluate_rows([[row[c]] for c in cols], 1)[0]
+        return(tuple(row))
+    
+    def fill_constants(self, row):
+        """ Replaces the batch-constant values in a row that was made by an earlier plan """
+        if(len(self.const_slots) == 0):
+            return(tuple(row))
+        
+        row = list(row)
+        for i in self.const_slots:
+            row[i] = self.blank_row[i]
+        return(tuple(row))
 
-
+#===================================================================================================
+def clean_value(v):
+    """ Cleans up a report value. Strings that look like numbers are converted """
+    if(not isinstance(v, str)):
+        return(v)
+    
+    v = v.strip()
+    # try converting string to a number
+    try:
+        v = ast.literal_eval(v)
+    except Exception:
+        pass
+    return(v)
 
 #===================================================================================================
 # Completely unrelated functions
@@ -113,6 +320,11 @@ class DataTable():
         self.headings = [] # array of column headings (to define column order)
         self.table = {} # dictionary of column arrays
         self.rowcount = 0
+        self.stats = None # column_stats.TableStats, if collecting
+        
+        # rollover.RolloverWriter that rows are passed on to, if streaming
+        self.writer = None
+        self.n_written = 0
         
     def init_blank(self, T):
         """Initialize the table using a template"""
@@ -123,6 +335,39 @@ class DataTable():
             self.headings.append(e.name)
             self.table[e.name] = []
 
+    def init_plan(self, plan, stats = False):
+        """Initialize the table using a compiled ExtractionPlan.
+        If stats is set, per-column statistics are collected as rows are appended and are
+        exported as a summary sheet"""
+        self.headings = list(plan.headings)
+        self.table = {}
+        self.rowcount = 0
+        for h in self.headings:
+            self.table[h] = []
+        
+        self.computed_slots = plan.computed_slots
+        self.computed_rowcount = 0
+        
+        if(stats):
+            self.stats = column_stats.TableStats(self.headings, [i for i, expr, cols in self.computed_slots])
+        else:
+            self.stats = None
+    
+    def compute_columns(self):
+        """ Fills in the computed columns, a whole column at a time """
+        computed_slots = getattr(self, "computed_slots", [])
+        if(len(computed_slots) == 0 or (self.computed_rowcount == self.rowcount)):
+            return
+        
+        cache = {}
+        for i, expr, cols in computed_slots:
+            inputs = [self.table[self.headings[c]] for c in cols]
+            self.table[self.headings[i]] = expr.evaluate(inputs, self.rowcount, cache)
+            if(self.stats != None):
+                # Rows before computed_rowcount were already counted. They come out the same
+                self.stats.add_column(i, self.table[self.headings[i]][self.computed_rowcount:])
+        self.computed_rowcount = self.rowcount
+    
     def append_row(self, row_dict):
         """ Append a row to the bottom of the table.
         row_dict is a dict of row data by column name """
@@ -133,15 +378,7 @@ class DataTable():
                 # Heading does not exist yet. Fill in blanks for past items
                 self.table[k] = [""] * self.rowcount
                 
-            # clean up value
-            v = v.strip()
-            # try converting string to a number
-            try:
-                v = ast.literal_eval(v)
-            except:
-                pass
-            
-            self.table[k].append(v)
+            self.table[k].append(clean_value(v))
             
         self.rowcount = self.rowcount + 1
         
@@ -150,16 +387,126 @@ class DataTable():
             if(len(self.table[hdr]) < self.rowcount):
                 self.table[hdr].append(None)
     
-    def export_excel(self, filename):
-        """ Export table to a new Excel file """
-        # convert table to array of rows
-        rows = [self.headings]
-        for y in range(self.rowcount):
-            row = []
-            for h in self.headings:
-                row.append(self.table[h][y])
-            rows.append(row)
+    def append_row_tuple(self, row):
+        """ Append a row produced by ExtractionPlan.make_row().
+        Values are already cleaned and are in the same order as the headings """
+        for h,v in zip(self.headings, row):
+            self.table[h].append(v)
+        if(self.stats != None):
+            self.stats.add_row(row)
         
-        sheet = pyexcel.Sheet(rows, self.name, name_columns_by_row=0)
-        sheet.save_as(filename)
+        self.rowcount = self.rowcount + 1
+        if((self.writer != None) and (self.rowcount >= self.stream_batch)):
+            self.flush()
+    
+    def iter_rows(self):
+        """ Yields the rows of the table, without headings """
+        self.compute_columns()
+        
+        columns = [self.table[h] for h in self.headings]
+        for y in range(self.rowcount):
+            yield([col[y] for col in columns])
+    
+    def get_rows(self):
+        """ Returns the table as a list of rows, headings first """
+        rows = [self.headings]
+        rows.extend(self.iter_rows())
+        return(rows)
+    
+    def get_stats_rows(self):
+        """ Returns the column statistics as a list of rows, or None if they were not collected """
+        if(self.stats == None):
+            return(None)
+        self.compute_columns()
+        return(self.stats.get_rows())
+    
+    def get_extra_sheets(self):
+        """ Sheets to write after the table's own """
+        rows = self.get_stats_rows()
+        if(rows == None):
+            return(None)
+        used = set([self.name.casefold(), rollover.INDEX_SHEET.casefold()])
+        return({column_stats.summary_sheet_name(self.name, used): rows})
+    
+    def export_excel(self, filename, max_rows = None, max_bytes = None, split_files = False):
+        """ Export table to a new Excel file.
+        Tables too big for one sheet are split into several sheets, or several files if
+        split_files is set (see rollover.RolloverWriter).
+        Returns the list of parts written """
+        W = rollover.RolloverWriter(filename, self.headings, self.name, max_rows, max_bytes, split_files)
+        try:
+            W.add_rows(self.iter_rows())
+            return(W.close(self.get_extra_sheets()))
+        except:
+            W.abort()
+            raise
+    
+    def export_stats_json(self, filename):
+        """ Writes the column statistics next to the exported file filename """
+        if(self.stats == None):
+            return
+        self.compute_columns()
+        self.stats.write_json(column_stats.sidecar_path(filename))
+    
+    #--------------------------------------------------------------------------
+    # Streaming export
+    #--------------------------------------------------------------------------
+    def stream_to(self, writer, batch_rows = STREAM_BATCH_ROWS):
+        """ Passes rows on to a rollover.RolloverWriter every batch_rows rows instead of keeping
+        them. Only the rows of the current batch are in the table """
+        self.writer = writer
+        self.stream_batch = batch_rows
+        self.n_written = 0
+    
+    def flush(self):
+        """ Sends the rows in the table to the writer and empties it """
+        if(self.rowcount == 0):
+            return
+        self.writer.add_rows(self.iter_rows())
+        self.n_written = self.n_written + self.rowcount
+        for h in self.headings:
+            self.table[h] = []
+        self.rowcount = 0
+        self.computed_rowcount = 0
+    
+    def finish(self):
+        """ Writes out the last rows, and the statistics if any. Returns the list of parts written """
+        self.flush()
+        W = self.writer
+        self.writer = None
+        return(W.close(self.get_extra_sheets()))
+    
+    def get_total_rows(self):
+        """ Number of rows appended, including ones already streamed out """
+        return(self.n_written + self.rowcount)
 
+def export_excel_book(tables, filename):
+    """ Export several DataTables to one Excel file, one sheet each.
+    Tables too big for one sheet are split over several, listed in an index sheet.
+    Tables that collected statistics also get a summary sheet.
+    Table names must be unique and valid sheet names """
+    max_rows = rollover.max_data_rows(filename)
+    index = [rollover.INDEX_HEADINGS]
+    sheets = {}
+    for TBL in tables:
+        rows = TBL.get_rows()
+        ranges = rollover.split_ranges(TBL.rowcount, max_rows)
+        if(len(ranges) == 1):
+            sheets[TBL.name] = rows
+            continue
+        for n, (start, end) in enumerate(ranges):
+            name = rollover.part_sheet_name(TBL.name, n + 1)
+            sheets[name] = [rows[0]] + rows[1+start:1+end]
+            index.append([n + 1, "", name, start + 1, end, end - start])
+    if(len(index) > 1):
+        sheets = dict([(rollover.INDEX_SHEET, index)] + list(sheets.items()))
+    
+    used = set([name.casefold() for name in sheets])
+    for TBL in tables:
+        rows = TBL.get_stats_rows()
+        if(rows != None):
+            name = column_stats.summary_sheet_name(TBL.name, used)
+            used.add(name.casefold())
+            sheets[name] = rows
+    book = pyexcel.Book(sheets)
+    book.save_as(filename)
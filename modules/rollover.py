@@ -0,0 +1,267 @@
+####################################################################################################
+# The MIT License (MIT)
+#
+# Copyright (c) 2015, Alexander I. Mykyta
+# All rights reserved.
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+# 
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+####################################################################################################
+
+# Writing reports that are too big for one sheet
+#
+# Rows are written in parts of at most max_rows rows (and roughly max_bytes of cell text). Each
+# part gets its own copy of the headings, and goes either into its own sheet of the output
+# workbook, or into its own numbered file next to it. An "Index" sheet lists which rows went
+# where. Output that fits in one part is written as a single sheet, with no index.
+#
+# Rows are spooled to a temporary file in batches of SPOOL_BATCH as they arrive, including the
+# part being filled. Only the batch being filled is kept in memory. Part files are written from
+# the spool as soon as their part is full, and sheets when the workbook is written.
+
+import os
+import pickle
+import tempfile
+import logging
+
+import pyexcel
+
+log = logging.getLogger("rollover")
+
+# Rows per sheet that each format can hold, including the heading row
+SHEET_ROW_LIMITS = {
+    ".xls": 65536,
+    ".xlsx": 1048576,
+    ".xlsm": 1048576,
+    ".ods": 1048576,
+}
+
+INDEX_SHEET = "Index"
+INDEX_HEADINGS = ["Part", "File", "Sheet", "First Row", "Last Row", "Rows"]
+
+SPOOL_BATCH = 1000 # Rows per pickle in the spool file
+
+#===================================================================================================
+def max_data_rows(filename):
+    """ Number of data rows that fit in one sheet of filename's format, or None if unlimited """
+    limit = SHEET_ROW_LIMITS.get(os.path.splitext(filename)[1].lower())
+    if(limit == None):
+        return(None)
+    return(limit - 1)
+
+def part_path(filename, n):
+    """ File name of part n (starting at 1) when splitting into several files """
+    root, ext = os.path.splitext(filename)
+    return("%s_%03d%s" % (root, n, ext))
+
+def part_sheet_name(name, n):
+    suffix = " %d" % n
+    return(name[:31 - len(suffix)] + suffix)
+
+def row_size(row):
+    """ Rough size of a row's cell text, in bytes """
+    size = len(row)
+    for v in row:
+        if(v != None):
+            size = size + len(str(v))
+    return(size)
+
+def split_ranges(n_rows, max_rows):
+    """ Returns [(start, end)] slices of at most max_rows rows covering n_rows rows """
+    if((max_rows == None) or (n_rows <= max_rows)):
+        return([(0, n_rows)])
+    return([(i, min(i + max_rows, n_rows)) for i in range(0, n_rows, max_rows)])
+
+#===================================================================================================
+class RolloverWriter:
+    """ Writes rows to filename, splitting into parts as needed.
+    
+    max_rows defaults to, and is capped at, what one sheet of the output format can hold.
+    max_bytes optionally limits the cell text in each part.
+    If split_files is set, parts are written to numbered files (see part_path()) and filename
+    only gets the index. Otherwise they are sheets of filename.
+    """
+    def __init__(self, filename, headings, name = "output", max_rows = None, max_bytes = None, split_files = False):
+        self.filename = filename
+        self.headings = list(headings)
+        self.name = name
+        self.split_files = split_files
+        
+        limit = max_data_rows(filename)
+        if((max_rows == None) or ((limit != None) and (max_rows > limit))):
+            max_rows = limit
+        self.max_rows = max_rows
+        self.max_bytes = max_bytes
+        
+        self.rows = [] # Batch being filled
+        self.part_rows = 0
+        self.part_bytes = 0
+        self.n_rows = 0
+        
+        # (file, sheet, first row, last row) of each finished part
+        self.parts = []
+        
+        # Spool file. Each part is a run of batches, starting at part_start
+        self.spool = None
+        self.part_start = 0
+        self.part_batches = 0
+        self.spool_batches = [] # Number of batches of each finished sheet part
+    
+    def add_row(self, row):
+        size = row_size(row) if self.max_bytes else 0
+        if(self.part_rows):
+            if((self.max_rows != None) and (self.part_rows >= self.max_rows)):
+                self.end_part()
+            elif(self.max_bytes and (self.part_bytes + size > self.max_bytes)):
+                self.end_part()
+        self.rows.append(row)
+        self.part_rows = self.part_rows + 1
+        self.part_bytes = self.part_bytes + size
+        if(len(self.rows) >= SPOOL_BATCH):
+            self.spool_rows()
+    
+    def add_rows(self, rows):
+        for row in rows:
+            self.add_row(row)
+    
+    #--------------------------------------------------------------------------
+    def spool_rows(self):
+        """ Moves the batch being filled to the spool file """
+        if(self.spool == None):
+            self.spool = tempfile.TemporaryFile()
+        self.spool.seek(0, 2)
+        pickle.dump(self.rows, self.spool, pickle.HIGHEST_PROTOCOL)
+        self.part_batches = self.part_batches + 1
+        self.rows = []
+    
+    def end_part(self):
+        n = len(self.parts) + 1
+        first = self.n_rows + 1
+        last = self.n_rows + self.part_rows
+        if(len(self.rows)):
+            self.spool_rows()
+        
+        if(self.split_files):
+            path = part_path(self.filename, n)
+            self.spool.seek(self.part_start)
+            pyexcel.isave_as(
+                array = self.iter_spooled_part(self.part_batches),
+                dest_file_name = path,
+                dest_sheet_name = self.name
+            )
+            self.parts.append((path, self.name, first, last))
+            log.info("Wrote rows %d-%d to %s" % (first, last, path))
+            
+            # Part is in its file now
+            self.spool.seek(0)
+            self.spool.truncate()
+        else:
+            self.spool_batches.append(self.part_batches)
+            self.parts.append((self.filename, part_sheet_name(self.name, n), first, last))
+        
+        self.n_rows = last
+        self.part_start = self.spool.seek(0, 2)
+        self.part_batches = 0
+        self.part_rows = 0
+        self.part_bytes = 0
+    
+    def iter_spooled_part(self, n_batches, rows = ()):
+        """ Yields the headings, n_batches batches from the spool file's current position, and
+        then rows """
+        yield(self.headings)
+        for i in range(n_batches):
+            for row in pickle.load(self.spool):
+                yield(row)
+        for row in rows:
+            yield(row)
+    
+    #--------------------------------------------------------------------------
+    def get_index_rows(self):
+        rows = [INDEX_HEADINGS]
+        for n, (path, sheet, first, last) in enumerate(self.parts):
+            # Parts in this workbook are only identified by their sheet
+            if(path == self.filename):
+                path = ""
+            rows.append([n + 1, os.path.basename(path), sheet, first, last, last - first + 1])
+        return(rows)
+    
+    def close(self, extra_sheets = None):
+        """ Writes out everything that is left.
+        extra_sheets is an optional dict of sheet name --> rows to add to filename.
+        Returns the list of parts, as (file, sheet, first row, last row) """
+        if(len(self.parts) == 0):
+            # Everything fit in one part. Its last batch may still be in memory
+            last = self.n_rows + self.part_rows
+            if(self.spool != None):
+                self.spool.seek(self.part_start)
+            part = self.iter_spooled_part(self.part_batches, self.rows)
+            try:
+                if(extra_sheets):
+                    sheets = {self.name: part}
+                    sheets.update(extra_sheets)
+                    pyexcel.isave_book_as(bookdict = sheets, dest_file_name = self.filename)
+                else:
+                    pyexcel.isave_as(
+                        array = part,
+                        dest_file_name = self.filename,
+                        dest_sheet_name = self.name
+                    )
+            finally:
+                self.close_spool()
+            self.parts.append((self.filename, self.name, self.n_rows + 1, last))
+            self.n_rows = last
+            self.rows = []
+            self.part_rows = 0
+            return(self.parts)
+        
+        if(self.part_rows):
+            self.end_part()
+        
+        sheets = {}
+        sheets[INDEX_SHEET] = self.get_index_rows()
+        if(not self.split_files):
+            self.spool.seek(0)
+            for (path, sheet, first, last), n_batches in zip(self.parts, self.spool_batches):
+                sheets[sheet] = self.iter_spooled_part(n_batches)
+        if(extra_sheets):
+            sheets.update(extra_sheets)
+        
+        try:
+            pyexcel.isave_book_as(bookdict = sheets, dest_file_name = self.filename)
+        finally:
+            self.close_spool()
+        log.info("Wrote %d rows in %d parts" % (self.n_rows, len(self.parts)))
+        return(self.parts)
+    
+    def close_spool(self):
+        if(self.spool != None):
+            self.spool.close()
+            self.spool = None
+    
+    def abort(self):
+        """ Discards everything, including part files that were already written """
+        self.close_spool()
+        self.rows = []
+        self.part_rows = 0
+        for path, sheet, first, last in self.parts:
+            if(path != self.filename):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+        self.parts = []
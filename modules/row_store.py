@@ -0,0 +1,140 @@
+####################################################################################################
+# The MIT License (MIT)
+#
+# Copyright (c) 2015, Alexander I. Mykyta
+# All rights reserved.
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+# 
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+####################################################################################################
+
+import sys
+import array
+import pickle
+import tempfile
+import threading
+import logging
+
+log = logging.getLogger("row_store")
+
+DEFAULT_MAX_BYTES = 256 * 1024 * 1024
+
+#===================================================================================================
+def estimate_size(row):
+    """ Rough number of bytes a row tuple occupies in memory """
+    n = sys.getsizeof(row)
+    for v in row:
+        n = n + sys.getsizeof(v)
+    return(n)
+
+def estimate_packed_size(packed):
+    """ Same as estimate_size(), for a row packed by form_data.FieldSchema """
+    codes, extra = packed
+    return(sys.getsizeof(codes) + estimate_size(extra))
+
+#===================================================================================================
+class RowStore:
+    """ Keeps report rows in memory up to a byte budget.
+    
+    Once the budget is exceeded, the oldest rows are pickled to an anonymous temporary file and
+    read back from there on demand.
+    schema is an optional form_data.FieldSchema of the rows. Rows are then kept packed as value
+    codes, in memory and in the spill file. The encoded values themselves always stay in memory.
+    Thread safe, since rows are added by import workers and read by the export.
+    """
+    def __init__(self, max_bytes = DEFAULT_MAX_BYTES, schema = None):
+        self.max_bytes = max_bytes
+        self.schema = schema
+        self.lock = threading.Lock()
+        
+        self.mem_rows = {}  # key --> (row, size). Insertion order is the spill order
+        self.mem_bytes = 0
+        
+        # Location of spilled rows in spill_file, indexed by key. Offset is -1 if not spilled
+        self.offsets = array.array('q')
+        self.lengths = array.array('l')
+        self.spill_file = None
+    
+    def add(self, row):
+        """ Stores a row. Returns the key to get it back with """
+        with self.lock:
+            key = len(self.offsets)
+            self.offsets.append(-1)
+            self.lengths.append(0)
+            
+            if(self.schema != None):
+                row = self.schema.pack(row)
+                size = estimate_packed_size(row)
+            else:
+                size = estimate_size(row)
+            self.mem_rows[key] = (row, size)
+            self.mem_bytes = self.mem_bytes + size
+            
+            while((self.mem_bytes > self.max_bytes) and (len(self.mem_rows) > 1)):
+                self.spill_oldest()
+        
+        return(key)
+    
+    def get(self, key):
+        with self.lock:
+            if(key in self.mem_rows):
+                row = self.mem_rows[key][0]
+            else:
+                if(self.offsets[key] < 0):
+                    raise KeyError(key)
+                self.spill_file.seek(self.offsets[key])
+                row = pickle.loads(self.spill_file.read(self.lengths[key]))
+            
+            if(self.schema != None):
+                row = self.schema.unpack(row)
+            return(row)
+    
+    def discard(self, key):
+        """ Forgets a row. Space in the spill file is not reclaimed """
+        with self.lock:
+            if(key in self.mem_rows):
+                row, size = self.mem_rows.pop(key)
+                self.mem_bytes = self.mem_bytes - size
+            else:
+                self.offsets[key] = -1
+    
+    def spill_oldest(self):
+        if(self.spill_file == None):
+            self.spill_file = tempfile.TemporaryFile(prefix="pdform_rows_")
+            log.info("Row memory budget exceeded. Spilling rows to disk")
+        
+        key = next(iter(self.mem_rows))
+        row, size = self.mem_rows.pop(key)
+        self.mem_bytes = self.mem_bytes - size
+        
+        data = pickle.dumps(row, pickle.HIGHEST_PROTOCOL)
+        self.spill_file.seek(0, 2)
+        offset = self.spill_file.tell()
+        self.spill_file.write(data)
+        self.offsets[key] = offset
+        self.lengths[key] = len(data)
+    
+    def close(self):
+        with self.lock:
+            if(self.spill_file):
+                self.spill_file.close()
+                self.spill_file = None
+            self.mem_rows = {}
+            self.mem_bytes = 0
+            self.offsets = array.array('q')
+            self.lengths = array.array('l')
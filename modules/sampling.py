@@ -0,0 +1,182 @@
+####################################################################################################
+# The MIT License (MIT)
+#
+# Copyright (c) 2015, Alexander I. Mykyta
+# All rights reserved.
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+# 
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+####################################################################################################
+
+# Previewing a template on a sample of a large corpus
+#
+# Files are drawn in an order given by a hash of the seed and the file name, so the same seed
+# always gives the same sample, and drawing more extends it instead of starting over.
+# With strata, files are grouped (by folder, size or date) and drawn from each group in turn,
+# so that small groups show up early.
+#
+# The sampled forms are parsed once, with all of their fields. The preview rows are remade
+# from them each time the template changes.
+
+import os
+import heapq
+import hashlib
+import datetime
+import logging
+
+from . import form_data
+from . import report_template
+from . import archives
+from . import schedule
+from . import batch
+
+log = logging.getLogger("sampling")
+
+STRATA_NONE = "None"
+STRATA_DIR = "Folder"
+STRATA_SIZE = "Size"
+STRATA_DATE = "Month"
+STRATA = (STRATA_NONE, STRATA_DIR, STRATA_SIZE, STRATA_DATE)
+
+# Status of a sampled file
+ST_MATCH = "match"
+ST_MISMATCH = "mismatch"
+ST_INVALID = "invalid"
+
+#===================================================================================================
+def load_source(path):
+    """ Returns the files of a folder (searched like a batch job) or a manifest file """
+    if(os.path.isdir(path)):
+        return(batch.find_pdfs(path))
+    return(batch.read_manifest(path))
+
+def sample_key(seed, filename):
+    h = hashlib.blake2b(("%s\0%s" % (seed, filename)).encode("utf-8", "surrogateescape"), digest_size=8)
+    return(int.from_bytes(h.digest(), "big"))
+
+def get_mtime(path):
+    # Members of archives are dated by their archive
+    archive, member = archives.split_path(path)
+    try:
+        return(os.path.getmtime(archive or path))
+    except OSError:
+        return(0)
+
+def get_labels(filenames, strata):
+    """ Returns the stratum of each file """
+    if(strata == STRATA_DIR):
+        return([os.path.dirname(f) for f in filenames])
+    elif(strata == STRATA_SIZE):
+        # Powers of two
+        return([size.bit_length() for size in schedule.get_file_sizes(filenames)])
+    elif(strata == STRATA_DATE):
+        return([datetime.date.fromtimestamp(get_mtime(f)).strftime("%Y-%m") for f in filenames])
+    else:
+        return([None] * len(filenames))
+
+#===================================================================================================
+class Sampler:
+    """ Draws files from a corpus in a reproducible random order, optionally stratified """
+    def __init__(self, filenames, seed = 0, strata = STRATA_NONE):
+        self.seed = seed
+        self.strata = strata
+        self.n_total = len(filenames)
+        self.n_drawn = 0
+        
+        groups = {}
+        for f, label in zip(filenames, get_labels(filenames, strata)):
+            groups.setdefault(label, []).append((sample_key(seed, f), f))
+        
+        # One heap per stratum, in a stable order
+        self.heaps = []
+        for label in sorted(groups, key=str):
+            heap = groups[label]
+            heapq.heapify(heap)
+            self.heaps.append(heap)
+        self.turn = 0
+    
+    def draw(self, n):
+        """ Returns the next n files of the sample, or fewer if the corpus runs out """
+        result = []
+        while((len(result) < n) and len(self.heaps)):
+            if(self.turn >= len(self.heaps)):
+                self.turn = 0
+            heap = self.heaps[self.turn]
+            result.append(heapq.heappop(heap)[1])
+            if(len(heap) == 0):
+                # Stratum is used up. The next one moves into its turn
+                self.heaps.pop(self.turn)
+            else:
+                self.turn = self.turn + 1
+        self.n_drawn = self.n_drawn + len(result)
+        return(result)
+    
+    def is_exhausted(self):
+        return(len(self.heaps) == 0)
+
+#===================================================================================================
+class Preview:
+    """ Parsed forms of a sample, and the report rows a template makes from them """
+    def __init__(self, sampler):
+        self.sampler = sampler
+        self.forms = [] # FormData of each sampled file, in the order drawn
+    
+    def iter_extend(self, n):
+        """ Draws and parses n more files. Yields each filename as it is parsed """
+        for pf in archives.iter_files(self.sampler.draw(n)):
+            F = None
+            if(pf.error == None):
+                try:
+                    F = form_data.FormData(pf.filename, None, None, pf.data, pf.timestamp)
+                except Exception as E:
+                    log.warning("Failed to read '%s': %s" % (pf.filename, E))
+            if(F == None):
+                F = form_data.FormSummary(pf.filename, False)
+            self.forms.append(F)
+            yield(pf.filename)
+    
+    def extend(self, n):
+        for filename in self.iter_extend(n):
+            pass
+    
+    def get_rows(self, T):
+        """ Returns (headings, [(filename, status, row)]) for a template. row is None unless the
+        form matches the template """
+        plan = T.compile()
+        
+        # The rows go through a table so that computed columns are filled in
+        TBL = report_template.DataTable()
+        TBL.init_plan(plan)
+        results = []
+        for F in self.forms:
+            if(not F.valid):
+                results.append([F.filename, ST_INVALID, None])
+            elif(not plan.is_matching_form(F)):
+                results.append([F.filename, ST_MISMATCH, None])
+            else:
+                TBL.append_row_tuple(plan.make_row(F))
+                results.append([F.filename, ST_MATCH, TBL.rowcount - 1])
+        
+        rows = TBL.get_rows()
+        for r in results:
+            if(r[2] != None):
+                r[2] = rows[1 + r[2]]
+        return((plan.headings, [tuple(r) for r in results]))
+    
+    def get_summary(self):
+        return("%d of %d files sampled" % (len(self.forms), self.sampler.n_total))
@@ -0,0 +1,198 @@
+####################################################################################################
+# The MIT License (MIT)
+#
+# Copyright (c) 2015, Alexander I. Mykyta
+# All rights reserved.
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+# 
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+####################################################################################################
+
+# Size-aware chunking of batch jobs
+#
+# Parse time grows with file size. If chunks hold a fixed number of files and are worked on in
+# manifest order, a few huge PDFs near the end of the manifest stretch out the end of the job
+# while the other workers sit idle.
+#
+# Instead, chunks are cut so that they cost about the same, with any file that costs more than
+# that in a chunk of its own. Chunks stay contiguous ranges of the manifest, so the shards still
+# merge in manifest order no matter which order they finish in.
+# Workers take chunks from the shared pool biggest first (longest processing time first), so
+# the small chunks are left to fill in the gaps at the end.
+# Members of a tar can only be reached by decompressing the archive from its start, so the
+# members of one tar are never split across chunks. A big tar becomes one big chunk, which is
+# claimed early.
+#
+#   python -m modules.schedule      Runs a makespan benchmark on simulated skewed corpora
+
+import os
+import sys
+import heapq
+import random
+import logging
+import argparse
+
+from . import archives
+
+log = logging.getLogger("schedule")
+
+# Fixed cost of a file on top of its size, in bytes. Opening and parsing even a tiny file costs
+# about as much as reading this many more bytes of a large one
+FILE_OVERHEAD_BYTES = 64 * 1024
+
+# Chunks to aim for in a job. Workers that run out of chunks sit idle, so the last rounds of
+# chunks should be small compared to the whole job
+MIN_CHUNKS = 256
+
+#===================================================================================================
+def get_file_sizes(filenames):
+    """ Returns the size of each file, or 0 if it can not be found.
+    Members of archives are looked up in the archive's listing """
+    listings = {}
+    sizes = []
+    for path in filenames:
+        archive, member = archives.split_path(path)
+        if(archive == None):
+            try:
+                sizes.append(os.path.getsize(path))
+            except OSError:
+                sizes.append(0)
+            continue
+        
+        if(archive not in listings):
+            try:
+                listings[archive] = archives.member_sizes(archive)
+            except Exception as E:
+                log.warning("Could not list archive '%s': %s" % (archive, E))
+                listings[archive] = {}
+        sizes.append(listings[archive].get(member, 0))
+    return(sizes)
+
+def get_tar_links(filenames):
+    """ Returns a list with True for each file that is a member of the same tar as the file
+    before it. Those files have to go in the same chunk """
+    links = []
+    prev = None
+    for path in filenames:
+        archive, member = archives.split_path(path)
+        if((archive != None) and archives.is_zip(archive)):
+            # Zip members can be read on their own
+            archive = None
+        links.append((archive != None) and (archive == prev))
+        prev = archive
+    return(links)
+
+def file_cost(size):
+    return(size + FILE_OVERHEAD_BYTES)
+
+#===================================================================================================
+def fixed_chunks(sizes, chunk_size):
+    """ Chunks of chunk_size files each. Returns a list of (start, end, cost) """
+    chunks = []
+    for start in range(0, len(sizes), chunk_size):
+        end = min(start + chunk_size, len(sizes))
+        chunks.append((start, end, sum([file_cost(s) for s in sizes[start:end]])))
+    return(chunks)
+
+def balanced_chunks(sizes, chunk_size, min_chunks = MIN_CHUNKS, links = None):
+    """ Cuts the manifest into contiguous chunks of about equal cost, each with at most
+    chunk_size files. Aims for at least min_chunks chunks, so that the work can still be spread
+    evenly as the job runs out.
+    links is an optional list from get_tar_links(). A chunk is never cut in front of a linked
+    file, even if that makes it bigger than chunk_size.
+    Returns a list of (start, end, cost) """
+    if(len(sizes) == 0):
+        return([])
+    costs = [file_cost(s) for s in sizes]
+    n_chunks = max((len(sizes) + chunk_size - 1) // chunk_size, min(min_chunks, len(sizes)))
+    target = sum(costs) / n_chunks
+    
+    chunks = []
+    start = 0
+    cost = 0
+    for i, c in enumerate(costs):
+        linked = (links != None) and links[i]
+        if((i > start) and (not linked) and ((i - start >= chunk_size) or (cost + c > target))):
+            chunks.append((start, i, cost))
+            start = i
+            cost = 0
+        cost = cost + c
+    chunks.append((start, len(costs), cost))
+    return(chunks)
+
+def claim_order(chunks):
+    """ Returns chunk numbers, most costly first """
+    return(sorted(range(len(chunks)), key=lambda c: (-chunks[c][2], c)))
+
+#===================================================================================================
+# Benchmark
+#===================================================================================================
+def simulate(chunks, order, n_workers):
+    """ Simulates workers taking the next chunk in order from a shared pool as soon as they are
+    free. Cost is taken as time. Returns the makespan """
+    free_at = [0] * n_workers
+    for c in order:
+        t = heapq.heappop(free_at)
+        heapq.heappush(free_at, t + chunks[c][2])
+    return(max(free_at))
+
+def skewed_corpus(n_files, n_huge, rng, huge_at_end = True):
+    """ File sizes of a corpus of mostly small forms and a few huge scanned packets """
+    sizes = [int(rng.lognormvariate(12, 0.5)) for i in range(n_files - n_huge)] # ~160 KB
+    huge = [int(rng.uniform(50, 200) * 1024 * 1024) for i in range(n_huge)]
+    if(huge_at_end):
+        return(sizes + huge)
+    sizes = sizes + huge
+    rng.shuffle(sizes)
+    return(sizes)
+
+def benchmark(n_files = 20000, n_huge = 12, n_workers = 16, chunk_size = 200, seed = 1):
+    rng = random.Random(seed)
+    lines = []
+    lines.append("%d files, %d huge, %d workers, chunk size %d" % (n_files, n_huge, n_workers, chunk_size))
+    lines.append("%-22s %14s %14s %14s" % ("corpus", "manifest order", "size-aware", "lower bound"))
+    for name, huge_at_end in (("huge files at end", True), ("huge files shuffled", False)):
+        sizes = skewed_corpus(n_files, n_huge, rng, huge_at_end)
+        costs = [file_cost(s) for s in sizes]
+        bound = max(sum(costs) / n_workers, max(costs))
+        
+        old = fixed_chunks(sizes, chunk_size)
+        old_makespan = simulate(old, range(len(old)), n_workers)
+        new = balanced_chunks(sizes, chunk_size)
+        new_makespan = simulate(new, claim_order(new), n_workers)
+        lines.append("%-22s %13.2fx %13.2fx %13.2fx" % (
+            name, old_makespan / bound, new_makespan / bound, 1.0
+        ))
+    lines.append("(makespan relative to the lower bound)")
+    return("\n".join(lines))
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(
+        prog = "python -m modules.schedule",
+        description = "Compare the makespan of fixed and size-aware chunking on simulated corpora"
+    )
+    parser.add_argument("--files", type = int, default = 20000)
+    parser.add_argument("--huge", type = int, default = 12, help = "Number of huge files")
+    parser.add_argument("-j", "--workers", type = int, default = 16)
+    parser.add_argument("--chunk-size", type = int, default = 200)
+    args = parser.parse_args(argv)
+    print(benchmark(args.files, args.huge, args.workers, args.chunk_size))
+    return(0)
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,137 @@
+####################################################################################################
+# The MIT License (MIT)
+#
+# Copyright (c) 2015, Alexander I. Mykyta
+# All rights reserved.
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+# 
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+####################################################################################################
+
+# Finding the templates that are closest to a form that does not match any of them exactly
+#
+# A form is compared by its set of field names. Each template's set is reduced to a MinHash
+# signature, which is split into bands. Templates that share any whole band with the form are
+# the candidates. Only the candidates are compared exactly.
+#
+# With the defaults (16 bands of 4), a template that shares half of its fields with the form is
+# found ~65% of the time, and one that shares 80% is found almost always.
+
+import random
+import logging
+
+from . import pdf_parser
+
+log = logging.getLogger("template_index")
+
+DEFAULT_NUM_PERM = 64
+DEFAULT_BANDS = 16
+DEFAULT_MIN_SIMILARITY = 0.5
+
+_PRIME = (1 << 61) - 1
+
+#===================================================================================================
+class MinHasher:
+    """ Computes MinHash signatures of sets of strings """
+    
+    # Per-string hash vectors are cached. Field names repeat a lot between forms
+    MAX_CACHE = 100000
+    
+    def __init__(self, num_perm = DEFAULT_NUM_PERM, seed = 1):
+        # Fixed seed so signatures are comparable between runs
+        rng = random.Random(seed)
+        self.perms = []
+        for i in range(num_perm):
+            self.perms.append((rng.randrange(1, _PRIME), rng.randrange(0, _PRIME)))
+        self.cache = {}
+    
+    def hash_vector(self, s):
+        v = self.cache.get(s)
+        if(v == None):
+            h = pdf_parser.fnv_hash32(s)
+            v = tuple([(a*h + b) % _PRIME for a,b in self.perms])
+            if(len(self.cache) >= self.MAX_CACHE):
+                self.cache.clear()
+            self.cache[s] = v
+        return(v)
+    
+    def signature(self, names):
+        """ Returns the signature of a set of strings, or None if it is empty """
+        vectors = [self.hash_vector(s) for s in names]
+        if(len(vectors) == 0):
+            return(None)
+        return(tuple(map(min, zip(*vectors))))
+
+#===================================================================================================
+def jaccard(a, b):
+    if((len(a) == 0) and (len(b) == 0)):
+        return(1.0)
+    return(len(a & b) / len(a | b))
+
+class TemplateIndex:
+    """ Similarity index over the field names of a list of templates """
+    
+    def __init__(self, templates, num_perm = DEFAULT_NUM_PERM, bands = DEFAULT_BANDS):
+        if(num_perm % bands):
+            raise ValueError("num_perm must be a multiple of bands")
+        self.hasher = MinHasher(num_perm)
+        self.bands = bands
+        self.rows = num_perm // bands
+        
+        self.templates = []
+        self.field_sets = []
+        self.buckets = {} # (band number, band of signature) --> [template index, ...]
+        
+        for T in templates:
+            self.add(T)
+    
+    def band_keys(self, sig):
+        for i in range(self.bands):
+            yield((i, sig[i*self.rows:(i+1)*self.rows]))
+    
+    def add(self, T):
+        idx = len(self.templates)
+        self.templates.append(T)
+        self.field_sets.append(frozenset(T.avail_fields))
+        
+        sig = self.hasher.signature(T.avail_fields)
+        if(sig == None):
+            return
+        for key in self.band_keys(sig):
+            self.buckets.setdefault(key, []).append(idx)
+    
+    def query(self, field_names, max_results = 3, min_similarity = DEFAULT_MIN_SIMILARITY):
+        """ Returns up to max_results (similarity, template) pairs, most similar first.
+        similarity is the Jaccard similarity of the field name sets, from 0 to 1 """
+        names = frozenset(field_names)
+        sig = self.hasher.signature(names)
+        if(sig == None):
+            return([])
+        
+        candidates = set()
+        for key in self.band_keys(sig):
+            candidates.update(self.buckets.get(key, ()))
+        
+        results = []
+        for idx in candidates:
+            score = jaccard(names, self.field_sets[idx])
+            if(score >= min_similarity):
+                results.append((score, idx))
+        results.sort(key=lambda r: (-r[0], r[1]))
+        
+        return([(score, self.templates[idx]) for score, idx in results[:max_results]])
@@ -0,0 +1,262 @@
+####################################################################################################
+# The MIT License (MIT)
+#
+# Copyright (c) 2015, Alexander I. Mykyta
+# All rights reserved.
+# 
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+# 
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+# 
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+####################################################################################################
+
+# Inverted index over the report rows of loaded forms
+#
+# Only the report's columns (the plan's headings) are indexed, with the values that the report
+# would export. The raw PDF fields in FormData.fields are not, so a query can only name a field
+# that the report has a column for.
+#
+# For every column: value --> set of row keys. The rows themselves stay in a row_store.RowStore,
+# and the keys are their keys there. Indexed values and query values go through the same
+# normalize(): text is converted like report_template.clean_value() does, so "1.50" finds 1.5,
+# and is then compared as a stripped, case-folded string. Empty and missing values are both
+# indexed as "".
+#
+# Queries are one or more conditions joined with "&":
+#   City = Toronto          equal
+#   City != Toronto         not equal
+#   Name ^= Al              starts with
+#   Postcode is empty
+#   Postcode is not empty
+# A column name or value that contains "&" (or starts or ends with spaces) can be put in double
+# quotes, with "" for a quote inside:
+#   Company = "Smith & Sons"
+
+import re
+import bisect
+import logging
+import functools
+
+from .report_template import clean_value
+
+log = logging.getLogger("value_index")
+
+OP_EQ = "="
+OP_NE = "!="
+OP_PREFIX = "^="
+OP_EMPTY = "empty"
+OP_NOT_EMPTY = "not empty"
+
+_COND_EMPTY = re.compile(r'^(.+?)\s+is\s+(not\s+)?empty$', re.IGNORECASE)
+_COND_COMPARE = re.compile(r'^(.+?)\s*(!=|\^=|=)\s*(.*)$')
+
+#===================================================================================================
+def normalize(v):
+    """ Converts a row value or a query value to the string it is indexed and compared as """
+    if(v == None):
+        return("")
+    if(isinstance(v, str)):
+        return(_normalize_text(v))
+    return(_normalize_value(v))
+
+@functools.lru_cache(maxsize = 65536)
+def _normalize_text(v):
+    # Rows repeat the same few strings, and converting them is slow
+    return(_normalize_value(clean_value(v)))
+
+def _normalize_value(v):
+    if(isinstance(v, float) and v.is_integer()):
+        v = int(v)
+    return(str(v).strip().casefold())
+
+def split_query(text):
+    """ Splits a query at the "&"s that are not inside double quotes """
+    parts = []
+    start = 0
+    quoted = False
+    for i, c in enumerate(text):
+        if(c == '"'):
+            quoted = not quoted
+        elif((c == "&") and not quoted):
+            parts.append(text[start:i])
+            start = i + 1
+    if(quoted):
+        raise ValueError("Missing closing quote in '%s'" % text[start:].strip())
+    parts.append(text[start:])
+    return(parts)
+
+def unquote(s):
+    s = s.strip()
+    if((len(s) >= 2) and s.startswith('"') and s.endswith('"')):
+        s = s[1:-1].replace('""', '"')
+    return(s)
+
+def parse_query(text, columns):
+    """ Parses a query into a list of (column, op, value) conditions.
+    Raises ValueError if the query is not understood """
+    columns_cf = {}
+    for c in columns:
+        columns_cf.setdefault(c.strip().casefold(), c)
+    
+    conditions = []
+    for part in split_query(text):
+        part = part.strip()
+        if(not part):
+            continue
+        
+        m = _COND_EMPTY.match(part)
+        if(m):
+            column = m.group(1)
+            op = OP_NOT_EMPTY if m.group(2) else OP_EMPTY
+            value = ""
+        else:
+            m = _COND_COMPARE.match(part)
+            if(m == None):
+                raise ValueError("Could not understand '%s'" % part)
+            column, op, value = m.groups()
+        
+        column = unquote(column)
+        key = column.strip().casefold()
+        if(key not in columns_cf):
+            raise ValueError("No column named '%s'" % column.strip())
+        value = unquote(value)
+        if(op == OP_PREFIX):
+            # Partial text is not converted: "1." is the start of "1.5"
+            value = value.strip().casefold()
+        else:
+            value = normalize(value)
+        conditions.append((columns_cf[key], op, value))
+    return(conditions)
+
+#===================================================================================================
+class ValueIndex:
+    """ Incrementally built index of the rows in a row_store.RowStore
+    
+    Indexes the report's columns, not FormData.fields.
+    Only the postings are held here. Rows are read back from the store when one is removed or
+    checked against a filter, so the store's memory budget still applies to them.
+    Rows must be complete when they are added. Computed columns that are still None are
+    indexed as empty.
+    """
+    
+    def __init__(self, headings, store):
+        self.headings = tuple(headings)
+        self.store = store
+        self.col_of = {}
+        for i, h in enumerate(self.headings):
+            self.col_of.setdefault(h, i)
+        
+        self.postings = [{} for h in self.headings] # per column: value --> set of keys
+        self.sorted_values = [None for h in self.headings] # Built when a prefix query needs it
+        self.keys = set()
+    
+    def __len__(self):
+        return(len(self.keys))
+    
+    def add(self, key, row):
+        """ Indexes row, which is stored in the store under key """
+        if(key in self.keys):
+            self.remove(key)
+        
+        self.keys.add(key)
+        for col, v in enumerate(row):
+            v = normalize(v)
+            p = self.postings[col]
+            keys = p.get(v)
+            if(keys == None):
+                keys = p[v] = set()
+                self.sorted_values[col] = None
+            keys.add(key)
+    
+    def remove(self, key):
+        """ Call before the row is discarded from the store """
+        if(key not in self.keys):
+            return
+        self.keys.discard(key)
+        for col, v in enumerate(self.store.get(key)):
+            v = normalize(v)
+            p = self.postings[col]
+            keys = p[v]
+            keys.discard(key)
+            if(len(keys) == 0):
+                del p[v]
+                self.sorted_values[col] = None
+    
+    #--------------------------------------------------------------------------
+    def lookup(self, column, op, value):
+        """ Returns the set of keys that satisfy one condition """
+        col = self.col_of[column]
+        p = self.postings[col]
+        
+        if(op == OP_EQ):
+            return(set(p.get(value, ())))
+        elif(op == OP_EMPTY):
+            return(set(p.get("", ())))
+        elif(op == OP_NE):
+            return(self.keys.difference(p.get(value, ())))
+        elif(op == OP_NOT_EMPTY):
+            return(self.keys.difference(p.get("", ())))
+        elif(op == OP_PREFIX):
+            values = self.sorted_values[col]
+            if(values == None):
+                values = self.sorted_values[col] = sorted(p.keys())
+            result = set()
+            i = bisect.bisect_left(values, value)
+            while((i < len(values)) and values[i].startswith(value)):
+                result.update(p[values[i]])
+                i = i + 1
+            return(result)
+        raise ValueError("Unknown operator '%s'" % op)
+    
+    def query(self, conditions):
+        """ Returns the set of keys that satisfy all conditions """
+        # Narrow down with the positive conditions first. The negative ones are then removed
+        # from that, instead of being expanded to nearly every key
+        negative = {OP_NE: OP_EQ, OP_NOT_EMPTY: OP_EMPTY}
+        result = None
+        for column, op, value in sorted(conditions, key=lambda c: c[1] in negative):
+            if(result == None):
+                result = self.lookup(column, op, value)
+            elif(op in negative):
+                result.difference_update(self.lookup(column, negative[op], value))
+            else:
+                result.intersection_update(self.lookup(column, op, value))
+            if(len(result) == 0):
+                break
+        if(result == None):
+            return(set(self.keys))
+        return(result)
+    
+    def matches(self, key, conditions):
+        """ Checks one indexed row against the conditions without a full query """
+        if(key not in self.keys):
+            return(False)
+        row = self.store.get(key)
+        for column, op, value in conditions:
+            v = normalize(row[self.col_of[column]])
+            if(op == OP_EQ):
+                ok = (v == value)
+            elif(op == OP_NE):
+                ok = (v != value)
+            elif(op == OP_PREFIX):
+                ok = v.startswith(value)
+            elif(op == OP_EMPTY):
+                ok = (v == "")
+            else:
+                ok = (v != "")
+            if(not ok):
+                return(False)
+        return(True)
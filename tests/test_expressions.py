@@ -0,0 +1,87 @@
+# Checks that computed columns give the same values whether they are evaluated on numpy arrays
+# (export) or row by row (preview and filter)
+#
+#   python -m pytest tests
+
+import os
+import sys
+import random
+
+import pytest
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, ROOT)
+
+from modules import expressions
+
+numpy = pytest.importorskip("numpy")
+
+#===================================================================================================
+def make_columns(n_rows, seed):
+    """ Columns of the kinds that clean_value() produces """
+    rng = random.Random(seed)
+    def pick(choices):
+        return([rng.choice(choices) for y in range(n_rows)])
+    return({
+        'a': pick([0, 1, 2, 5, -3, 7, 12]),
+        'b': pick([1, 2, 2.5, -0.75, 4, None, ""]),
+        'c': pick([3, 0, 10, 1.5, None]),
+        'name': pick(["Ada", "Alan", "", None, "Grace"]),
+        'flag': pick([True, False, None]),
+        'big': pick([2**60, 3, None]),
+    })
+
+EXPRESSIONS = [
+    "{a} + 1",
+    "{b} + 1",
+    "{a} * {b} - {c}",
+    "{a} / {c}",
+    "{a} // 2 + {b} % 2",
+    "{b} ** 2",
+    "-{b}",
+    "text({a})",
+    "text({b}) + \"!\"",
+    "where({a} > 1, \"big\", \"small\")",
+    "where({b} > 1, \"big\", \"small\")",
+    "where({b} > 1, {a}, \"none\")",
+    "where({b} > 1, {a} > 2, 0)",
+    "max({a}, 2)",
+    "max({b}, 2)",
+    "min({b}, {c})",
+    "max({a}, {b}, {c})",
+    "abs({b})",
+    "round({b})",
+    "round({b} / 3, 2)",
+    "num({b}) + num({c})",
+    "({a} > 1) & ({b} < 3)",
+    "({a} > 1) + ({b} > 1)",
+    "~({a} > 1)",
+    "{name} + \" \" + {name}",
+    "{name} == \"Ada\"",
+    "{flag} + 1",
+    "max({flag}, 0)",
+    "{big} + 1",
+    "{a} * 2**52",
+    "7",
+    "1 / 0",
+]
+
+#===================================================================================================
+@pytest.mark.parametrize("text", EXPRESSIONS)
+def test_vectorised_matches_rows(text):
+    expr = expressions.Expression(text)
+    for seed in range(5):
+        columns = make_columns(200, seed)
+        inputs = [columns[name] for name in expr.columns]
+        expected = expr.evaluate_rows(inputs, 200)
+        result = expr.evaluate(inputs, 200)
+        assert([(v, type(v)) for v in result] == [(v, type(v)) for v in expected])
+
+@pytest.mark.parametrize("text", ["{a} + 1", "{b} + {c}", "where({b} > 1, \"big\", \"small\")", "max({b}, 2)"])
+def test_common_expressions_are_vectorised(text):
+    # Blanks in the input must not stop an expression from being vectorised
+    expr = expressions.Expression(text)
+    columns = make_columns(200, 0)
+    inputs = [columns[name] for name in expr.columns]
+    assert(expr.vectorise)
+    assert(expr.evaluate_numpy(inputs, 200) == expr.evaluate_rows(inputs, 200))
@@ -0,0 +1,145 @@
+# Cross-checks the fast_pdf reader against pdfminer
+#
+#   python -m pytest tests
+
+import os
+import sys
+import glob
+
+import pytest
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, ROOT)
+
+from modules import pdf_parser
+from modules import fast_pdf
+
+EXAMPLES = sorted(glob.glob(os.path.join(ROOT, "examples", "*.pdf")))
+
+#===================================================================================================
+def read(path):
+    with open(path, 'rb') as f:
+        return(f.read())
+
+def summarize(pages):
+    """ Everything the rest of the program uses from a list of Page objects """
+    result = []
+    for pg in pages:
+        fields = []
+        for field in pg.fields:
+            rect = None
+            if(field.rect != None):
+                rect = [float(x) for x in field.rect]
+            fields.append((field.name, field.value, rect))
+        result.append((pg.page_hash, [float(x) for x in pg.mediabox], fields))
+    return(result)
+
+def make_pdf(objects, trailer = b"", startxref = None):
+    """ Builds a small PDF with a classic xref table. objects are numbered from 1 """
+    out = bytearray(b"%PDF-1.4\n")
+    offsets = []
+    for i, body in enumerate(objects):
+        offsets.append(len(out))
+        out += b"%d 0 obj\n" % (i + 1) + body + b"\nendobj\n"
+    
+    xref = len(out)
+    if(startxref == None):
+        startxref = xref
+    out += b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1)
+    for offset in offsets:
+        out += b"%010d 00000 n \n" % offset
+    out += b"trailer\n<</Size %d /Root 1 0 R %s>>\nstartxref\n%d\n%%%%EOF\n" % (
+        len(objects) + 1, trailer, startxref
+    )
+    return(bytes(out))
+
+def make_hybrid_pdf():
+    """ Builds FORM_OBJECTS as a hybrid-reference PDF. The widget is in an object stream, which
+    the classic xref table lists as free. Only the /XRefStm says where it is """
+    widget = FORM_OBJECTS[3]
+    header = b"4 0 "
+    objstm = b"<</Type /ObjStm /N 1 /First %d /Length %d>>\nstream\n%s%s\nendstream" % (
+        len(header), len(header) + len(widget), header, widget
+    )
+    # Object 4 is entry 0 of object stream 5
+    xrefstm = b"<</Type /XRef /Size 7 /W [1 2 1] /Index [4 1] /Length 4>>\nstream\n\x02\x00\x05\x00\nendstream"
+    objects = FORM_OBJECTS[:3] + [None, objstm, xrefstm]
+    
+    out = bytearray(b"%PDF-1.5\n")
+    offsets = []
+    for i, body in enumerate(objects):
+        offsets.append(len(out))
+        if(body != None):
+            out += b"%d 0 obj\n" % (i + 1) + body + b"\nendobj\n"
+    
+    xref = len(out)
+    out += b"xref\n0 7\n0000000000 65535 f \n"
+    for i, offset in enumerate(offsets):
+        if(objects[i] == None):
+            out += b"0000000000 00001 f \n"
+        else:
+            out += b"%010d 00000 n \n" % offset
+    out += b"trailer\n<</Size 7 /Root 1 0 R /XRefStm %d>>\nstartxref\n%d\n%%%%EOF\n" % (offsets[5], xref)
+    return(bytes(out))
+
+FORM_OBJECTS = [
+    b"<</Type /Catalog /Pages 2 0 R /AcroForm <</Fields [4 0 R]>>>>",
+    b"<</Type /Pages /Kids [3 0 R] /Count 1>>",
+    b"<</Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] /Annots [4 0 R]>>",
+    b"<</Type /Annot /Subtype /Widget /FT /Tx /T (name) /V (Ada) /Rect [10 10 100 30] /P 3 0 R>>"
+]
+
+#===================================================================================================
+@pytest.mark.parametrize("path", EXAMPLES, ids=os.path.basename)
+def test_examples_match_pdfminer(path):
+    data = read(path)
+    fast = summarize(pdf_parser.get_pdf_pages_fast(data))
+    assert(len(fast) > 0)
+    assert(fast == summarize(pdf_parser.get_pdf_pages_pdfminer(data)))
+
+@pytest.mark.parametrize("path", EXAMPLES, ids=os.path.basename)
+def test_examples_match_pdfminer_filtered(path):
+    data = read(path)
+    names = [field.name for pg in pdf_parser.get_pdf_pages_pdfminer(data) for field in pg.fields]
+    field_filter = frozenset(names[::2])
+    assert(summarize(pdf_parser.get_pdf_pages_fast(data, field_filter)) ==
+           summarize(pdf_parser.get_pdf_pages_pdfminer(data, field_filter)))
+
+def test_xref_table_matches_pdfminer():
+    data = make_pdf(FORM_OBJECTS)
+    fast = summarize(pdf_parser.get_pdf_pages_fast(data))
+    assert(fast == [(fast[0][0], [0.0, 0.0, 612.0, 792.0], [("name", "Ada", [10.0, 10.0, 100.0, 30.0])])])
+    assert(fast == summarize(pdf_parser.get_pdf_pages_pdfminer(data)))
+
+def test_hybrid_xref_matches_pdfminer():
+    data = make_hybrid_pdf()
+    fast = summarize(pdf_parser.get_pdf_pages_fast(data))
+    assert([fields for _, _, fields in fast] == [[("name", "Ada", [10.0, 10.0, 100.0, 30.0])]])
+    assert(fast == summarize(pdf_parser.get_pdf_pages_pdfminer(data)))
+
+#===================================================================================================
+@pytest.mark.parametrize("data", [
+    b"",
+    b"not a pdf at all",
+    b"%PDF-1.4\n1 0 obj\n<<>>\nendobj\n",
+    make_pdf(FORM_OBJECTS)[:200],
+], ids=["empty", "garbage", "no-xref", "truncated"])
+def test_broken_files_are_rejected(data):
+    with pytest.raises(fast_pdf.READ_ERRORS):
+        fast_pdf.Reader(data).get_pages()
+
+def test_encrypted_file_is_rejected():
+    data = make_pdf(
+        FORM_OBJECTS + [b"<</Filter /Standard /V 1 /R 2 /O <00> /U <00> /P -4>>"],
+        b"/Encrypt 5 0 R"
+    )
+    with pytest.raises(fast_pdf.Unsupported):
+        fast_pdf.Reader(data)
+
+def test_broken_xref_falls_back_to_pdfminer():
+    # pdfminer recovers by scanning for objects. The fast reader gives up
+    data = make_pdf(FORM_OBJECTS, startxref = 5)
+    with pytest.raises(fast_pdf.READ_ERRORS):
+        fast_pdf.Reader(data).get_pages()
+    pages = pdf_parser.get_pdf_pages(None, None, data)
+    assert([(field.name, field.value) for field in pages[0].fields] == [("name", "Ada")])